@@ -32,6 +32,8 @@ install_requires = ['Django>=1.6, <1.9', 'django-tagging', 'httplib2',
 major_python_version, minor_python_version, _, _, _ = sys.version_info
 if major_python_version < 3 or (major_python_version == 3 and minor_python_version < 4):
     install_requires.append('pathlib')
+if major_python_version < 3 or (major_python_version == 3 and minor_python_version < 5):
+    install_requires.append('scandir')
 
 setup(
     name = "Sumatra",
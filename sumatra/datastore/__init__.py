@@ -11,7 +11,7 @@ Classes
 FileSystemDataStore - provides methods for accessing files stored on a local file
                       system, under a given root directory.
 ArchivingFileSystemDataStore - provides methods for accessing files written to
-                      a local file system then archived as .tar.gz.
+                      a local file system then archived as .tar.gz or .zip.
 MirroredFileSystemDataStore - provides methods for accessing files written to
                       a local file system then mirrored to a web server
 
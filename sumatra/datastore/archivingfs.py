@@ -1,6 +1,12 @@
 """
-Datastore based on files written to the local filesystem, archived in gzipped
-tar files, then retrieved from the tar files.
+Datastore based on files written to the local filesystem, archived in
+(compressed) tar files or in zip files, then retrieved from the archives.
+
+Zip files have a central directory of their members, so a single member can be
+read without decompressing the rest of the archive. This makes them the better
+choice when individual files are often viewed, e.g. in the web interface.
+Compressed tar files are compressed by several threads in parallel (see
+:mod:`sumatra.datastore.compression`), so they are faster to create.
 
 
 :copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
@@ -10,53 +16,123 @@ tar files, then retrieved from the tar files.
 from __future__ import with_statement
 from __future__ import unicode_literals
 import os
+import sys
 import tarfile
+import zipfile
 import shutil
+import hashlib
 import logging
 import mimetypes
 import datetime
-from contextlib import closing  # needed for Python 2.6
+from multiprocessing import cpu_count
+from contextlib import closing, contextmanager  # closing needed for Python 2.6
 from sumatra.core import TIMESTAMP_FORMAT, component
 
 
-from .base import DataItem
+from .base import DataItem, DataKey, DIGEST_CHUNK_SIZE, read_chunks
+from .digest_cache import cached_digest, get_digest_cache, batch_updates
 from .filesystem import FileSystemDataStore
+from .compression import CODECS, ParallelCompressedFile
+
+
+ARCHIVE_FORMATS = ("tar", "zip")
+# archives created by earlier versions of Sumatra are all .tar.gz files
+ARCHIVE_EXTENSIONS = [".tar.gz", ".zip", ".tar.bz2", ".tar", ".tar.xz"]
+# members of zip files can only be written from file objects, and the
+# compression level chosen, in recent versions of Python
+ZIP_STREAMING = sys.version_info >= (3, 6)
+ZIP_COMPRESSLEVEL = sys.version_info >= (3, 7)
+
+
+class _HashingReader(object):
+    """Wraps a file object, calculating the SHA-1 digest of the data read from it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha1 = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha1.update(data)
+        return data
 
 
 class ArchivedDataFile(DataItem):
-    """A file-like object, that represents a file inside a tar archive"""
+    """A file-like object, that represents a file inside a tar or zip archive"""
     # current implementation just for real files
 
     def __init__(self, path, store, creation=None):
         self.path = path
         archive_label = self.path.split(os.path.sep)[0]
-        self.tarfile_path = os.path.join(store.archive_store, archive_label + ".tar.gz")
-        info = self._get_info()
-        self.size = info.size
-        self.creation = creation or datetime.datetime.fromtimestamp(info.mtime).replace(microsecond=0)
+        self.archive_path = self._find_archive(store, archive_label)
+        self.size, mtime = self._get_info()
+        self.creation = creation or mtime.replace(microsecond=0)
         self.name = os.path.basename(self.path)
         self.extension = os.path.splitext(self.name)
         self.mimetype, self.encoding = mimetypes.guess_type(self.path)
 
+    def _find_archive(self, store, archive_label):
+        """Return the path of the archive containing this file."""
+        for extension in ARCHIVE_EXTENSIONS:
+            archive_path = os.path.join(store.archive_store, archive_label + extension)
+            if os.path.exists(archive_path):
+                return archive_path
+        return os.path.join(store.archive_store, archive_label + ".tar.gz")
+
+    @property
+    def _is_zip(self):
+        return self.archive_path.endswith(".zip")
+
+    @property
+    def _member_name(self):
+        # zip files always use forward slashes
+        return self.path.replace(os.path.sep, "/") if self._is_zip else self.path
+
+    def _open_archive(self):
+        if self._is_zip:
+            return zipfile.ZipFile(self.archive_path, 'r')
+        return tarfile.open(self.archive_path, 'r')
+
     def _get_info(self):
-        with closing(tarfile.open(self.tarfile_path, 'r')) as data_archive:
+        """Return the size and modification time of the file."""
+        with closing(self._open_archive()) as data_archive:
+            if self._is_zip:
+                info = data_archive.getinfo(self._member_name)
+                return info.file_size, datetime.datetime(*info.date_time)
             info = data_archive.getmember(self.path)
-        return info
+            return info.size, datetime.datetime.fromtimestamp(info.mtime)
+
+    @contextmanager
+    def _open_member(self):
+        """
+        Open the file within the archive. Only for zip archives is it possible
+        to go straight to the file, without decompressing the files before it.
+        """
+        with closing(self._open_archive()) as data_archive:
+            if self._is_zip:
+                f = data_archive.open(self._member_name)
+            else:
+                f = data_archive.extractfile(self.path)
+            with closing(f):
+                yield f
 
     def get_content(self, max_length=None):
-        with closing(tarfile.open(self.tarfile_path, 'r')) as data_archive:
-            f = data_archive.extractfile(self.path)
+        with self._open_member() as f:
             if max_length:
-                content = f.read(max_length)
-            else:
-                content = f.read()
-            f.close()
-            return content
+                return f.read(max_length)
+            return f.read()
     content = property(fget=get_content)
 
+    def iter_content(self, chunk_size=DIGEST_CHUNK_SIZE):
+        with self._open_member() as f:
+            for chunk in read_chunks(f, chunk_size):
+                yield chunk
+
     @property
-    def sorted_content(self):
-        raise NotImplementedError
+    def digest(self):
+        # archives are not modified once written, but may be replaced
+        return cached_digest(self.archive_path, lambda: DataItem.digest.fget(self),
+                             key=os.path.join(os.path.abspath(self.archive_path), self.path))
 
 
 @component
@@ -65,49 +141,161 @@ class ArchivingFileSystemDataStore(FileSystemDataStore):
     Represents a locally-mounted filesystem that archives any new files created
     in it. The root of the data store will generally be a subdirectory of the
     real filesystem.
+
+    *archive_format* may be "tar" (the default) or "zip". *compression* may be
+    "gzip" (the default), "bzip2", "xz" or "none", and *compression_level* is
+    the compression level for that method (by default, the highest level for
+    gzip and bzip2, and 6 for xz). For fast archiving, use gzip with level 1,
+    or no compression. Tar files are compressed by up to
+    :attr:`compression_workers` threads in parallel.
     """
     data_item_class = ArchivedDataFile
+    compression_workers = cpu_count()
 
-    def __init__(self, root, archive=".smt/archive"):
-        super(ArchivingFileSystemDataStore, self).__init__(root)
+    def __init__(self, root, archive=".smt/archive", change_detection="mtime",
+                 archive_format="tar", compression="gzip", compression_level=None):
+        super(ArchivingFileSystemDataStore, self).__init__(root, change_detection)
         self.archive_store = archive
-        # should allow specification of archive format, e.g. tar.gz or zip
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError("archive_format must be 'tar' or 'zip'")
+        if compression not in CODECS:
+            raise ValueError("compression must be one of %s" % ", ".join(sorted(CODECS)))
+        if archive_format == "zip" and CODECS[compression].zip_compression is None:
+            raise ValueError("%s compression of zip files is not supported by this version "
+                             "of Python" % compression)
+        self.archive_format = archive_format
+        self.compression = compression
+        self.compression_level = compression_level
 
     def __getstate__(self):
-        return {'root': self.root, 'archive': self.archive_store}
+        state = super(ArchivingFileSystemDataStore, self).__getstate__()
+        state['archive'] = self.archive_store
+        # only non-default settings are included, so that the state of
+        # existing data stores is unchanged
+        if self.archive_format != "tar":
+            state['archive_format'] = self.archive_format
+        if self.compression != "gzip":
+            state['compression'] = self.compression
+        if self.compression_level not in (None, CODECS[self.compression].default_level):
+            state['compression_level'] = self.compression_level
+        return state
 
     def find_new_data(self, timestamp):
         """Finds newly created/changed data items"""
         new_files = self._find_new_data_files(timestamp)
         label = timestamp.strftime(TIMESTAMP_FORMAT)
-        archive_paths = self._archive(label, new_files)
-        return [ArchivedDataFile(path, self).generate_key()
-                for path in archive_paths]
+        return self._archive_files(label, new_files)
 
     def _archive(self, label, files, delete_originals=True):
         """
         Archives files and, by default, deletes the originals.
         """
+        return [key.path for key in self._archive_files(label, files, delete_originals)]
+
+    def _archive_files(self, label, files, delete_originals=True):
+        """
+        Archives files and, by default, deletes the originals. Returns keys
+        for the archived files.
+
+        The archive is written directly into the archive store, under a
+        temporary name until it is complete. The files are hashed as they are
+        archived, so that they only need to be read once.
+        """
         if not os.path.exists(self.archive_store):
             os.mkdir(self.archive_store)
-        tf = tarfile.open(label + ".tar.gz",'w:gz')
-        logging.info("Archiving data to file %s" % tf.name)
-        # Add data files
-        archive_paths = []
-        for file_path in files:
-            archive_path = os.path.join(label, file_path)
-            tf.add(os.path.join(self.root, file_path), archive_path)
-            archive_paths.append(archive_path)
-        tf.close()
-        # Move the archive to self.archive_store
-        shutil.copy(tf.name, self.archive_store) # shutil.move() doesn't work as expected if dataroot is a symbolic link
-        os.remove(tf.name)
+        if self.archive_format == "zip":
+            archive_file = os.path.join(self.archive_store, label + ".zip")
+            add_files = self._write_zip
+        else:
+            archive_file = os.path.join(self.archive_store,
+                                        label + ".tar" + CODECS[self.compression].extension)
+            add_files = self._write_tar
+        logging.info("Archiving data to file %s" % archive_file)
+        partial_file = archive_file + ".part"
+        try:
+            members = add_files(partial_file, [(os.path.join(self.root, file_path),
+                                                os.path.join(label, file_path))
+                                               for file_path in files])
+        except:
+            if os.path.exists(partial_file):
+                os.remove(partial_file)
+            raise
+        os.rename(partial_file, archive_file)
+        keys = []
+        cache = get_digest_cache()
+        archive_stats = os.stat(archive_file)
+        with batch_updates():
+            for archive_path, size, mtime, digest in members:
+                mimetype, encoding = mimetypes.guess_type(archive_path)
+                keys.append(DataKey(archive_path, digest, mtime.replace(microsecond=0),
+                                    mimetype=mimetype, encoding=encoding, size=size))
+                if cache is not None:
+                    cache.set(os.path.join(os.path.abspath(archive_file), archive_path),
+                              archive_stats, digest)
         # Delete original files.
         if delete_originals:
             for file_path in files:
                 os.remove(os.path.join(self.root, file_path))
         self._last_label = label # useful for testing
-        return archive_paths
+        return keys
+
+    def _write_tar(self, tar_path, files):
+        """
+        Write the given (full path, archive path) pairs to a tar file. Returns
+        the archive path, size, modification time and digest of each file.
+        """
+        members = []
+        if self.compression == "none":
+            fileobj = open(tar_path, 'wb')
+        else:
+            fileobj = ParallelCompressedFile(open(tar_path, 'wb'), self.compression,
+                                             self.compression_level, self.compression_workers)
+        with closing(fileobj):
+            with closing(tarfile.open(fileobj=fileobj, mode='w|')) as tf:
+                for full_path, archive_path in files:
+                    info = tf.gettarinfo(full_path, archive_path)
+                    with open(full_path, 'rb') as f:
+                        reader = _HashingReader(f)
+                        tf.addfile(info, reader)
+                    members.append((archive_path, info.size,
+                                    datetime.datetime.fromtimestamp(info.mtime),
+                                    reader.sha1.hexdigest()))
+        return members
+
+    def _write_zip(self, zip_path, files):
+        """
+        Write the given (full path, archive path) pairs to a zip file. Returns
+        the archive path, size, modification time and digest of each file.
+        """
+        members = []
+        compression = CODECS[self.compression].zip_compression
+        options = {}
+        if ZIP_COMPRESSLEVEL:
+            options["compresslevel"] = self.compression_level
+        with closing(zipfile.ZipFile(zip_path, 'w', compression, allowZip64=True,
+                                     **options)) as zf:
+            for full_path, archive_path in files:
+                if ZIP_STREAMING:
+                    info = zipfile.ZipInfo.from_file(full_path, archive_path)
+                    info.compress_type = compression
+                    with open(full_path, 'rb') as f:
+                        reader = _HashingReader(f)
+                        with zf.open(info, 'w', force_zip64=info.file_size > 0x7fffffff) as dest:
+                            shutil.copyfileobj(reader, dest, DIGEST_CHUNK_SIZE)
+                    digest = reader.sha1.hexdigest()
+                else:
+                    # earlier versions cannot write a member from a file object,
+                    # so the file is read twice: once to hash it, once to archive it
+                    with open(full_path, 'rb') as f:
+                        reader = _HashingReader(f)
+                        for chunk in iter(lambda: reader.read(DIGEST_CHUNK_SIZE), b""):
+                            pass
+                    digest = reader.sha1.hexdigest()
+                    zf.write(full_path, archive_path)
+                    info = zf.getinfo(archive_path.replace(os.path.sep, "/"))
+                members.append((archive_path, info.file_size,
+                                datetime.datetime(*info.date_time), digest))
+        return members
 
     def delete(self, *keys):
         """Delete the files corresponding to the given keys."""
@@ -9,15 +9,35 @@ from builtins import object
 
 import hashlib
 import os.path
+from contextlib import closing
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from ..core import component_type
 
 IGNORE_DIGEST = "0"*40
+#: size of the blocks in which content is read when calculating digests
+DIGEST_CHUNK_SIZE = 1024 * 1024
+# line digests are added modulo 2**160, so that their sum does not depend on
+# the order of the lines
+LINE_DIGEST_MODULUS = 2 ** 160
+
+
+def read_chunks(f, chunk_size=DIGEST_CHUNK_SIZE):
+    """
+    Return an iterator over the contents of a file-like object, in blocks of
+    at most *chunk_size* bytes. The file is closed once it has been read.
+    """
+    with closing(f):
+        for chunk in iter(partial(f.read, chunk_size), b""):
+            yield chunk
 
 
 @component_type
 class DataStore(object):
     """Base class for data storage abstractions."""
     required_attributes = ("find_new_data", "get_data_item", "delete")
+    #: maximum number of data items copied at once by :meth:`save_copies`
+    copy_workers = 4
 
     def __getstate__(self):
         """
@@ -30,6 +50,14 @@ class DataStore(object):
     def copy(self):
         return self.__class__(**self.__getstate__())
 
+    def start_watching(self):
+        """
+        Called immediately before a computation is launched. Subclasses may
+        use this to start tracking the data items created by the computation,
+        which are then returned by :meth:`find_new_data`.
+        """
+        pass
+
     def find_new_data(self, timestamp):
         """Finds newly created/changed data items"""
         raise NotImplementedError
@@ -48,6 +76,24 @@ class DataStore(object):
         """
         return self.get_data_item(key).get_content(max_length)
 
+    def save_copies(self, keys, path):
+        """
+        Save copies of the data items identified by *keys* to the local
+        directory *path*, which is created if it does not exist. Up to
+        :attr:`copy_workers` items are copied at once.
+
+        Return a list of the full paths of the copies, in the same order as
+        *keys*.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        pool = ThreadPool(self.copy_workers)
+        try:
+            return pool.map(lambda key: self.get_data_item(key).save_copy(path), keys)
+        finally:
+            pool.close()
+            pool.join()
+
     def delete(self, *keys):
         """
         Delete the files corresponding to the given keys.
@@ -75,6 +121,8 @@ class DataKey(object):
     a proxy for the :class:`DataItem` on a system where the actual data is not
     available.
     """
+    # a record may have many thousands of data keys, so they are kept small
+    __slots__ = ("path", "digest", "creation", "metadata")
 
     def __init__(self, path, digest, creation, **metadata):
         self.path = path
@@ -82,6 +130,14 @@ class DataKey(object):
         self.creation = creation
         self.metadata = metadata
 
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        # also accepts the __dict__ of data keys pickled by earlier versions
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def __repr__(self):
         return "%s(%s [%s])" % (self.path, self.digest, self.creation)
 
@@ -102,16 +158,23 @@ class DataItem(object):
 
     @property
     def digest(self):
-        """docstring"""
-        return hashlib.sha1(self.content).hexdigest()
+        """SHA-1 digest of the content, which is read a block at a time."""
+        sha1 = hashlib.sha1()
+        for chunk in self.iter_content():
+            sha1.update(chunk)
+        return sha1.hexdigest()
 
     def __eq__(self, other):
+        """
+        Two data items are equal if they have the same content, or if they
+        contain the same lines in a different order.
+        """
         if self.size != other.size:
             return False
-        elif self.content == other.content: # use digest here?
+        elif self.digest == other.digest:
             return True
         else:
-            return self.sorted_content == other.sorted_content
+            return self.unordered_digest == other.unordered_digest
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -130,13 +193,90 @@ class DataItem(object):
         """
         raise NotImplementedError
 
+    def iter_content(self, chunk_size=DIGEST_CHUNK_SIZE):
+        """
+        Return an iterator over the contents of the data item, in blocks of at
+        most *chunk_size* bytes.
+
+        This default implementation returns the entire content as a single
+        block. Subclasses that can read their content incrementally should
+        override it.
+        """
+        yield self.content
+
+    def iter_range(self, start, stop=None, chunk_size=DIGEST_CHUNK_SIZE):
+        """
+        Return an iterator over the bytes from offset *start* up to (but not
+        including) offset *stop*, or to the end of the data item if *stop* is
+        None, in blocks of at most *chunk_size* bytes.
+
+        This default implementation reads and discards the content before
+        *start*. Subclasses that can seek within their content should
+        override it.
+        """
+        position = 0
+        for chunk in self.iter_content(chunk_size):
+            end = position + len(chunk)
+            if end > start:
+                chunk = chunk[max(start - position, 0):]
+                if stop is not None and end >= stop:
+                    yield chunk[:len(chunk) - (end - stop)]
+                    return
+                yield chunk
+            position = end
+
+    def iter_lines(self, chunk_size=DIGEST_CHUNK_SIZE, start=0):
+        """
+        Return an iterator over the lines of the data item, without their
+        line terminators, beginning at byte offset *start*. Only one block of
+        content is held in memory at a time, plus any line which is longer
+        than a block.
+        """
+        remainder = b""
+        if start:
+            chunks = self.iter_range(start, chunk_size=chunk_size)
+        else:
+            chunks = self.iter_content(chunk_size)
+        for chunk in chunks:
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+            for line in lines:
+                yield line
+        if remainder:
+            yield remainder
+
+    @property
+    def unordered_digest(self):
+        """
+        Digest of the lines of the content, which does not depend on the order
+        of the lines. Each line is hashed separately, and the line digests are
+        summed, so the content is read in blocks and never held in memory.
+        """
+        total = 0
+        n_lines = 0
+        for line in self.iter_lines():
+            total += int(hashlib.sha1(line).hexdigest(), 16)
+            n_lines += 1
+        return "%040x-%d" % (total % LINE_DIGEST_MODULUS, n_lines)
+
+    @property
     def sorted_content(self):
-        """Return the contents of the data item, sorted by line."""
-        raise NotImplementedError
+        """
+        Return the contents of the data item, sorted by line.
+
+        The whole content is loaded into memory: to compare the lines of
+        large data items, use :attr:`unordered_digest`.
+        """
+        lines = self.content.split(b"\n")
+        if len(lines) > 1 and lines[-1] == b"":  # the content ends with a line terminator
+            lines.pop()
+            return b"\n".join(sorted(lines)) + b"\n"
+        return b"\n".join(sorted(lines))
 
     def save_copy(self, path):
         """
-        Save a copy of the data to a local file.
+        Save a copy of the data to a local file. The data are copied a block
+        at a time, so they need not fit in memory.
 
         If path is an existing directory, the data item path will be appended
         to it, otherwise path is treated as a full path including filename,
@@ -144,13 +284,26 @@ class DataItem(object):
 
         Return the full path of the final file.
         """
+        full_path = self._copy_destination(path)
+        with open(full_path, "wb") as fp:
+            for chunk in self.iter_content():
+                fp.write(chunk)
+        return full_path
+
+    def _copy_destination(self, path):
+        """
+        Return the full path of the file to which :meth:`save_copy` should
+        write, creating its parent directory if necessary.
+        """
         if os.path.isdir(path):
             full_path = os.path.join(path, self.path)
         else:
             full_path = path
         dir = os.path.dirname(full_path)
-        if not os.path.exists(dir):
-            os.makedirs(dir)
-        with open(full_path, "w") as fp:
-            fp.write(self.content)
+        if dir and not os.path.exists(dir):
+            try:
+                os.makedirs(dir)
+            except OSError:  # may have been created by another thread in the meantime
+                if not os.path.isdir(dir):
+                    raise
         return full_path
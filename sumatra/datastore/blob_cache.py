@@ -0,0 +1,241 @@
+"""
+Provides a local cache of data that would otherwise be fetched from a remote
+server each time it is read, such as files available only from the mirror of
+a :class:`MirroredFileSystemDataStore` or archives stored by a
+:class:`DavFsDataStore`.
+
+Each item in the cache (a "blob") is stored as a separate file, whose name is
+the key of the blob, usually its SHA-1 digest. Blobs are downloaded to a
+temporary file, checked against their expected digest (or size) and only then
+renamed into place, so that an interrupted or corrupted download is never
+used. When the total size of the blobs exceeds the size limit of the cache,
+the least recently used blobs are evicted, apart from the one just fetched.
+Blobs larger than the cache itself are not cached at all. Where their size is
+known in advance (given by the caller, or by the Content-Length of an HTTP
+response) they are not downloaded into the cache either; otherwise a blob
+that turns out to be too large is passed on from its temporary file, so that
+it is never downloaded twice.
+
+Another process may evict a blob between it being fetched and being opened.
+:meth:`BlobCache.open_blob` takes care of this by fetching the blob again; a
+blob which has been opened remains readable even if it is then evicted (on
+POSIX systems).
+
+The cache is stored in the .smt directory of the current project; if there is
+no .smt directory in the working directory, remote data are not cached.
+
+
+:copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+from __future__ import unicode_literals
+from builtins import object
+
+import os
+import hashlib
+import tempfile
+import threading
+from contextlib import closing
+from .base import read_chunks
+
+BLOB_CACHE_DIR = os.path.join(".smt", "cache", "blobs")
+#: default maximum total size of the cached blobs, in bytes
+BLOB_CACHE_SIZE = 1024 ** 3
+
+
+class BlobCache(object):
+    """
+    A directory of locally-cached copies of remote data, holding at most
+    *max_size* bytes.
+
+    The cache may be shared between threads, and between processes.
+    """
+
+    def __init__(self, directory=BLOB_CACHE_DIR, max_size=BLOB_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        # spread the blobs over subdirectories, to keep directory sizes down
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """
+        Return the path of the cached blob with the given key, or None if it
+        is not in the cache.
+        """
+        path = self._path(key)
+        try:
+            os.utime(path, None)  # the modification time records the last use
+        except OSError:
+            return None
+        return path
+
+    def fetch(self, key, open_remote, digest=None, size=None):
+        """
+        Return the path of the cached blob with the given key. If it is not
+        in the cache, it is read from the file-like object returned by
+        *open_remote()* and added to the cache.
+
+        If *digest* (the SHA-1 digest of the content) or *size* is given, the
+        downloaded data are checked against it, and an :class:`IOError` is
+        raised if they do not match.
+
+        Returns None if the blob is larger than the cache, in which case it is
+        not cached (nor, if its size is known in advance, downloaded).
+        """
+        path = self.get(key)
+        if path is not None:
+            return path
+        if size is not None and size > self.max_size:
+            return None
+        remote = open_remote()
+        if _content_length(remote) > self.max_size:
+            remote.close()
+            return None
+        path, oversized = self._download(key, remote, digest, size)
+        return path
+
+    def _download(self, key, remote, digest=None, size=None, keep_oversized=False):
+        """
+        Read a blob from the file-like object *remote* into the cache, and
+        return a tuple (path, None). If the blob turns out to be larger than
+        the cache, return (None, None) or, if *keep_oversized* is True,
+        (None, f), where f is the downloaded data, opened for reading.
+        """
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:  # may have been created by another thread in the meantime
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        sha1 = hashlib.sha1()
+        n_bytes = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".download-")
+        try:
+            with closing(os.fdopen(fd, 'wb')) as f:
+                for chunk in read_chunks(remote):
+                    sha1.update(chunk)
+                    n_bytes += len(chunk)
+                    f.write(chunk)
+            if digest is not None and sha1.hexdigest() != digest:
+                raise IOError("Digest of downloaded data (%s) does not match the expected digest (%s)"
+                              % (sha1.hexdigest(), digest))
+            if size is not None and n_bytes != size:
+                raise IOError("Downloaded %d bytes, expected %d" % (n_bytes, size))
+            if n_bytes > self.max_size:
+                oversized = open(tmp_path, 'rb') if keep_oversized else None
+                os.remove(tmp_path)  # an open file remains readable (on POSIX systems)
+                return None, oversized
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict(keep=path)
+        return path, None
+
+    def open_blob(self, key, open_remote, digest=None, size=None):
+        """
+        Return the cached blob with the given key, opened for reading, fetching
+        it as for :meth:`fetch` if necessary. If the blob is too large to be
+        cached, the file-like object returned by *open_remote()* (or, if the
+        size of the blob was not known in advance, the data already
+        downloaded) is returned instead.
+        """
+        for attempt in range(3):
+            path = self.get(key)
+            if path is None:
+                if size is not None and size > self.max_size:
+                    return open_remote()
+                remote = open_remote()
+                if _content_length(remote) > self.max_size:
+                    return remote
+                path, oversized = self._download(key, remote, digest, size, keep_oversized=True)
+                if path is None:
+                    return oversized
+            try:
+                return open(path, 'rb')
+            except IOError:  # evicted by another process in the meantime
+                continue
+        return open_remote()
+
+    def _blobs(self):
+        """Return a list of (last use, size, path) for each cached blob."""
+        blobs = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.startswith(".download-"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stats = os.stat(path)
+                except OSError:  # evicted by another process
+                    continue
+                blobs.append((stats.st_mtime, stats.st_size, path))
+        return blobs
+
+    def size(self):
+        """Return the total size of the cached blobs, in bytes."""
+        return sum(size for last_use, size, path in self._blobs())
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used blobs until the total size of the
+        cache is within its limit. The blob at path *keep*, if given, is
+        never removed.
+        """
+        with self._lock:
+            blobs = sorted(self._blobs())
+            total = sum(size for last_use, size, path in blobs)
+            for last_use, size, path in blobs:
+                if total <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+    def clear(self):
+        """Remove all blobs from the cache."""
+        with self._lock:
+            for last_use, size, path in self._blobs():
+                os.remove(path)
+
+
+def _content_length(f):
+    """
+    Return the size of the data to be read from *f*, if it is an HTTP
+    response with a Content-Length header, or -1.
+    """
+    headers = getattr(f, "headers", None)
+    try:
+        return int(headers.get("Content-Length"))
+    except (AttributeError, TypeError, ValueError):
+        return -1
+
+
+_caches = {}
+
+
+def get_blob_cache():
+    """
+    Return the blob cache for the project in the current working directory,
+    or None if the working directory does not contain a project.
+    """
+    if not os.path.isdir(os.path.dirname(os.path.dirname(BLOB_CACHE_DIR))):
+        return None
+    directory = os.path.abspath(BLOB_CACHE_DIR)
+    if directory not in _caches:
+        try:
+            _caches[directory] = BlobCache(directory)
+        except OSError:  # e.g. read-only project directory
+            return None
+    return _caches[directory]
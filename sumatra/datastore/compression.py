@@ -0,0 +1,118 @@
+"""
+Compression of data archives using several threads at once.
+
+Gzip, bzip2 and xz files may consist of several independently-compressed
+streams, one after another, which are decompressed as if they were a single
+stream. :class:`ParallelCompressedFile` takes advantage of this by splitting
+the data written to it into blocks and compressing the blocks in parallel.
+The resulting files can be read by the standard tools and by the
+:mod:`tarfile` module.
+
+
+:copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+from __future__ import unicode_literals
+from builtins import object
+
+import bz2
+import gzip
+import zipfile
+from io import BytesIO
+from contextlib import closing  # needed for Python 2.6
+from collections import deque, namedtuple
+from multiprocessing.pool import ThreadPool
+try:
+    import lzma  # Python 3.3 and later
+except ImportError:
+    lzma = None
+
+Codec = namedtuple("Codec", ["extension", "compress", "default_level", "zip_compression"])
+
+
+def _gzip_compress(data, level):
+    # gzip.compress() is only available in Python 3.2 and later
+    buffer = BytesIO()
+    with closing(gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=level)) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+#: The supported compression methods. *compress* is a function taking the
+#: data and the compression level. *zip_compression* is None for methods
+#: which the zipfile module of this version of Python does not support.
+#: "xz" is only available if the :mod:`lzma` module is (Python 3.3 and later).
+CODECS = {
+    "gzip": Codec(".gz", _gzip_compress, 9, zipfile.ZIP_DEFLATED),
+    "bzip2": Codec(".bz2", lambda data, level: bz2.compress(data, level), 9,
+                   getattr(zipfile, "ZIP_BZIP2", None)),
+    "none": Codec("", None, None, zipfile.ZIP_STORED),
+}
+if lzma is not None:
+    CODECS["xz"] = Codec(".xz", lambda data, level: lzma.compress(data, preset=level), 6,
+                         getattr(zipfile, "ZIP_LZMA", None))
+
+
+class ParallelCompressedFile(object):
+    """
+    A write-only file-like object that compresses the data written to it and
+    writes the result to *fileobj*.
+
+    The data are split into blocks of *block_size* bytes, which are compressed
+    by up to *n_workers* threads at once. The compression modules release the
+    GIL, so the threads can use several processor cores. At most
+    2 x *n_workers* blocks are held in memory at any time.
+
+    *fileobj* is closed when this file is closed.
+    """
+
+    def __init__(self, fileobj, codec="gzip", level=None, n_workers=4, block_size=4 * 1024 * 1024):
+        codec = CODECS[codec]
+        if level is None:
+            level = codec.default_level
+        self.fileobj = fileobj
+        self._compress = lambda data: codec.compress(data, level)
+        self._block_size = block_size
+        self._buffer = []
+        self._buffered = 0
+        self._pool = ThreadPool(n_workers)
+        self._pending = deque()
+        self._max_pending = 2 * n_workers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._block_size:
+            self._submit()
+
+    def _submit(self):
+        block = b"".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._pending.append(self._pool.apply_async(self._compress, (block,)))
+        while len(self._pending) >= self._max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        # blocks are written in the order in which they were submitted
+        self.fileobj.write(self._pending.popleft().get())
+
+    def close(self):
+        if self._pool is None:
+            return
+        try:
+            if self._buffered:
+                self._submit()
+            while self._pending:
+                self._write_next()
+        finally:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self.fileobj.close()
@@ -1,18 +1,25 @@
 '''
 Datastore via remote webdav connection
+
+Archives are downloaded once into the local blob cache (see
+:mod:`sumatra.datastore.blob_cache`), and read from there afterwards.
 '''
 from __future__ import unicode_literals
 from future import standard_library
 standard_library.install_aliases()
 
 import os
+import hashlib
 import tarfile
 import logging
 from fs.contrib.davfs import DAVFS
 from urllib.parse import urlparse
-from contextlib import closing  # needed for Python 2.6
 
 from sumatra.core import component
+from .base import DataItem
+from .blob_cache import get_blob_cache
+from .digest_cache import cached_digest
+from .filesystem import FileSystemDataStore
 from .archivingfs import ArchivingFileSystemDataStore, ArchivedDataFile, TIMESTAMP_FORMAT
 
 
@@ -24,25 +31,43 @@ class DavFsDataItem(ArchivedDataFile):
         self.store = store
         super(DavFsDataItem, self).__init__(path, store)
 
-    def get_content(self, max_length=None):
-        obj = self.store.dav_fs.open(self.tarfile_path, 'rb')
-        with closing(tarfile.open(fileobj=obj)) as data_archive:
-            f = data_archive.extractfile(self.path)
-            if max_length:
-                content = f.read(max_length)
-            else:
-                content = f.read()
-            f.close()
-            return content
-
-    # mandatory repeat
-    content = property(fget=get_content)
+    def _find_archive(self, store, archive_label):
+        return os.path.join(store.archive_store, archive_label + ".tar.gz")
 
-    def _get_info(self):
-        obj = self.store.dav_fs.open(self.tarfile_path, 'rb')
-        with closing(tarfile.open(fileobj=obj)) as data_archive:
-            return data_archive.getmember(self.path)
-        return tarfile.TarInfo()
+    def _local_archive(self):
+        """
+        Return the path of a local copy of the archive, downloading it into
+        the blob cache if necessary, or None if there is no cache or the
+        archive is too large to be cached.
+        """
+        cache = get_blob_cache()
+        if cache is None:
+            return None
+        # archives are not modified once written, so they can be identified by their URL
+        key = hashlib.sha1(("%s/%s" % (self.store.dav_url, self.archive_path)).encode("utf-8")).hexdigest()
+        local_path = cache.get(key)
+        if local_path is None:
+            fs = self.store.dav_fs
+            local_path = cache.fetch(key, lambda: fs.open(self.archive_path, 'rb'),
+                                     size=fs.getsize(self.archive_path))
+        return local_path
+
+    def _open_archive(self):
+        local_path = self._local_archive()
+        if local_path is not None:
+            try:
+                return tarfile.open(local_path, 'r')
+            except IOError:  # evicted from the cache by another process
+                pass
+        return tarfile.open(fileobj=self.store.dav_fs.open(self.archive_path, 'rb'))
+
+    @property
+    def digest(self):
+        local_path = self._local_archive()
+        if local_path is None:
+            return DataItem.digest.fget(self)
+        return cached_digest(local_path, lambda: DataItem.digest.fget(self),
+                             key=os.path.join(local_path, self.path))
 
 
 @component
@@ -51,8 +76,8 @@ class DavFsDataStore(ArchivingFileSystemDataStore):
 
     data_item_class = DavFsDataItem
 
-    def __init__(self, root, dav_url, dav_user=None, dav_pw=None):
-        super(DavFsDataStore, self).__init__(root)
+    def __init__(self, root, dav_url, dav_user=None, dav_pw=None, change_detection="mtime"):
+        super(DavFsDataStore, self).__init__(root, change_detection=change_detection)
         parsed = urlparse(dav_url)
         self.dav_user = dav_user or parsed.username
         self.dav_pw = dav_pw or parsed.password
@@ -60,7 +85,9 @@ class DavFsDataStore(ArchivingFileSystemDataStore):
         self.dav_fs = DAVFS(url=self.dav_url, credentials={'username': self.dav_user, 'password': self.dav_pw})
 
     def __getstate__(self):
-        return {'root': self.root, 'dav_url': self.dav_url, 'dav_user': self.dav_user, 'dav_pw': self.dav_pw}
+        state = FileSystemDataStore.__getstate__(self)
+        state.update({'dav_url': self.dav_url, 'dav_user': self.dav_user, 'dav_pw': self.dav_pw})
+        return state
 
     def find_new_data(self, timestamp):
         """Finds newly created/changed data items"""
@@ -0,0 +1,210 @@
+"""
+Provides a persistent cache of the digests of data files, so that the digest
+of a file which has not changed since it was last hashed can be obtained with
+a single call to :func:`os.stat`, rather than by reading the whole file.
+
+Cache entries are keyed by the absolute path of the file, and are only used
+if the size, modification time (in nanoseconds) and inode number of the file
+are the same as when the digest was calculated. The cache is stored in an
+SQLite database in the .smt directory of the current project; if there is no
+.smt directory in the working directory, digests are not cached.
+
+When many digests are calculated at once, e.g. for the new data files of a
+computation, the cache should be updated within :meth:`DigestCache.batch`,
+so that the new entries are written in a single transaction.
+
+
+:copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+from __future__ import unicode_literals
+from builtins import object
+
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DIGEST_CACHE_FILE = os.path.join(".smt", "digests.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS digest (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    cached REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS digest_cached ON digest (cached);
+"""
+
+
+def _signature(stats):
+    """Return the (size, mtime_ns, inode) tuple used to validate cache entries."""
+    mtime_ns = getattr(stats, "st_mtime_ns", None)  # not available in Python 2
+    if mtime_ns is None:
+        mtime_ns = int(stats.st_mtime * 1e9)
+    return (stats.st_size, mtime_ns, stats.st_ino)
+
+
+class DigestCache(object):
+    """
+    A persistent mapping from file paths to the digests of their contents.
+
+    When the cache contains more than *max_entries* entries, the entries that
+    were added first are evicted (first in, first out: using an entry does not
+    keep it in the cache, since that would need a write for every lookup).
+
+    The cache may be shared between threads.
+    """
+
+    def __init__(self, db_file=DIGEST_CACHE_FILE, max_entries=100000):
+        self.db_file = db_file
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._batch_depth = 0
+        self._pending = {}  # entries to be written at the end of the batch, by path
+        self._connection = sqlite3.connect(db_file, timeout=30.0, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        with self._connection:
+            self._connection.executescript(SCHEMA)
+
+    def __del__(self):
+        if hasattr(self, "_connection"):
+            self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM digest").fetchone()[0]
+
+    def get(self, path, stats):
+        """
+        Return the cached digest of the file at *path*, whose current
+        :func:`os.stat` result is *stats*, or None if the file is not in the
+        cache or has changed since its digest was cached.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            row = self._pending.get(path)
+            if row is None:
+                row = self._connection.execute(
+                    "SELECT size, mtime_ns, inode, digest FROM digest WHERE path = ?",
+                    (path,)).fetchone()
+        if row is not None and tuple(row[:3]) == _signature(stats):
+            return row[3]
+        return None
+
+    def set(self, path, stats, digest):
+        """
+        Store the digest of the file at *path*, where *stats* is the result
+        of :func:`os.stat` for the file when the digest was calculated.
+
+        Within :meth:`batch`, the entry is only written at the end of the batch.
+        """
+        with self._lock:
+            self._pending[os.path.abspath(path)] = _signature(stats) + (digest,)
+            if self._batch_depth == 0:
+                self._write_pending()
+
+    @contextmanager
+    def batch(self):
+        """
+        Return a context manager within which new entries are collected, to be
+        written, and the cache trimmed to *max_entries*, in a single
+        transaction on leaving the outermost batch.
+        """
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self._write_pending()
+
+    def _write_pending(self):
+        """Write the pending entries; the caller must hold the lock."""
+        if not self._pending:
+            return
+        now = time.time()
+        rows = [(path,) + row + (now,) for path, row in self._pending.items()]
+        self._pending = {}
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO digest (path, size, mtime_ns, inode, digest, cached) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            n_entries = self._connection.execute("SELECT COUNT(*) FROM digest").fetchone()[0]
+            if n_entries > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM digest WHERE path IN "
+                    "(SELECT path FROM digest ORDER BY cached, rowid LIMIT ?)",
+                    (n_entries - self.max_entries,))
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._pending = {}
+            with self._connection:
+                self._connection.execute("DELETE FROM digest")
+
+
+_caches = {}
+
+
+def get_digest_cache():
+    """
+    Return the digest cache for the project in the current working directory,
+    or None if the working directory does not contain a project.
+    """
+    if not os.path.isdir(os.path.dirname(DIGEST_CACHE_FILE)):
+        return None
+    db_file = os.path.abspath(DIGEST_CACHE_FILE)
+    if db_file not in _caches:
+        try:
+            _caches[db_file] = DigestCache(db_file)
+        except sqlite3.Error:  # e.g. read-only project directory
+            return None
+    return _caches[db_file]
+
+
+@contextmanager
+def batch_updates():
+    """
+    Return a context manager within which updates to the digest cache of the
+    current project, if any, are batched (see :meth:`DigestCache.batch`).
+    """
+    cache = get_digest_cache()
+    if cache is None:
+        yield
+    else:
+        with cache.batch():
+            yield
+
+
+def cached_digest(path, calculate, stats=None, key=None):
+    """
+    Return the digest of the file at *path*, from the digest cache if the file
+    has not changed since its digest was cached, otherwise by calling
+    *calculate()*, whose result is then cached.
+
+    *stats* is the result of :func:`os.stat` for the file, if already known.
+    *key* is the path under which the digest is cached, if different from
+    *path* (e.g. for a member of an archive file).
+    """
+    cache = get_digest_cache()
+    if cache is None:
+        return calculate()
+    if stats is None:
+        stats = os.stat(path)
+    key = key or path
+    digest = cache.get(key, stats)
+    if digest is None:
+        digest = calculate()
+        # don't cache the digest if the file was modified while it was being read
+        if _signature(os.stat(path)) == _signature(stats):
+            cache.set(key, stats, digest)
+    return digest
@@ -8,28 +8,106 @@ Datastore based on files written to and retrieved from a local filesystem.
 from __future__ import unicode_literals
 
 import os
+import sys
+import time
+import shutil
 import datetime
 import mimetypes
-from subprocess import Popen
+from multiprocessing.pool import ThreadPool
+from operator import methodcaller
 import warnings
 from pathlib import Path
 from ..core import component
-from .base import DataStore, DataItem, IGNORE_DIGEST
+from .base import DataStore, DataItem, IGNORE_DIGEST, DIGEST_CHUNK_SIZE, read_chunks
+from .digest_cache import cached_digest, batch_updates
+from . import watchers
+from .watchers import scan_files, IGNORE_DIRS, WATCHERS
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+FICLONE = 0x40049409  # from <linux/fs.h>
+
+
+def _reflink(src, dst, size):
+    """Make *dst* share the data blocks of *src* (Btrfs, XFS, ...)."""
+    fcntl.ioctl(dst, FICLONE, src)
+    return size
+
+
+def _copy_file_range(src, dst, size):
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(src, dst, size - copied)
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def _sendfile(src, dst, size):
+    copied = 0
+    while copied < size:
+        n = os.sendfile(dst, src, copied, size - copied)
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+KERNEL_COPY_METHODS = []
+if sys.platform.startswith("linux"):
+    if fcntl is not None:
+        KERNEL_COPY_METHODS.append(_reflink)
+    if hasattr(os, "copy_file_range"):  # Python >= 3.8
+        KERNEL_COPY_METHODS.append(_copy_file_range)
+    if hasattr(os, "sendfile"):
+        KERNEL_COPY_METHODS.append(_sendfile)
+
+
+def copy_file(source, destination):
+    """
+    Copy the file *source* to *destination*, without passing the data through
+    user space where possible: the copy is made by cloning the file (on
+    filesystems that support reflinks), or with the :func:`os.copy_file_range`
+    or :func:`os.sendfile` system calls. If none of these is available, the
+    data are copied a block at a time.
+    """
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        for method in KERNEL_COPY_METHODS:
+            try:
+                method(src.fileno(), dst.fileno(), size)
+            except OSError:
+                # not supported for this pair of files, e.g. on different
+                # filesystems; start again with the next method
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+            else:
+                return
+        shutil.copyfileobj(src, dst, DIGEST_CHUNK_SIZE)
 
 
 class DataFile(DataItem):
     """A file-like object, that represents a file in a local filesystem."""
     # current implementation just for real files
 
-    def __init__(self, path, store, creation=None):
+    def __init__(self, path, store, creation=None, stats=None):
+        """
+        *stats* may be given if the result of :func:`os.stat` for the file is
+        already known, to avoid having to obtain it again.
+        """
         self.path = path
         self.full_path = os.path.join(store.root, path)
-        if os.path.exists(self.full_path):
-            stats = os.stat(self.full_path)
-            self.size = stats.st_size
-        else:
-            raise IOError("File %s does not exist" % self.full_path)
-            # self.size = None
+        if stats is None:
+            try:
+                stats = os.stat(self.full_path)
+            except OSError:
+                raise IOError("File %s does not exist" % self.full_path)
+        self._stats = stats
+        self.size = stats.st_size
         self.creation = creation or datetime.datetime.fromtimestamp(stats.st_ctime).replace(microsecond=0)
         self.name = os.path.basename(self.full_path)
         self.extension = os.path.splitext(self.full_path)
@@ -45,23 +123,29 @@ class DataFile(DataItem):
         return content
     content = property(fget=get_content)
 
+    def iter_content(self, chunk_size=DIGEST_CHUNK_SIZE):
+        return read_chunks(open(self.full_path, 'rb'), chunk_size)
+
+    def iter_range(self, start, stop=None, chunk_size=DIGEST_CHUNK_SIZE):
+        with open(self.full_path, 'rb') as f:
+            f.seek(start)
+            remaining = None if stop is None else stop - start
+            while remaining is None or remaining > 0:
+                chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
     @property
-    def sorted_content(self):
-        sorted_path = "%s,sorted" % self.full_path
-        if not os.path.exists(sorted_path):
-            cmd = "sort %s > %s" % (self.full_path, sorted_path)
-            job = Popen(cmd, shell=True)
-            job.wait()
-        f = open(sorted_path, 'rb')
-        content = f.read()
-        f.close()
-        if len(content) != self.size:  # sort adds a \n if the file does not end with one
-            assert len(content) == self.size + 1
-            content = content[:-1]
-        return content
+    def digest(self):
+        return cached_digest(self.full_path, lambda: DataItem.digest.fget(self), self._stats)
 
-    # should probably override save_copy() from base class,
-    # as a filesystem copy will be much faster
+    def save_copy(self, path):
+        full_path = self._copy_destination(path)
+        copy_file(self.full_path, full_path)
+        return full_path
 
 
 @component
@@ -69,17 +153,33 @@ class FileSystemDataStore(DataStore):
     """
     Represents a locally-mounted filesystem. The root of the data store will
     generally be a subdirectory of the real filesystem.
+
+    By default, new data files are found by comparing their modification
+    times with the record timestamp. *change_detection* may instead be
+    "manifest" or "inotify" (Linux only), see :mod:`sumatra.datastore.watchers`.
+    If inotify is not available when the data store starts watching (e.g. a
+    project created on Linux is used on another system), new data files are
+    found by comparing modification times, with a warning.
+
+    When looking for new data, the digests of the new files are calculated by
+    up to :attr:`hash_workers` threads in parallel.
     """
     data_item_class = DataFile
+    hash_workers = 4
 
-    def __init__(self, root):
+    def __init__(self, root, change_detection="mtime"):
         self.root = os.path.abspath(root or "./Data")
+        self.change_detection = change_detection
+        self._watcher = None
 
     def __str__(self):
         return self.root
 
     def __getstate__(self):
-        return {'root': self.root}
+        state = {'root': self.root}
+        if self.change_detection != "mtime":  # keep the state of existing stores unchanged
+            state['change_detection'] = self.change_detection
+        return state
 
     def __setstate__(self, state):
         self.__init__(**state)
@@ -97,33 +197,79 @@ class FileSystemDataStore(DataStore):
                 pass  # should perhaps emit warning
     root = property(fget=__get_root, fset=__set_root)
 
-    def _find_new_data_files(self, timestamp, ignoredirs=[".smt", ".hg", ".svn", ".git", ".bzr"]):
-        """Finds newly created/changed files in dataroot."""
+    def __get_change_detection(self):
+        return self._change_detection
+
+    def __set_change_detection(self, mode):
+        if mode not in ("mtime",) + tuple(WATCHERS):
+            raise ValueError("change_detection must be one of 'mtime', %s" %
+                             ", ".join("'%s'" % name for name in WATCHERS))
+        self._change_detection = mode
+    change_detection = property(fget=__get_change_detection, fset=__set_change_detection)
+
+    def start_watching(self):
+        if self.change_detection == "inotify" and not watchers.have_inotify:
+            warnings.warn("inotify is not available on this system, so new data files will be "
+                          "found by comparing modification times.")
+        elif self.change_detection != "mtime":
+            self._watcher = WATCHERS[self.change_detection](self.root)
+            self._watcher.start()
+
+    def _scan_new_data_files(self, timestamp, ignoredirs=IGNORE_DIRS):
+        """
+        Finds newly created/changed files in dataroot. Returns a list of
+        (path, stats) tuples, where path is relative to the root and stats is
+        the result of :func:`os.stat` for the file.
+        """
+        if self._watcher is not None:
+            watcher, self._watcher = self._watcher, None
+            new_files = watcher.stop()
+            if new_files is not None:
+                return new_files
+            warnings.warn("Some file system events were lost, so new data files will be "
+                          "found by comparing modification times.")
         # The timestamp-based approach creates problems when running several
         # experiments at once, since datafiles created by other experiments may
         # be mixed in with this one.
         # For this reason, concurrently running computations should each use
         # their own datastore, each with a different root.
         timestamp = timestamp.replace(microsecond=0)  # Round down to the nearest second
-        # Find and add new data files
-        length_dataroot = len(self.root) + len(os.path.sep)
-        new_files = []
-        for root, dirs, files in os.walk(self.root):
-            for igdir in ignoredirs:
-                if igdir in dirs:
-                    dirs.remove(igdir)
-            for file in files:
-                full_path = os.path.join(root, file)
-                relative_path = os.path.join(root[length_dataroot:], file)
-                last_modified = datetime.datetime.fromtimestamp(os.stat(full_path).st_mtime)
-                if last_modified >= timestamp:
-                    new_files.append(relative_path)
-        return new_files
+        earliest_mtime = time.mktime(timestamp.timetuple())
+        return [(path, stats) for path, stats in scan_files(self.root, ignoredirs)
+                if stats.st_mtime >= earliest_mtime]
+
+    def _find_new_data_files(self, timestamp, ignoredirs=IGNORE_DIRS):
+        """Finds newly created/changed files in dataroot."""
+        return [path for path, stats in self._scan_new_data_files(timestamp, ignoredirs)]
+
+    def _generate_keys(self, data_items):
+        """
+        Generate keys for the given data items, calculating the digests in
+        parallel. The new digests are written to the digest cache together.
+        """
+        generate_key = methodcaller("generate_key")
+        n_workers = min(self.hash_workers, len(data_items))
+        with batch_updates():
+            if n_workers < 2:
+                return [generate_key(item) for item in data_items]
+            # hashlib releases the GIL while hashing, so threads are sufficient
+            pool = ThreadPool(n_workers)
+            try:
+                return pool.map(generate_key, data_items)
+            except:
+                pool.terminate()  # don't wait for the remaining files to be hashed
+                raise
+            finally:
+                pool.close()
+                pool.join()
 
     def find_new_data(self, timestamp):
         """Finds newly created/changed data items"""
-        return [DataFile(path, self).generate_key()
-                for path in self._find_new_data_files(timestamp)]
+        return self._generate_keys([self.data_item_class(path, self, stats=stats)
+                                    for path, stats in self._scan_new_data_files(timestamp)])
+
+    def generate_keys(self, *paths):
+        return self._generate_keys([self.data_item_class(path, self) for path in paths])
 
     def get_data_item(self, key):
         """
@@ -0,0 +1,87 @@
+"""
+Provides an index of the positions of lines within a text data item, so that
+a range of lines (e.g. one page of a preview in the web interface) can be read
+without reading all of the lines before it.
+
+
+:copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+from __future__ import unicode_literals
+from builtins import object
+
+import re
+import threading
+from collections import OrderedDict
+from itertools import islice
+
+NEWLINE = re.compile(b"\n")
+
+
+class LineIndex(object):
+    """
+    Records the byte offset of every *step*-th line of *data_item*.
+
+    Building the index reads the data item once, a block at a time. After
+    that, reading a range of lines only requires reading from the nearest
+    indexed line, i.e. at most *step* - 1 lines more than are needed.
+    """
+
+    def __init__(self, data_item, step=1000):
+        self.data_item = data_item
+        self.step = step
+        self.offsets = [0]  # offsets[i] is the position of line i * step
+        n_lines = 0
+        position = 0
+        last_byte = b""
+        for chunk in data_item.iter_content():
+            if not chunk:
+                continue
+            # the first newline in this chunk which ends an indexed line
+            first = self.step - 1 - n_lines % self.step
+            for match in islice(NEWLINE.finditer(chunk), first, None, self.step):
+                self.offsets.append(position + match.end())
+            n_lines += chunk.count(b"\n")
+            position += len(chunk)
+            last_byte = chunk[-1:]
+        if last_byte not in (b"", b"\n"):  # last line has no terminator
+            n_lines += 1
+        self.n_lines = n_lines
+        self.size = position
+
+    def get_lines(self, first, count=None):
+        """
+        Return a list of up to *count* lines, without their line terminators,
+        starting with line number *first* (counting from zero). If *count* is
+        None, return all lines from *first* to the end.
+        """
+        if first >= self.n_lines or count == 0:
+            return []
+        block = first // self.step
+        lines = self.data_item.iter_lines(start=self.offsets[block])
+        stop = None if count is None else first - block * self.step + count
+        return list(islice(lines, first - block * self.step, stop))
+
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_line_index(data_item, key, max_indexes=16):
+    """
+    Return a :class:`LineIndex` for *data_item*, reusing the index built for
+    a previous request if possible. *key* must identify the content of the
+    data item, e.g. its path and digest. Up to *max_indexes* indexes are kept,
+    and the least recently used are discarded.
+    """
+    with _lock:
+        index = _indexes.pop(key, None)
+    if index is None:
+        index = LineIndex(data_item)
+    else:
+        index.data_item = data_item
+    with _lock:
+        _indexes[key] = index
+        while len(_indexes) > max_indexes:
+            _indexes.popitem(last=False)
+    return index
@@ -5,6 +5,11 @@ available at some URL.
 The datastore itself does not take care of the mirroring, it is up to the
 user to take care of this.
 
+Files that are no longer available locally are downloaded from the mirror.
+Complete files are kept in the local blob cache (see
+:mod:`sumatra.datastore.blob_cache`), while reading just the beginning of a
+file uses an HTTP Range request, if the server supports them.
+
 
 :copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
 :license: BSD 2-clause, see LICENSE for details.
@@ -14,11 +19,14 @@ from future.standard_library import install_aliases
 install_aliases()
 
 import os
+import datetime
 import mimetypes
-from urllib.request import urlopen
+from urllib.request import urlopen, Request
 from ..core import component
-from .base import DataItem
-from .filesystem import FileSystemDataStore
+from .base import DataItem, IGNORE_DIGEST, DIGEST_CHUNK_SIZE, read_chunks
+from .blob_cache import get_blob_cache
+from .digest_cache import cached_digest
+from .filesystem import FileSystemDataStore, copy_file
 
 
 class MirroredDataFile(DataItem):
@@ -27,11 +35,18 @@ class MirroredDataFile(DataItem):
     file system and on a webserver.
     """
 
-    def __init__(self, path, store, creation=None):
+    def __init__(self, path, store, creation=None, stats=None, expected_digest=None):
+        """
+        *expected_digest* is the digest of the file, if known, which allows
+        the downloaded content of the mirrored version to be cached.
+        """
         self.path = path
+        self.expected_digest = expected_digest
         self.full_path = os.path.join(store.root, path)
-        if os.path.exists(self.full_path):
+        if stats is None and os.path.exists(self.full_path):
             stats = os.stat(self.full_path)
+        self._stats = stats
+        if stats is not None:
             self.size = stats.st_size
             self.creation = creation or datetime.datetime.fromtimestamp(stats.st_ctime).replace(microsecond=0)
         else:
@@ -42,12 +57,29 @@ class MirroredDataFile(DataItem):
         self.mimetype, self.encoding = mimetypes.guess_type(self.full_path)
         self.url = store.mirror_base_url + self.path
 
-    def get_content(self, max_length=None):
+    def _open(self):
         if os.path.exists(self.full_path):  # first try to access local version
-            f = open(self.full_path, 'rb')
-        else:  # otherwise try the mirrored version
-            f = urlopen(self.url)
+            return open(self.full_path, 'rb')
+        cache = get_blob_cache()
+        if cache is not None and self.expected_digest:
+            return cache.open_blob(self.expected_digest, lambda: urlopen(self.url),
+                                   digest=self.expected_digest)
+        return urlopen(self.url)  # otherwise try the mirrored version
+
+    def _is_cached(self):
+        cache = get_blob_cache()
+        return (cache is not None and self.expected_digest is not None
+                and cache.get(self.expected_digest) is not None)
+
+    def get_content(self, max_length=None):
+        if max_length and not os.path.exists(self.full_path) and not self._is_cached():
+            # request only the bytes that are needed
+            request = Request(self.url, headers={"Range": "bytes=0-%d" % (max_length - 1)})
+            f = urlopen(request)
+        else:
+            f = self._open()
         if max_length:
+            # if the server does not support Range requests, it sends everything
             content = f.read(max_length)
         else:
             content = f.read()
@@ -55,9 +87,25 @@ class MirroredDataFile(DataItem):
         return content
     content = property(fget=get_content)
 
+    def iter_content(self, chunk_size=DIGEST_CHUNK_SIZE):
+        return read_chunks(self._open(), chunk_size)
+
     @property
-    def sorted_content(self):
-        raise NotImplementedError
+    def digest(self):
+        if self._stats is None:  # the file is only available from the mirror
+            if self._is_cached():
+                # the file was checked against the expected digest when it was downloaded
+                return self.expected_digest
+            # downloaded (and cached, if it is small enough) as it is hashed
+            return DataItem.digest.fget(self)
+        return cached_digest(self.full_path, lambda: DataItem.digest.fget(self), self._stats)
+
+    def save_copy(self, path):
+        if not os.path.exists(self.full_path):  # stream the mirrored version
+            return super(MirroredDataFile, self).save_copy(path)
+        full_path = self._copy_destination(path)
+        copy_file(self.full_path, full_path)
+        return full_path
 
 
 @component
@@ -68,23 +116,54 @@ class MirroredFileSystemDataStore(FileSystemDataStore):
     """
     data_item_class = MirroredDataFile
 
-    def __init__(self, root, mirror_base_url):
+    def __init__(self, root, mirror_base_url, change_detection="mtime"):
         """
         root is the path on the local filesystem within which to search for
           new files
         mirror_base_url is a URL to which the file path should be appended
         """
-        super(MirroredFileSystemDataStore, self).__init__(root)
+        super(MirroredFileSystemDataStore, self).__init__(root, change_detection)
         self.mirror_base_url = mirror_base_url
 
     def __getstate__(self):
-        return {'root': self.root, 'mirror_base_url': self.mirror_base_url}
+        state = super(MirroredFileSystemDataStore, self).__getstate__()
+        state['mirror_base_url'] = self.mirror_base_url
+        return state
 
     def find_new_data(self, timestamp):
         """Finds newly created/changed data items"""
-        new_files = self._find_new_data_files(timestamp)
-        return [MirroredDataFile(path, self).generate_key()
-                for path in new_files]
+        return self._generate_keys([MirroredDataFile(path, self, stats=stats)
+                                    for path, stats in self._scan_new_data_files(timestamp)])
+
+    def get_data_item(self, key):
+        """
+        Return the file that matches the given key.
+        """
+        expected_digest = key.digest if key.digest != IGNORE_DIGEST else None
+        df = self.data_item_class(key.path, self, key.creation, expected_digest=expected_digest)
+        try:
+            digest = df.digest
+        except IOError as err:  # not available from the mirror, or corrupted
+            raise KeyError("Unable to retrieve %s: %s" % (key.path, err))
+        if expected_digest and digest != expected_digest:
+            raise KeyError("Digests do not match.")
+        return df
+
+    def get_content(self, key, max_length=None):
+        """
+        Return the contents of a file identified by a key.
+
+        If `max_length` is given, the return value will be truncated. If the
+        file is only available from the mirror, and has not been cached, only
+        the first `max_length` bytes are downloaded, and the digest of the
+        file is not checked.
+        """
+        if max_length:
+            df = self.data_item_class(key.path, self, key.creation,
+                                      expected_digest=key.digest if key.digest != IGNORE_DIGEST else None)
+            if df._stats is None and not df._is_cached():
+                return df.get_content(max_length)
+        return super(MirroredFileSystemDataStore, self).get_content(key, max_length)
 
     def delete(self, *keys):
         """Delete the files corresponding to the given keys."""
@@ -0,0 +1,249 @@
+"""
+Detection of the files created or modified in a directory tree while a
+computation is running.
+
+By default, :class:`FileSystemDataStore` finds new data by comparing the
+modification time of every file under its root with the record timestamp. The
+watchers defined here are alternatives, selected with the *change_detection*
+argument of the data store:
+
+"manifest"
+    a listing of the size, modification time and inode number of every file
+    is taken just before the computation is launched, and compared with the
+    state of the tree afterwards. Files that were not changed during the run
+    are never reported, even if their modification times are in the future
+    or the clock of a file server is out of step with the local clock.
+"inotify"
+    (Linux only) the Linux inotify interface is used to receive a notification
+    each time a file is written during the run, so that finding the new data
+    costs only as much as the number of changed files, however big the tree.
+    If the kernel event queue overflows, the data store falls back to
+    comparing modification times.
+
+With either mode, a file is attributed to a run only if it was written while
+that run was executing. Computations that run at the same time and share a
+data root should still write to different subdirectories (see the
+``--addlabel`` option of ``smt configure``).
+
+
+:copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+from __future__ import unicode_literals
+from builtins import object
+
+import os
+import sys
+import errno
+import select
+import struct
+import threading
+try:
+    from os import scandir
+except ImportError:  # Python < 3.5
+    from scandir import scandir
+try:
+    from os import fsencode, fsdecode
+except ImportError:  # Python 2
+    def fsencode(filename):
+        if isinstance(filename, bytes):
+            return filename
+        return filename.encode(sys.getfilesystemencoding() or "utf-8")
+
+    def fsdecode(filename):
+        if isinstance(filename, bytes):
+            return filename.decode(sys.getfilesystemencoding() or "utf-8")
+        return filename
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    have_inotify = sys.platform.startswith("linux") and hasattr(_libc, "inotify_init1")
+except (ImportError, OSError):
+    have_inotify = False
+
+IGNORE_DIRS = (".smt", ".hg", ".svn", ".git", ".bzr")
+
+
+def scan_files(root, ignoredirs=IGNORE_DIRS):
+    """
+    Walk the directory tree below *root*, yielding (path, stats) for each
+    file, where path is relative to *root* and stats is the result of
+    :func:`os.stat` for the file. Directories whose names are in
+    *ignoredirs* are skipped and, as with :func:`os.walk`, symbolic links to
+    directories are not followed.
+    """
+    directories = [""]
+    while directories:
+        directory = directories.pop()
+        for entry in scandir(os.path.join(root, directory)):
+            relative_path = os.path.join(directory, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in ignoredirs:
+                    directories.append(relative_path)
+            elif not entry.is_dir():
+                yield relative_path, entry.stat()
+
+
+def _signature(stats):
+    return (stats.st_size, stats.st_mtime, stats.st_ino)
+
+
+class ManifestWatcher(object):
+    """
+    Finds changed files by comparing a listing of the directory tree taken
+    before the run with one taken afterwards.
+    """
+
+    def __init__(self, root, ignoredirs=IGNORE_DIRS):
+        self.root = root
+        self.ignoredirs = ignoredirs
+        self.manifest = None
+
+    def start(self):
+        self.manifest = dict((path, _signature(stats))
+                             for path, stats in scan_files(self.root, self.ignoredirs))
+
+    def stop(self):
+        """
+        Return a list of (path, stats) tuples for the files that have been
+        created or modified since :meth:`start` was called.
+        """
+        manifest, self.manifest = self.manifest, None
+        return [(path, stats) for path, stats in scan_files(self.root, self.ignoredirs)
+                if manifest.get(path) != _signature(stats)]
+
+
+# constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher(object):
+    """
+    Finds changed files by watching every directory in the tree with inotify.
+
+    Events are read by a background thread while the computation runs, so
+    that the kernel event queue does not overflow.
+    """
+
+    def __init__(self, root, ignoredirs=IGNORE_DIRS):
+        if not have_inotify:
+            raise OSError("inotify is not available on this system")
+        self.root = root
+        self.ignoredirs = ignoredirs
+        self._fd = None
+        self._directories = {}  # watch descriptor -> path relative to root
+        self._changed = set()
+        self._overflowed = False
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _add_watch(self, directory):
+        wd = _libc.inotify_add_watch(self._fd, fsencode(os.path.join(self.root, directory)),
+                                     WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:  # fs.inotify.max_user_watches reached
+                self._overflowed = True
+            elif err != errno.ENOENT:  # the directory may already have been removed
+                raise OSError(err, os.strerror(err))
+            return
+        self._directories[wd] = directory
+
+    def _add_tree(self, directory, new=False):
+        """
+        Watch a directory and all its subdirectories. If the directory has
+        been created during the run, any files already in it are new.
+        """
+        directories = [directory]
+        while directories:
+            directory = directories.pop()
+            self._add_watch(directory)
+            try:
+                entries = list(scandir(os.path.join(self.root, directory)))
+            except OSError:
+                continue
+            for entry in entries:
+                relative_path = os.path.join(directory, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in self.ignoredirs:
+                        directories.append(relative_path)
+                elif new:
+                    self._changed.add(relative_path)
+
+    def _read_events(self):
+        try:
+            buffer = os.read(self._fd, 65536)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return False
+            raise
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = fsdecode(buffer[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self._overflowed = True
+            elif mask & IN_IGNORED:
+                self._directories.pop(wd, None)
+            elif wd in self._directories:
+                path = os.path.join(self._directories[wd], name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and name not in self.ignoredirs:
+                        self._add_tree(path, new=True)
+                else:
+                    self._changed.add(path)
+        return True
+
+    def _run(self):
+        while not self._stopping.is_set():
+            readable, _, _ = select.select([self._fd], [], [], 0.1)
+            if readable:
+                self._read_events()
+
+    def start(self):
+        self._fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._add_tree("")
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Return a list of (path, stats) tuples for the files that have been
+        created or modified since :meth:`start` was called, or None if some
+        events were lost.
+        """
+        self._stopping.set()
+        self._thread.join()
+        while self._read_events():
+            pass
+        os.close(self._fd)
+        if self._overflowed:
+            return None
+        new_files = []
+        for path in sorted(self._changed):
+            try:
+                stats = os.stat(os.path.join(self.root, path))
+            except OSError:  # the file was deleted again during the run
+                continue
+            new_files.append((path, stats))
+        return new_files
+
+
+WATCHERS = {"manifest": ManifestWatcher, "inotify": InotifyWatcher}
@@ -6,7 +6,8 @@ For each executable that is supported there is a sub-module containing a
 :func:`find_dependencies()` function, and a series of heuristics for finding
 version information. There is also a sub-module :mod:`core`, which contains
 heuristics that are independent of the language, e.g. where the dependencies are
-under version control.
+under version control, and a sub-module :mod:`cache`, which keeps the results
+between runs.
 
 
 :copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
@@ -18,9 +19,25 @@ from __future__ import unicode_literals
 import warnings
 
 from sumatra.dependency_finder import neuron, python, genesis, matlab, r
+from sumatra.dependency_finder.cache import get_dependency_cache
 
 
-def find_dependencies(filename, executable):
+def _get_finder(executable):
+    """Return the sub-module which finds dependencies for *executable*, if any."""
+    if "matlab" in executable.name.lower():
+        return matlab
+    elif "python" in executable.name.lower():
+        return python
+    elif executable.name == "NEURON":
+        return neuron
+    elif executable.name == "GENESIS":
+        return genesis
+    elif executable.name == "R":
+        return r
+    return None
+
+
+def find_dependencies(filename, executable, use_cache=True):
     """
     Return a list of dependencies for a given script and programming language.
 
@@ -29,18 +46,25 @@ def find_dependencies(filename, executable):
     *executable*:
         an instance of :class:`~sumatra.programs.Executable` or one of its
         subclasses.
-
+    *use_cache*:
+        if True, and the working directory contains a Sumatra project, reuse
+        the dependencies found previously for the same script, unless any of
+        the files involved has changed (see :mod:`dependency_finder.cache`).
     """
-    if "matlab" in executable.name.lower():
-        return matlab.find_dependencies(filename, executable)
-    elif "python" in executable.name.lower():
-        return python.find_dependencies(filename, executable)
-    elif executable.name == "NEURON":
-        return neuron.find_dependencies(filename, executable)
-    elif executable.name == "GENESIS":
-        return genesis.find_dependencies(filename, executable)
-    elif executable.name == "R":
-        return r.find_dependencies(filename, executable)
-    else:
+    finder = _get_finder(executable)
+    if finder is None:
         warnings.warn("find_dependencies() not yet implemented for %s" % executable.name)
         return []
+    cache = get_dependency_cache() if use_cache else None
+    if cache is not None:
+        dependencies = cache.get(filename, executable)
+        if dependencies is not None:
+            return dependencies
+    unresolved = []
+    if finder is python:  # only the Python finder reports imports it could not find
+        dependencies = finder.find_dependencies(filename, executable, unresolved=unresolved)
+    else:
+        dependencies = finder.find_dependencies(filename, executable)
+    if cache is not None:
+        cache.put(filename, executable, dependencies, unresolved)
+    return dependencies
@@ -0,0 +1,247 @@
+"""
+Provides a persistent cache of the dependencies found for a script, so that
+the (often slow) search for dependencies, which for Python involves running
+:class:`modulefinder.ModuleFinder` over the whole import graph in a
+subprocess, need not be repeated each time the same script is run.
+
+An entry in the cache is keyed by the SHA-1 digest of the script, and by the
+path and version of the executable which runs it. The entry also records a
+fingerprint of each file the result depends on: the files and directories of
+the dependencies found, and, for Python, the other modules in the script's
+directory, which it may import. The entry is only used if none of these has
+changed; otherwise the dependencies are found afresh. For Python, the entry
+also records any imported modules which could not be found; if one of these
+has since been installed, the dependencies are also found afresh.
+
+The versions of dependencies which are under version control may change
+without any change to their files (e.g. after a commit), so these are always
+looked up again, even when the dependencies themselves come from the cache.
+
+Each entry is stored as a separate JSON file, named after its key, in the
+.smt directory of the current project; if there is no .smt directory in the
+working directory, dependencies are not cached. When there are more than
+*max_entries* entries, the least recently used are removed.
+
+
+:copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+from __future__ import unicode_literals
+from builtins import object
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from contextlib import closing
+from sumatra import versioncontrol
+
+DEPENDENCY_CACHE_DIR = os.path.join(".smt", "cache", "dependencies")
+#: default maximum number of cached results
+DEPENDENCY_CACHE_ENTRIES = 100
+#: directories and files which are ignored when fingerprinting a directory,
+#: as they change without any change to the code
+IGNORE_DIRS = ("__pycache__", ".git", ".hg", ".svn", ".bzr")
+IGNORE_EXTENSIONS = (".pyc", ".pyo")
+
+
+def file_digest(path):
+    """Return the SHA-1 digest of the content of a file."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def fingerprint(path):
+    """
+    Return a string which changes whenever the file at *path* changes, or
+    None if there is no such file.
+
+    For files this is the digest of their content. For directories, such as
+    Python packages, hashing every file they contain would take about as long
+    as finding the dependencies again, so the digest of a listing of the paths,
+    sizes and modification times of all the files in the directory and its
+    subdirectories (apart from compiled Python files and version control
+    metadata) is used.
+    """
+    try:
+        if not os.path.isdir(path):
+            return file_digest(path)
+        listing = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = [name for name in dirnames if name not in IGNORE_DIRS]
+            for name in filenames:
+                if os.path.splitext(name)[1] in IGNORE_EXTENSIONS:
+                    continue
+                file_path = os.path.join(dirpath, name)
+                stats = os.stat(file_path)
+                listing.append("%s %d %r" % (os.path.relpath(file_path, path),
+                                             stats.st_size, stats.st_mtime))
+    except (IOError, OSError):
+        return None
+    return hashlib.sha1("\n".join(sorted(listing)).encode('utf-8')).hexdigest()
+
+
+def watched_files(filename, executable, dependencies):
+    """
+    Return the paths of the files and directories which, if changed, could
+    change the dependencies found for *filename*.
+    """
+    paths = set(os.path.abspath(dep.path) for dep in dependencies if dep.path)
+    if "python" in executable.name.lower():
+        # local modules are not themselves dependencies, but may import some
+        directory = os.path.dirname(os.path.abspath(filename))
+        paths.update(os.path.join(directory, name) for name in os.listdir(directory)
+                     if name.endswith(".py"))
+    elif "matlab" in executable.name.lower():
+        paths.add(os.path.abspath("depfun.data"))
+    return paths
+
+
+def refresh_versions_from_versioncontrol(dependencies):
+    """
+    Update the versions of those dependencies which are under version control,
+    as :func:`core.find_versions_from_versioncontrol` would for newly-found
+    dependencies.
+    """
+    for dependency in dependencies:
+        if dependency.path is None:
+            continue
+        try:
+            wc = versioncontrol.get_working_copy(dependency.path)
+        except versioncontrol.VersionControlError:
+            continue  # the cached version is still valid
+        dependency.diff = wc.diff() if wc.has_changed() else ''
+        dependency.version = wc.current_version()
+        dependency.source = wc.repository.url
+    return dependencies
+
+
+class DependencyCache(object):
+    """
+    A directory of the dependencies previously found for scripts, holding at
+    most *max_entries* results.
+
+    The cache may be shared between threads, and between processes.
+    """
+
+    def __init__(self, directory=DEPENDENCY_CACHE_DIR, max_entries=DEPENDENCY_CACHE_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, filename, executable):
+        """Return the key of the cache entry for *filename* run with *executable*."""
+        identity = [executable.name, executable.path, getattr(executable, "version", None),
+                    os.path.abspath(filename), file_digest(filename)]
+        return hashlib.sha1(json.dumps(identity).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, filename, executable):
+        """
+        Return the cached dependencies of *filename*, or None if they are not
+        in the cache, any of the files they were found from has changed, or
+        any of the modules which could not be found can now be imported.
+        """
+        from sumatra import dependency_finder
+        try:
+            path = self._path(self.key(filename, executable))
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path, None)  # the modification time records the last use
+        except (IOError, OSError, ValueError):
+            return None
+        for watched_path, watched_fingerprint in entry["files"].items():
+            if fingerprint(watched_path) != watched_fingerprint:
+                return None
+        unresolved = entry.get("unresolved")
+        if unresolved and dependency_finder.python.find_importable(unresolved, executable):
+            return None
+        dependencies = []
+        for state in entry["dependencies"]:
+            cls = getattr(dependency_finder, state.pop("module")).Dependency
+            dependency = cls.__new__(cls)
+            dependency.__setstate__(state)
+            dependencies.append(dependency)
+        return refresh_versions_from_versioncontrol(dependencies)
+
+    def put(self, filename, executable, dependencies, unresolved=()):
+        """
+        Add the dependencies found for *filename* to the cache. *unresolved*
+        contains the names of any imported modules which could not be found.
+        """
+        entry = {
+            "files": dict((path, fingerprint(path))
+                          for path in watched_files(filename, executable, dependencies)),
+            "dependencies": [dict(dep.__getstate__(), module=dep.module) for dep in dependencies],
+            "unresolved": sorted(unresolved),
+        }
+        try:
+            path = self._path(self.key(filename, executable))
+        except (IOError, OSError):
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".entry-")
+        try:
+            with closing(os.fdopen(fd, 'w')) as f:
+                json.dump(entry, f)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def _entries(self):
+        """Return a list of (last use, path) for each cache entry."""
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.startswith(".entry-"):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:  # evicted by another process
+                continue
+        return entries
+
+    def evict(self):
+        """Remove the least recently used entries beyond the size of the cache."""
+        with self._lock:
+            entries = sorted(self._entries())
+            for last_use, path in entries[:max(len(entries) - self.max_entries, 0)]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._lock:
+            for last_use, path in self._entries():
+                os.remove(path)
+
+
+_caches = {}
+
+
+def get_dependency_cache():
+    """
+    Return the dependency cache for the project in the current working
+    directory, or None if the working directory does not contain a project.
+    """
+    if not os.path.isdir(os.path.dirname(os.path.dirname(DEPENDENCY_CACHE_DIR))):
+        return None
+    directory = os.path.abspath(DEPENDENCY_CACHE_DIR)
+    if directory not in _caches:
+        try:
+            _caches[directory] = DependencyCache(directory)
+        except OSError:  # e.g. read-only project directory
+            return None
+    return _caches[directory]
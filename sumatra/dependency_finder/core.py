@@ -104,6 +104,10 @@ class BaseDependency(object):
 
     """
 
+    # subclasses should also define __slots__, so that records with many
+    # dependencies are kept small
+    __slots__ = ("name", "path", "diff", "version", "source", "__weakref__")
+
     def __init__(self, name, path=None, version='unknown', diff='', source=None):
         self.name = name
         self.path = path
@@ -111,6 +115,14 @@ class BaseDependency(object):
         self.version = version
         self.source = source  # e.g. url of (upstream?) repository
 
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in BaseDependency.__slots__[:-1])
+
+    def __setstate__(self, state):
+        # also accepts the __dict__ of objects pickled by earlier versions
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def __repr__(self):
         return "%s (%s) version=%s%s" % (self.name, self.path, self.version, self.diff and "*" or '')
 
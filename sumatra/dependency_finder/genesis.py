@@ -41,6 +41,7 @@ class Dependency(core.BaseDependency):
     Contains information about a .g file, and tries to determine version information.
     """
     module = 'genesis'
+    __slots__ = ()
 
     def __init__(self, name, path=None, version='unknown', diff='', source=None):
         # name maybe should be path relative to main file?
@@ -17,6 +17,7 @@ class Dependency(core.BaseDependency):
     Contains information about a Matlab toolbox.
     """
     module = 'matlab'
+    __slots__ = ()
     
     def __init__(self, module_name, path, version='unknown', diff='', source=None):
         super(Dependency, self).__init__(module_name, path, version, diff, source)
@@ -40,6 +40,7 @@ class Dependency(core.BaseDependency):
     Contains information about a Hoc file, and tries to determine version information.
     """
     module = 'neuron'
+    __slots__ = ()
 
     def __init__(self, name, path=None, version='unknown', diff='', source=None):
         super(Dependency, self).__init__(os.path.basename(name),
@@ -167,6 +167,7 @@ class Dependency(core.BaseDependency):
     determine version information.
     """
     module = 'python'
+    __slots__ = ()
 
     def __init__(self, module_name, path, version='unknown', diff='', source=None):
         super(Dependency, self).__init__(module_name, path, version, diff, source)
@@ -180,20 +181,38 @@ class Dependency(core.BaseDependency):
         return cls(module.__name__, module.__path__[0])
 
 
-def find_imported_packages(filename, executable_path, debug=0, exclude_stdlib=True):
+# defines find_spec(), which returns None for a top-level module that cannot be found
+def_find_spec = """
+try:
+    from importlib.util import find_spec
+except ImportError:  # Python 2
+    import imp
+
+    def find_spec(name):
+        try:
+            return imp.find_module(name)
+        except ImportError:
+            return None
+"""
+
+
+def find_imported_packages(filename, executable_path, debug=0, exclude_stdlib=True, unresolved=None):
     """
     Find all imported top-level packages for a given Python file.
 
+    If *unresolved* is a list, the names of any imported top-level modules
+    which could not be found are appended to it.
+
     We cannot assume that the version of Python being used to run Sumatra is the
     same as that used to run the simulation/analysis. Therefore we need to run
     all the dependency finding and version checking in a subprocess with the
     correct version of Python.
     """
     # Actually, we could check whether executable_path matches sys.executable, and
-    # then do it in this process. On the other hand, the dependency finding
-    # could run in parallel with the simulation (good for multicore): we could
-    # move setting of dependencies to after the simulation, rather than having it
-    # in record.register()
+    # then do it in this process. On the other hand, when launched by
+    # Project.launch() the dependency finding runs in parallel with the
+    # simulation (see records.BackgroundRegistration), and a subprocess keeps
+    # it from competing with the simulation for the GIL of this process.
     script = """
         from modulefinder import ModuleFinder
         import sys, os
@@ -210,18 +229,52 @@ def find_imported_packages(filename, executable_path, debug=0, exclude_stdlib=Tr
             if module.__path__ and "." not in name:
                 if not(exclude_stdlib and os.path.dirname(module.__path__[0]) in stdlib_paths):
                     top_level_packages[name] = module
-        sys.stdout.write("%s" + str(top_level_packages))""" % (exclude_stdlib, int(debug), filename, SENTINEL)
-    return run_script(executable_path, script)
+        %s
+        # modulefinder does not find e.g. frozen modules, which can nevertheless be imported
+        missing = sorted(name for name in set(name.split(".")[0] for name in finder.badmodules)
+                         if name not in finder.modules and find_spec(name) is None)
+        sys.stdout.write("%s" + str((top_level_packages, missing)))""" % (
+            exclude_stdlib, int(debug), filename,
+            def_find_spec.replace("\n", "\n        "), SENTINEL)
+    result = run_script(executable_path, script)
+    if not isinstance(result, tuple):  # the script failed
+        return result
+    top_level_packages, missing = result
+    if unresolved is not None:
+        unresolved.extend(missing)
+    return top_level_packages
+
+
+find_importable_template = """
+import sys
+%(def_find_spec)s
+names = %(names)s
+sys.stdout.write("%(sentinel)s" + str([name for name in names if find_spec(name) is not None]))
+"""
+
+
+def find_importable(names, executable):
+    """
+    Return those of the given top-level module names which can now be
+    imported by *executable*.
+    """
+    script = find_importable_template % {'def_find_spec': def_find_spec,
+                                         'names': list(map(str, names)), 'sentinel': SENTINEL}
+    return run_script(executable.path, script) or []
 
 
-def find_dependencies(filename, executable):
+def find_dependencies(filename, executable, unresolved=None):
     """Return a list of Dependency objects representing all the top-level
-       modules or packages imported (directly or indirectly) by a given Python file."""
+       modules or packages imported (directly or indirectly) by a given Python file.
+
+       If *unresolved* is a list, the names of any imported top-level modules
+       which could not be found are appended to it."""
     heuristics = [core.find_versions_from_versioncontrol,
                   lambda deps: find_versions_by_attribute(deps, executable),
                   find_versions_from_egg]
     logger.debug("Finding imported packages")
-    packages = find_imported_packages(filename, executable.path, exclude_stdlib=True)
+    packages = find_imported_packages(filename, executable.path, exclude_stdlib=True,
+                                      unresolved=unresolved)
     dependencies = [Dependency.from_module(module, executable.path) for module in packages.values()]
     logger.debug("Finding versions of dependencies")
     return core.find_versions(dependencies, heuristics)
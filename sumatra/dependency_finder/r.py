@@ -22,6 +22,7 @@ class Dependency(core.BaseDependency):
     R dependency information.
     """
     module = 'r'
+    __slots__ = ()
 
     def __init__(self, module_name, path=None, version='unknown', diff='', source=None):
         super(Dependency, self).__init__(module_name, path, version, diff, source)
@@ -30,10 +30,22 @@ class PlatformInformation(object):
     A simple container for information about the machine and environment the
     computations are being performed on/in.
     """
+    # "clock" is only reported by the processes of a distributed computation
+    __slots__ = ("architecture_bits", "architecture_linkage", "machine", "network_name",
+                 "ip_addr", "processor", "release", "system_name", "version", "clock",
+                 "__weakref__")
 
     def __init__(self, **kwargs):
         for k, v in kwargs.items():
             setattr(self, k, v)
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__[:-1]
+                    if hasattr(self, name))
+
+    def __setstate__(self, state):
+        # also accepts the __dict__ of objects pickled by earlier versions
+        self.__init__(**state)
     #platform.mac_ver()
     #platform.win32_ver()
     #platform.dist()
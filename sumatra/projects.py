@@ -180,7 +180,11 @@ class Project(object):
     def new_record(self, parameters={}, input_data=[], script_args="",
                    executable='default', repository='default',
                    main_file='default', version='current', launch_mode='default',
-                   label=None, reason=None, timestamp_format='default'):
+                   label=None, reason=None, timestamp_format='default', register=True):
+        """
+        Create a new record. Unless *register* is False, information about the
+        code and the environment is recorded straight away.
+        """
         logger.debug("Creating new record")
         if executable == 'default':
             executable = deepcopy(self.default_executable)
@@ -202,7 +206,7 @@ class Project(object):
                         on_changed=self.on_changed,
                         input_datastore=self.input_datastore,
                         timestamp_format=timestamp_format)
-        if not isinstance(executable, programs.MatlabExecutable):
+        if register and not isinstance(executable, programs.MatlabExecutable):
             record.register(working_copy)
         return record
 
@@ -210,12 +214,23 @@ class Project(object):
                executable='default', repository='default', main_file='default',
                version='current', launch_mode='default', label=None, reason=None,
                timestamp_format='default', repeats=None):
-        """Launch a new simulation or analysis."""
+        """
+        Launch a new simulation or analysis.
+
+        The dependencies of the code, and information about the platform, are
+        captured while the computation runs, rather than before it is launched.
+        """
         record = self.new_record(parameters, input_data, script_args,
                                  executable, repository, main_file, version,
-                                 launch_mode, label, reason, timestamp_format)
+                                 launch_mode, label, reason, timestamp_format,
+                                 register=False)
+        registration = None
+        if not isinstance(record.executable, programs.MatlabExecutable):
+            registration = record.start_registration(record.repository.get_working_copy())
         record.run(with_label=self.data_label)
-        if 'matlab' in record.executable.name.lower():
+        if registration is not None:
+            registration.finish()
+        else:
             record.register(record.repository.get_working_copy())
         if repeats:
             record.repeats = repeats
@@ -255,13 +270,16 @@ class Project(object):
         success = False
         cnt = 0
         max_tries = 200
-        sleep_seconds = 5
+        max_sleep_seconds = 5
         while not success and cnt < max_tries:
             try:
                 self.record_store.save(self.name, record)
                 success = True
                 self._most_recent = record.label
             except (django.db.utils.DatabaseError, sqlite3.OperationalError):
+                # the database is usually locked only briefly, while another
+                # record is saved, so start by retrying quickly
+                sleep_seconds = min(0.1 * 2 ** cnt, max_sleep_seconds)
                 print("Failed to save record due to database error. Trying again in {0} seconds. (Attempt {1}/{2})".format(sleep_seconds, cnt, max_tries))
                 time.sleep(sleep_seconds)
                 cnt += 1
@@ -290,16 +308,23 @@ class Project(object):
         self._most_recent = self.record_store.most_recent(self.name)
         return n
 
-    def find_records(self, tags=None, reverse=False):
-        records = self.record_store.list(self.name, tags)
-        if reverse:
-            records.reverse()
-        return records
+    def find_records(self, tags=None, reverse=False, any_tags=False, **filters):
+        """
+        Return the records tagged with all of the given tags (or, if
+        *any_tags* is True, with any of them) that match the given filters
+        (see :meth:`RecordStore.query`), newest first unless *reverse* is True.
+        """
+        order_by = reverse and "timestamp" or "-timestamp"
+        if tags and not any_tags:
+            filters["all_tags"] = tags
+            tags = None
+        return self.record_store.query(self.name, order_by=order_by, tags=tags, **filters)
 
     # def find_data() here?
 
-    def format_records(self, format='text', mode='short', tags=None, reverse=False):
-        records = self.find_records(tags=tags, reverse=reverse)
+    def format_records(self, format='text', mode='short', tags=None, reverse=False,
+                       any_tags=False, **filters):
+        records = self.find_records(tags=tags, reverse=reverse, any_tags=any_tags, **filters)
         formatter = get_formatter(format)(records, project=self, tags=tags)
         return formatter.format(mode)
 
@@ -331,23 +356,33 @@ class Project(object):
         record.tags.remove(tag)
         self.record_store.save(self.name, record)
 
-    def compare(self, label1, label2, ignore_mimetypes=[], ignore_filenames=[]):
+    def compare(self, label1, label2, ignore_mimetypes=[], ignore_filenames=[],
+                ignore_line_order=False):
         record1 = self.record_store.get(self.name, label1)
         record2 = self.record_store.get(self.name, label2)
-        return record1.difference(record2, ignore_mimetypes, ignore_filenames)
+        return record1.difference(record2, ignore_mimetypes, ignore_filenames, ignore_line_order)
 
-    def show_diff(self, label1, label2, mode='short', ignore_mimetypes=[], ignore_filenames=[]):
-        diff = self.compare(label1, label2, ignore_mimetypes, ignore_filenames)
+    def show_diff(self, label1, label2, mode='short', ignore_mimetypes=[], ignore_filenames=[],
+                  ignore_line_order=False):
+        diff = self.compare(label1, label2, ignore_mimetypes, ignore_filenames, ignore_line_order)
         formatter = get_diff_formatter()(diff)
         return formatter.format(mode)
 
-    def export(self):
+    def export(self, format="json"):
         # copy the project data
         shutil.copy(".smt/project", ".smt/project_export.json")
         # export the record data
-        f = open(".smt/records_export.json", 'w')
-        f.write(self.record_store.export(self.name))
-        f.close()
+        if format == "binary":
+            with open(".smt/records_export.smtb", 'wb') as f:
+                self.record_store.export_to_file(self.name, f, format=format)
+            stale_export = ".smt/records_export.json"
+        else:
+            with open(".smt/records_export.json", 'w') as f:
+                self.record_store.export_to_file(self.name, f)
+            stale_export = ".smt/records_export.smtb"
+        # an earlier export in the other format must not be used by upgrade
+        if os.path.exists(stale_export):
+            os.remove(stale_export)
 
     def repeat(self, original_label, new_label=None):
         if original_label == 'last':
@@ -9,6 +9,8 @@ Record - gathers and stores information about an individual simulation or
          analysis run.
          Can be instantiated directly, but more usually created by the
          new_record() method of Project.
+BackgroundRegistration - captures the environment of a record in a background
+         thread, while the computation runs.
 
 
 :copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
@@ -21,6 +23,8 @@ from builtins import object
 from datetime import datetime
 import time
 import os
+import warnings
+from multiprocessing.pool import ThreadPool
 from os.path import join, basename, exists
 import re
 from operator import or_
@@ -44,6 +48,10 @@ class MissingInformationError(Exception):
     pass
 
 
+class ModifiedDuringRunError(Exception):
+    pass
+
+
 def check_file_under_version_control(file_path, working_copy):
     file_relative_to_wc = Path(file_path).resolve().relative_to(Path(working_copy.path).resolve())
     if not working_copy.contains(file_relative_to_wc.as_posix()):
@@ -57,6 +65,12 @@ class Record(object):
     retrieval.
     """
     valid_name_pattern = r'(?P<label>\w+[\w|\-\.:/\s]*)'
+    # a project may have many thousands of records, so they are kept small
+    __slots__ = ("timestamp", "label", "reason", "duration", "executable", "repository",
+                 "main_file", "version", "parameters", "input_data", "script_arguments",
+                 "launch_mode", "datastore", "input_datastore", "outcome", "output_data",
+                 "tags", "diff", "user", "on_changed", "stdout_stderr", "repeats",
+                 "dependencies", "platforms", "parameter_file")
 
     def __init__(self, executable, repository, main_file, version, launch_mode,
                  datastore, parameters={}, input_data=[], script_arguments='',
@@ -94,6 +108,15 @@ class Record(object):
 
     def register(self, working_copy):
         """Record information about the environment."""
+        self.check_code(working_copy)
+        self.capture_environment(working_copy)
+
+    def check_code(self, working_copy):
+        """
+        Check that the code to be run is that of the working copy. This is the
+        part of :meth:`register` which must be done before the computation is
+        launched.
+        """
         # Check the code hasn't changed and the version is correct
         logger.debug("Checking code")
         if len(self.diff) == 0:
@@ -102,26 +125,47 @@ class Record(object):
         # Check the main file is in the working copy
         #if self.main_file:
         #    check_file_under_version_control(self.main_file, working_copy)
+        if self.main_file is None and self.executable.requires_script:
+            raise MissingInformationError("main script file not specified")
+
+    def capture_environment(self, working_copy):
+        """
+        Record the dependencies of the code, and information about the
+        platform and the user. This is the (slow) part of :meth:`register`
+        which may be done while the computation runs
+        (see :meth:`start_registration`).
+        """
         # Record dependencies
         logger.debug("Recording dependencies")
-        self.dependencies = []
-        if self.main_file is None:
-            if self.executable.requires_script:
-                raise MissingInformationError("main script file not specified")
-        else:
+        dependencies = []
+        if self.main_file is not None:
             if len(self.main_file.split()) == 1: # this assumes filenames cannot contain spaces
-                self.dependencies = dependency_finder.find_dependencies(self.main_file, self.executable)
+                dependencies = dependency_finder.find_dependencies(self.main_file, self.executable)
             else: # if self.main_file contains multiple file names
                 # this seems a bit hacky. Should perhaps store a list self.main_files, _and_ check that all files exist.
                 for main_file in self.main_file.split():
-                    self.dependencies.extend(dependency_finder.find_dependencies(main_file, self.executable))
+                    dependencies.extend(dependency_finder.find_dependencies(main_file, self.executable))
             # if self.on_changed is 'error', should check that all the dependencies have empty diffs and raise an UncommittedChangesError otherwise
+        self.dependencies = dependencies
         # Record platform information
         logger.debug("Recording platform information")
         self.platforms = self.launch_mode.get_platform_information()
         # Record information about the current user
         self.user = get_user(working_copy)
 
+    def start_registration(self, working_copy):
+        """
+        Check the code, then start capturing the rest of the information about
+        the environment in a background thread, so that the computation can
+        be launched straight away. Returns a :class:`BackgroundRegistration`,
+        whose :meth:`~BackgroundRegistration.finish` method must be called
+        once the computation has finished.
+        """
+        self.check_code(working_copy)
+        registration = BackgroundRegistration(self, working_copy)
+        registration.start()
+        return registration
+
     def run(self, with_label=False):
         """
         Launch the simulation or analysis.
@@ -153,6 +197,7 @@ class Record(object):
             self.parameter_file = self.executable.write_parameters(self.parameters, parameter_file_basename)
             script_arguments = script_arguments.replace("<parameters>", self.parameter_file)
         # Run simulation/analysis
+        self.datastore.start_watching()
         start_time = time.time()
         result = self.launch_mode.run(self.executable, self.main_file,
                                       script_arguments, data_label)
@@ -182,6 +227,30 @@ class Record(object):
     def __repr__(self):
         return "Record #%s" % self.label
 
+    def _attributes(self):
+        """
+        Return a dict containing the attributes of the record which have been
+        set. Unlike :func:`getattr`, this does not retrieve the lazy
+        attributes of a :class:`LazyRecord`.
+        """
+        attributes = {}
+        for name in Record.__slots__:
+            try:
+                attributes[name] = getattr(Record, name).__get__(self, Record)
+            except AttributeError:
+                pass
+        return attributes
+
+    def __getstate__(self):
+        return self._attributes()
+
+    def __setstate__(self, state):
+        # also accepts the __dict__ of records pickled by earlier versions,
+        # ignoring any attributes which are no longer used
+        for name, value in state.items():
+            if name in Record.__slots__:
+                setattr(self, name, value)
+
     def describe(self, format='text', mode='long'):
         """
         Return a description of the record.
@@ -200,14 +269,16 @@ class Record(object):
     def __eq__(self, other):
         return not self.__ne__(other)
 
-    def difference(self, other_record, ignore_mimetypes=[], ignore_filenames=[]):
+    def difference(self, other_record, ignore_mimetypes=[], ignore_filenames=[],
+                   ignore_line_order=False):
         """
         Determine the difference between this computational experiment and
         another (code, platform, results, etc.).
 
         Return a RecordDifference object.
         """
-        return RecordDifference(self, other_record, ignore_mimetypes, ignore_filenames)
+        return RecordDifference(self, other_record, ignore_mimetypes, ignore_filenames,
+                                ignore_line_order)
 
     def delete_data(self):
         """
@@ -225,17 +296,175 @@ class Record(object):
         return self.launch_mode.generate_command(self.executable, self.main_file, self.script_arguments)
 
 
+#: The record attributes which may be large, or which may need further
+#: queries to retrieve from a record store, and so are only retrieved by a
+#: :class:`LazyRecord` when first needed.
+LAZY_ATTRIBUTES = ("parameters", "input_data", "output_data", "stdout_stderr", "diff",
+                   "dependencies", "platforms")
+
+
+def _modified_since(path, start_time):
+    """
+    Has the file at *path*, or any file directly within the directory at
+    *path*, been modified since *start_time*? Compiled Python files, which
+    running the code may create, are ignored.
+    """
+    if os.path.isdir(path):
+        paths = [join(path, name) for name in os.listdir(path)
+                 if not name.endswith((".pyc", ".pyo"))]
+    else:
+        paths = [path]
+    for path in paths:
+        try:
+            if os.path.isfile(path) and os.path.getmtime(path) > start_time:
+                return True
+        except OSError:  # deleted in the meantime
+            continue
+    return False
+
+
+class BackgroundRegistration(object):
+    """
+    Captures information about the environment of a record (see
+    :meth:`Record.capture_environment`) in a background thread, while the
+    computation runs.
+
+    Since the dependencies are found while the computation is running, the
+    files of the main script or of a dependency could be modified after the
+    computation was launched but before they were examined, in which case the
+    information recorded may not correspond to the code that actually ran.
+    :meth:`finish` checks for this, and either warns about such files
+    (`on_modified="warn"`, the default) or raises a
+    :class:`ModifiedDuringRunError` (`on_modified="error"`).
+
+    If the information cannot be captured, e.g. because the dependency finder
+    fails, the computation has nonetheless been run, so :meth:`finish` only
+    warns, and the record keeps whatever information was captured.
+    """
+
+    def __init__(self, record, working_copy):
+        self.record = record
+        self.working_copy = working_copy
+        self.start_time = None
+        self._pool = None
+        self._result = None
+
+    def start(self):
+        self.start_time = time.time()
+        self._pool = ThreadPool(1)
+        self._result = self._pool.apply_async(self.record.capture_environment,
+                                              (self.working_copy,))
+
+    def modified_files(self):
+        """
+        Return the paths of the main file(s) and dependencies which have been
+        modified since the registration was started.
+        """
+        paths = (self.record.main_file or "").split()
+        paths.extend(dep.path for dep in self.record.dependencies if dep.path)
+        return [path for path in paths if _modified_since(path, self.start_time)]
+
+    def finish(self, on_modified="warn"):
+        """
+        Wait for the information about the environment to be captured, and
+        check that none of the files examined were modified during the run.
+        Any exception raised while capturing the information is turned into
+        a warning.
+        """
+        if on_modified not in ("warn", "error"):
+            raise ValueError("on_modified must be either 'warn' or 'error'")
+        try:
+            self._result.get()
+        except Exception as err:
+            warnings.warn("Information about the environment of record %s could not be captured "
+                          "(%s: %s)" % (self.record.label, err.__class__.__name__, err))
+            for name in ("dependencies", "platforms"):
+                if not hasattr(self.record, name):
+                    setattr(self.record, name, [])
+        finally:
+            self._pool.close()
+            self._pool.join()
+        modified = self.modified_files()
+        if modified:
+            msg = ("The following files were modified while the computation was running, so the "
+                   "information recorded about them may not match the code that was run: %s"
+                   % ", ".join(modified))
+            if on_modified == "error":
+                raise ModifiedDuringRunError(msg)
+            warnings.warn(msg)
+
+
+class LazyRecord(Record):
+    """
+    A record retrieved from a record store, whose attributes named in
+    :data:`LAZY_ATTRIBUTES` are only retrieved when one of them is first
+    accessed. Record stores return lazy records when listing records, since
+    displaying a list of records usually needs only a few attributes of each.
+
+    *record* is a :class:`Record` holding the other attributes; any lazy
+    attributes it has are ignored. *load* is a function which returns a dict
+    containing the values of the lazy attributes.
+
+    Apart from when its attributes are retrieved, a lazy record behaves
+    exactly like a :class:`Record`. When pickled or copied, all of its
+    attributes are retrieved first.
+    """
+
+    __slots__ = ("_load",)
+
+    def __init__(self, record, load):
+        for name, value in record._attributes().items():
+            if name not in LAZY_ATTRIBUTES:
+                setattr(self, name, value)
+        self._load = load
+
+    def __getattr__(self, name):
+        # only called if the attribute has not been retrieved yet
+        if name in LAZY_ATTRIBUTES and self._load is not None:
+            self._retrieve()
+            attributes = self._attributes()
+            if name in attributes:
+                return attributes[name]
+        raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+
+    def _retrieve(self):
+        load, self._load = self._load, None
+        attributes = self._attributes()
+        for name, value in load().items():
+            # attributes may have been set since the record was retrieved
+            if name in LAZY_ATTRIBUTES and name not in attributes:
+                setattr(self, name, value)
+
+    def __getstate__(self):
+        if self._load is not None:
+            self._retrieve()
+        return self._attributes()
+
+    def __setstate__(self, state):
+        self._load = None
+        Record.__setstate__(self, state)
+
+
 class RecordDifference(object):
-    """Represents the difference between two Record objects."""
+    """
+    Represents the difference between two Record objects.
+
+    Data files are compared by their digests. If *ignore_line_order* is True,
+    files with different digests are compared line by line, and are treated
+    as identical if they contain the same lines in a different order (e.g.
+    output written by parallel processes).
+    """
 
     ignore_mimetypes = [] #r'image/\w+', r'video/\w+']
     ignore_filenames = [r'\.log', r'^log']
 
     def __init__(self, recordA, recordB,
                  ignore_mimetypes=[],
-                 ignore_filenames=[]):
+                 ignore_filenames=[],
+                 ignore_line_order=False):
         self.recordA = recordA
         self.recordB = recordB
+        self.ignore_line_order = ignore_line_order
         assert not isinstance(ignore_mimetypes, str) # catch a
         assert not isinstance(ignore_filenames, str) # common error
         self.ignore_mimetypes += ignore_mimetypes
@@ -334,8 +563,26 @@ class RecordDifference(object):
                         break
                 if not ignore:
                     keys[rec.label][key.digest] = key
+        if self.ignore_line_order:
+            self._match_unordered(keys, direction)
         return keys
 
+    def _match_unordered(self, keys, direction):
+        """
+        Re-key the data keys that have no counterpart with the same digest in
+        the other record by the order-independent digest of their lines.
+        """
+        keysA, keysB = keys[self.recordA.label], keys[self.recordB.label]
+        datastore_attr = direction == 'input_data' and 'input_datastore' or 'datastore'
+        for rec, own, other in ((self.recordA, keysA, keysB), (self.recordB, keysB, keysA)):
+            datastore = getattr(rec, datastore_attr)
+            for digest in [digest for digest in own if digest not in other]:
+                try:
+                    data_item = datastore.get_data_item(own[digest])
+                except (IOError, KeyError):  # the data are no longer available
+                    continue
+                own[data_item.unordered_digest] = own.pop(digest)
+
     def _data_differ(self, direction):
         keys = self._list_datakeys(direction)
         A = set(keys[self.recordA.label].keys())
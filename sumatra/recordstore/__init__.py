@@ -7,6 +7,7 @@ Sub-packages/modules
 --------------------
 
 shelve_store - provides the ShelveRecordStore class
+sqlite_store - provides the SQLiteRecordStore class
 django_store - provides the DjangoRecordStore class (if Django is installed)
 http_store   - provides the HttpRecordStore class
 
@@ -19,6 +20,7 @@ from __future__ import unicode_literals
 from . import serialization
 from .base import RecordStore
 from .shelve_store import ShelveRecordStore
+from .sqlite_store import SQLiteRecordStore
 try:
     from .django_store import DjangoRecordStore
     have_django = True
@@ -6,13 +6,108 @@ Provides base RecordStore class.
 :license: BSD 2-clause, see LICENSE for details.
 """
 from __future__ import unicode_literals
-from builtins import object
+from builtins import object, str
 
-from sumatra.recordstore import serialization
+import copy
+from itertools import islice
+from sumatra.recordstore import serialization, binary
 from sumatra.formatting import get_formatter
 from ..core import component_type
 
 
+def _chunks(items, size):
+    """Split an iterable into lists of at most `size` items."""
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+#: the keyword arguments accepted by :meth:`RecordStore.query`
+QUERY_FILTERS = ("tags", "all_tags", "since", "until", "outcome", "user", "version",
+                 "main_file", "parameters")
+
+
+def check_filters(filters):
+    """Raise a TypeError if any of the given query filters is not recognised."""
+    unknown = set(filters).difference(QUERY_FILTERS)
+    if unknown:
+        raise TypeError("Unknown query filter(s): %s" % ", ".join(sorted(unknown)))
+
+
+def parse_order_by(order_by):
+    """
+    Split an *order_by* argument such as "-timestamp" into the name of a
+    record attribute and a flag saying whether the order should be reversed.
+    """
+    if order_by.startswith("-"):
+        return order_by[1:], True
+    return order_by, False
+
+
+def matches_tags(record_tags, tags):
+    """Does a record with the given tags match a *tags* query filter?"""
+    if not tags:
+        return True
+    if not isinstance(tags, list):
+        tags = [tags]
+    return bool(set(record_tags).intersection(tags))
+
+
+def matches_all_tags(record_tags, tags):
+    """Does a record with the given tags match an *all_tags* query filter?"""
+    if not tags:
+        return True
+    if not isinstance(tags, list):
+        tags = [tags]
+    return set(tags).issubset(record_tags)
+
+
+def matches_parameters(parameter_set, parameters):
+    """
+    Does a record with the given parameter set match a *parameters* query
+    filter? Values are compared as strings, since they may have been
+    given on the command line.
+    """
+    for name, value in parameters.items():
+        try:
+            if str(parameter_set[name]) != str(value):
+                return False
+        except (KeyError, TypeError):
+            return False
+    return True
+
+
+def matches(record, tags=None, all_tags=None, since=None, until=None, outcome=None, user=None,
+            version=None, main_file=None, parameters=None):
+    """Does the given record match all of the given query filters?"""
+    return (matches_tags(record.tags, tags)
+            and matches_all_tags(record.tags, all_tags)
+            and (since is None or record.timestamp >= since)
+            and (until is None or record.timestamp <= until)
+            and (outcome is None or outcome.lower() in (record.outcome or "").lower())
+            and (user is None or record.user == user)
+            and (version is None or record.version == version)
+            and (main_file is None or record.main_file == main_file)
+            and (not parameters or matches_parameters(record.parameters, parameters)))
+
+
+def sort_records(records, order_by):
+    """Sort a list of records in place, according to an *order_by* argument."""
+    attribute, reverse = parse_order_by(order_by)
+    records.sort(key=lambda record: getattr(record, attribute) or "", reverse=reverse)
+    return records
+
+
+def slice_records(records, limit=None, offset=0):
+    """Apply the *limit* and *offset* arguments of a query to a list of records."""
+    if limit is None:
+        return records[offset:]
+    return records[offset:offset + limit]
+
+
 @component_type
 class RecordStore(object):
     """
@@ -20,6 +115,7 @@ class RecordStore(object):
     """
     required_attributes = ("list_projects", "save", "get", "list", "labels", "delete",
                            "delete_all", "delete_by_tag", "most_recent", "has_project")
+    sync_chunk_size = 100
 
     def list_projects(self):
         """Return the names of all projects that have records in this store."""
@@ -33,6 +129,25 @@ class RecordStore(object):
         """Retrieve the record with the given label from the given project."""
         raise NotImplementedError
 
+    def get_many(self, project_name, labels):
+        """
+        Retrieve the records with the given labels from the given project.
+
+        Subclasses for which retrieving several records at once is cheaper
+        than retrieving them one by one should override this method.
+        """
+        return [self.get(project_name, label) for label in labels]
+
+    def save_many(self, project_name, records):
+        """
+        Store the given records under the given project.
+
+        Subclasses for which storing several records at once is cheaper
+        than storing them one by one should override this method.
+        """
+        for record in records:
+            self.save(project_name, record)
+
     def list(self, project_name, tags=None):
         """
         Return a list of records for the given project.
@@ -42,10 +157,99 @@ class RecordStore(object):
         """
         raise NotImplementedError
 
+    def query(self, project_name, order_by="-timestamp", limit=None, offset=0, **filters):
+        """
+        Return a list of the records from the given project that match all
+        of the given filters, sorted by the record attribute named by
+        *order_by* (prefix the name with "-" for descending order). *limit*
+        and *offset* select a slice of the sorted list.
+
+        The following filters are supported:
+          *tags*: a tag or list of tags, as for :meth:`list`.
+          *all_tags*: a tag or list of tags; only records that have been
+              tagged with all of them are returned.
+          *since*, *until*: datetimes; only records with timestamps within
+              this range (inclusive) are returned.
+          *outcome*: text which must appear in the record outcome
+              (case-insensitive).
+          *user*, *version*, *main_file*: values which must be equal to the
+              corresponding record attribute.
+          *parameters*: a dict of parameter names and values, all of which
+              must be present in the record parameter set.
+
+        This default implementation retrieves all the records with the given
+        tags and filters them in Python. Subclasses should override it to
+        perform the filtering in the underlying database.
+        """
+        check_filters(filters)
+        records = [record for record in self.list(project_name, filters.get("tags"))
+                   if matches(record, **filters)]
+        return slice_records(sort_records(records, order_by), limit, offset)
+
+    def tag_counts(self, project_name):
+        """
+        Return a dict containing, for each tag used in the given project, the
+        number of records that have been tagged with it.
+
+        This default implementation retrieves every record in the project, so
+        subclasses should override it if they can count tags in the database.
+        """
+        counts = {}
+        for record in self.iter_records(project_name):
+            for tag in record.tags:
+                counts[tag] = counts.get(tag, 0) + 1
+        return counts
+
+    def add_tags(self, project_name, labels, tags):
+        """
+        Add the given tags to each of the records with the given labels.
+
+        This default implementation retrieves and saves each record in turn,
+        so subclasses should override it if they can add tags in the database.
+        """
+        for chunk in _chunks(labels, self.sync_chunk_size):
+            records = self.get_many(project_name, chunk)
+            for record in records:
+                record.tags.update(tags)
+            self.save_many(project_name, records)
+
+    def remove_tags(self, project_name, labels, tags):
+        """
+        Remove the given tags from each of the records with the given labels.
+        As for :meth:`add_tags`, subclasses should override this method if
+        they can remove tags in the database.
+        """
+        for chunk in _chunks(labels, self.sync_chunk_size):
+            records = self.get_many(project_name, chunk)
+            for record in records:
+                record.tags.difference_update(tags)
+            self.save_many(project_name, records)
+
+    def iter_records(self, project_name):
+        """
+        Return an iterator over all the records in the given project, which
+        retrieves the records a few at a time rather than all at once.
+        """
+        for labels in _chunks(self.labels(project_name), self.sync_chunk_size):
+            for record in self.get_many(project_name, labels):
+                yield record
+
     def labels(self, project_name):
-        """Return the labels of all records in the given project."""
+        """Return the labels of all records in the given project, most recent first."""
         raise NotImplementedError
 
+    def digests(self, project_name):
+        """
+        Return a dict containing, for each record in the given project, the
+        record label and a digest of the record content (see
+        :func:`serialization.record_digest`).
+
+        This default implementation retrieves every record in the project, so
+        subclasses should override it if they store the digests.
+        """
+        return dict((record.label, serialization.record_digest(record))
+                    for record in self.list(project_name))
+
     def delete(self, project_name, label):
         """Delete the record with the given label from the given project."""
         raise NotImplementedError
@@ -58,6 +262,16 @@ class RecordStore(object):
         """Delete all records from the given project that have been tagged with the given tag."""
         raise NotImplementedError
 
+    def collect_garbage(self):
+        """
+        Remove any data shared between records which is no longer used by
+        any record, and return the number of items removed.
+
+        Most record stores do this whenever records are deleted, so this
+        default implementation does nothing.
+        """
+        return 0
+
     def most_recent(self, project_name):
         """Return the most recent record from the given project."""
         raise NotImplementedError
@@ -72,12 +286,40 @@ class RecordStore(object):
         records = self.list(project_name)
         return self.export_records(records, indent=indent)
 
+    def export_to_file(self, project_name, fp, indent=None, format="json"):
+        """
+        Write a representation of the project record store to a file-like
+        object, retrieving and writing the records one at a time.
+
+        *format* may be "json" or "binary" (see :mod:`recordstore.binary`), in
+        which case *fp* must be opened in binary mode.
+        """
+        if format == "binary":
+            binary.dump_records(self.iter_records(project_name), fp)
+        else:
+            serialization.dump_records(self.iter_records(project_name), fp, indent=indent)
+
     def import_(self, project_name, content):
-        """Import records in JSON format."""
-        records = serialization.decode_records(content)
-        for record in records:
-            # need to check for duplicate record labels?
-            self.save(project_name, record)
+        """Import records in JSON or binary format."""
+        if binary.is_binary(content):
+            records = binary.decode_records(content)
+        else:
+            records = serialization.decode_records(content)
+        # need to check for duplicate record labels?
+        self.save_many(project_name, records)
+
+    def import_from_file(self, project_name, fp, format="json"):
+        """
+        Import records in JSON or binary format from a file-like object,
+        decoding and saving a few records at a time rather than loading the
+        whole file.
+        """
+        if format == "binary":
+            records = binary.load_records(fp)
+        else:
+            records = serialization.load_records(fp)
+        for chunk in _chunks(records, self.sync_chunk_size):
+            self.save_many(project_name, chunk)
 
     def sync(self, other, project_name):
         """
@@ -91,19 +333,29 @@ class RecordStore(object):
         """
         # what to do about syncing different Sumatra versions? Need to think about
         # schema versioning
-        self_labels = set(self.labels(project_name))
-        other_labels = set(other.labels(project_name))
+        self_digests = self.digests(project_name)
+        other_digests = other.digests(project_name)
+        self_labels = set(self_digests)
+        other_labels = set(other_digests)
         only_in_self = self_labels.difference(other_labels)
         only_in_other = other_labels.difference(self_labels)
-        in_both = self_labels.intersection(other_labels)
+        # records with identical digests are identical, so only records whose
+        # digests differ need to be retrieved and compared in detail (they may
+        # still be equal, e.g. if only the tags or outcome differ)
+        in_both = [label for label in self_labels.intersection(other_labels)
+                   if self_digests[label] != other_digests[label]]
         non_synchronizable = []
-        for label in in_both:
-            if self.get(project_name, label) != other.get(project_name, label):
-                non_synchronizable.append(label)
-        for label in only_in_self:
-            other.save(project_name, self.get(project_name, label))
-        for label in only_in_other:
-            self.save(project_name, other.get(project_name, label))
+        # records are transferred in chunks to limit memory use
+        for labels in _chunks(in_both, self.sync_chunk_size):
+            for label, self_record, other_record in zip(labels,
+                                                        self.get_many(project_name, labels),
+                                                        other.get_many(project_name, labels)):
+                if self_record != other_record:
+                    non_synchronizable.append(label)
+        for labels in _chunks(only_in_self, self.sync_chunk_size):
+            other.save_many(project_name, self.get_many(project_name, labels))
+        for labels in _chunks(only_in_other, self.sync_chunk_size):
+            self.save_many(project_name, other.get_many(project_name, labels))
         return non_synchronizable
 
     def sync_all(self, other):
@@ -134,7 +386,10 @@ class RecordStore(object):
             parts = field.split(".")
             obj = record
             for part in parts[:-1]:
-                obj = getattr(obj, part)
+                # sub-objects may be shared with other records (see interning)
+                child = copy.copy(getattr(obj, part))
+                setattr(obj, part, child)
+                obj = child
             setattr(obj, parts[-1], value)
             self.save(project_name, record)
 
@@ -0,0 +1,473 @@
+"""
+Handles serialization/deserialization of records to/from a compact binary
+format, as an alternative to JSON (see :mod:`sumatra.recordstore.serialization`)
+where the speed of encoding and decoding large numbers of records matters
+more than readability, e.g. for exports of large projects and for the
+HTTP record store.
+
+The format is versioned: content starts with the bytes ``SMTB`` followed by a
+one-byte format version. A record is encoded as a list of values in a fixed
+order (see :func:`record_values`), rather than as a dictionary, so that field
+names are not repeated in every record. Fields added in later versions of the
+format will be appended to the list. Values are tagged with their type;
+integers and lengths are variable-length, and timestamps are stored as
+integer microseconds, so that no date parsing or formatting is needed.
+
+Short strings are only stored the first time they occur: later occurrences
+refer back to the first. In a stream of records written by
+:func:`dump_records`, this applies across records, so paths, versions and
+names that are shared by many records take little space.
+
+When decoding, the classes of executables, repositories, launch modes, data
+stores, parameter sets and dependencies are looked up once per name, and
+identical sub-objects are only created once per stream, and shared between
+records (see :mod:`sumatra.recordstore.interning`).
+
+
+:copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+from __future__ import unicode_literals
+from builtins import str, int, object
+
+import struct
+from io import BytesIO
+from datetime import datetime, timedelta
+from sumatra import programs, launch, datastore, versioncontrol, parameters, dependency_finder
+from sumatra.records import Record
+from sumatra.core import get_registered_components
+from .interning import intern_object
+
+MAGIC = b"SMTB"
+FORMAT_VERSION = 1
+
+# type tags
+NONE, TRUE, FALSE, INT, FLOAT, STR, STR_REF, BYTES, LIST, DICT, TIMESTAMP = range(11)
+
+#: strings of up to this many bytes (when encoded as UTF-8) are only stored once
+MAX_SHARED_STRING = 256
+MAX_SHARED_STRINGS = 65536
+
+_EPOCH = datetime(1970, 1, 1)
+_DOUBLE = struct.Struct(">d")
+
+
+class BinaryFormatError(ValueError):
+    pass
+
+
+def _write_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+class Encoder(object):
+    """
+    Encodes values (None, booleans, numbers, strings, bytes, datetimes and
+    lists and dicts of these) into a bytearray. Short strings are added to a
+    table, which lasts as long as the encoder, and later occurrences are
+    encoded as references into the table.
+    """
+
+    def __init__(self):
+        self._strings = {}
+
+    def encode(self, value, out):
+        if isinstance(value, str):
+            content = value.encode("utf-8")
+            if len(content) <= MAX_SHARED_STRING:
+                index = self._strings.get(value)
+                if index is not None:
+                    out.append(STR_REF)
+                    _write_varint(out, index)
+                    return
+                if len(self._strings) < MAX_SHARED_STRINGS:
+                    self._strings[value] = len(self._strings)
+            out.append(STR)
+            _write_varint(out, len(content))
+            out += content
+        elif value is None:
+            out.append(NONE)
+        elif value is True:
+            out.append(TRUE)
+        elif value is False:
+            out.append(FALSE)
+        elif isinstance(value, int):
+            out.append(INT)
+            _write_varint(out, value << 1 if value >= 0 else ((-value) << 1) - 1)  # zigzag
+        elif isinstance(value, float):
+            out.append(FLOAT)
+            out += _DOUBLE.pack(value)
+        elif isinstance(value, (list, tuple)):
+            out.append(LIST)
+            _write_varint(out, len(value))
+            for item in value:
+                self.encode(item, out)
+        elif isinstance(value, dict):
+            out.append(DICT)
+            _write_varint(out, len(value))
+            for key, item in value.items():
+                self.encode(key, out)
+                self.encode(item, out)
+        elif isinstance(value, datetime):
+            delta = value - _EPOCH
+            microseconds = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+            out.append(TIMESTAMP)
+            _write_varint(out, microseconds << 1 if microseconds >= 0 else ((-microseconds) << 1) - 1)
+        elif isinstance(value, bytes):
+            out.append(BYTES)
+            _write_varint(out, len(value))
+            out += value
+        else:
+            raise TypeError("Cannot encode %r in the binary record format" % (value,))
+
+
+class Decoder(object):
+    """
+    Decodes values encoded by :class:`Encoder`, keeping a table of short
+    strings which mirrors that of the encoder.
+    """
+
+    def __init__(self):
+        self._strings = []
+
+    def decode(self, data, pos):
+        """
+        Decode the value starting at position *pos* of *data* (a bytearray),
+        and return the value and the position following it.
+        """
+        tag = data[pos]
+        pos += 1
+        if tag == STR:
+            length, pos = _read_varint(data, pos)
+            end = pos + length
+            value = data[pos:end].decode("utf-8")
+            if length <= MAX_SHARED_STRING and len(self._strings) < MAX_SHARED_STRINGS:
+                self._strings.append(value)
+            return value, end
+        elif tag == STR_REF:
+            index, pos = _read_varint(data, pos)
+            return self._strings[index], pos
+        elif tag == NONE:
+            return None, pos
+        elif tag == LIST:
+            length, pos = _read_varint(data, pos)
+            value = []
+            for i in range(length):
+                item, pos = self.decode(data, pos)
+                value.append(item)
+            return value, pos
+        elif tag == DICT:
+            length, pos = _read_varint(data, pos)
+            value = {}
+            for i in range(length):
+                key, pos = self.decode(data, pos)
+                value[key], pos = self.decode(data, pos)
+            return value, pos
+        elif tag == TRUE:
+            return True, pos
+        elif tag == FALSE:
+            return False, pos
+        elif tag in (INT, TIMESTAMP):
+            n, pos = _read_varint(data, pos)
+            n = (n >> 1) if not n & 1 else -((n + 1) >> 1)
+            if tag == INT:
+                return n, pos
+            return _EPOCH + timedelta(microseconds=n), pos
+        elif tag == FLOAT:
+            return _DOUBLE.unpack_from(data, pos)[0], pos + 8
+        elif tag == BYTES:
+            length, pos = _read_varint(data, pos)
+            return bytes(data[pos:pos + length]), pos + length
+        raise BinaryFormatError("Unknown type tag %d at position %d" % (tag, pos - 1))
+
+
+def _parameter_values(parameter_set):
+    if isinstance(parameter_set, dict):
+        return ["dict", parameter_set]
+    return [parameter_set.__class__.__name__, str(parameter_set)]
+
+
+def _component_values(obj):
+    return [obj.__class__.__name__, obj.__getstate__()]
+
+
+def _platform_values(platform):
+    return dict((name, getattr(platform, name)) for name in launch.PlatformInformation.__slots__
+                if name != "__weakref__" and hasattr(platform, name))
+
+
+def _data_key_values(key):
+    return [key.path, key.digest, key.creation, key.metadata]
+
+
+def record_values(record):
+    """
+    Return the list of values which represents a record in the binary format.
+    """
+    executable = record.executable
+    return [
+        record.label,
+        record.timestamp,
+        record.reason,
+        record.duration,
+        [executable.name, executable.path, executable.version, executable.options],
+        [record.repository.__class__.__name__, record.repository.url, record.repository.upstream],
+        record.main_file,
+        record.version,
+        _parameter_values(record.parameters),
+        _component_values(record.launch_mode),
+        _component_values(record.datastore),
+        _component_values(record.input_datastore),
+        [_data_key_values(key) for key in record.input_data],
+        record.script_arguments,
+        record.outcome or "",
+        record.stdout_stderr,
+        [_data_key_values(key) for key in record.output_data],
+        sorted(record.tags),
+        record.diff,
+        record.user,
+        [[dep.module, dep.name, dep.path, dep.version, dep.diff, dep.source]
+         for dep in record.dependencies],
+        [_platform_values(platform) for platform in record.platforms],
+        record.repeats,
+    ]
+
+
+def _freeze(value):
+    """Return a hashable equivalent of a decoded value."""
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    elif isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    return value
+
+
+class RecordBuilder(object):
+    """
+    Creates records from the lists of values returned by
+    :func:`record_values`. Component classes are looked up once per name, and
+    identical sub-objects are only created once.
+    """
+
+    def __init__(self):
+        self._classes = {}
+        self._objects = {}
+
+    def _get_class(self, kind, name):
+        cls = self._classes.get((kind, name))
+        if cls is None:
+            if kind == "executable":
+                cls = get_registered_components(programs.Executable).get(name, programs.Executable)
+            elif kind == "repository":
+                cls = versioncontrol.base.Repository
+                for module in versioncontrol.vcs_list:
+                    if hasattr(module, name):
+                        cls = getattr(module, name)
+                        break
+            elif kind == "dependency":
+                cls = getattr(dependency_finder, name).Dependency
+            else:
+                cls = getattr({"launch_mode": launch, "datastore": datastore,
+                               "parameters": parameters}[kind], name)
+            self._classes[(kind, name)] = cls
+        return cls
+
+    def _get_object(self, kind, values, create):
+        """
+        Return the object previously created from the same *values*, or call
+        *create* to create it.
+        """
+        try:
+            key = (kind, _freeze(values))
+            obj = self._objects.get(key)
+        except TypeError:  # e.g. keys of different types, which cannot be sorted
+            return intern_object(create(*values))
+        if obj is None:
+            obj = intern_object(create(*values))
+            self._objects[key] = obj
+        return obj
+
+    def _executable(self, name, path, version, options):
+        executable = self._get_class("executable", name)(path, version, options)
+        executable.name = name
+        return executable
+
+    def _repository(self, type, url, upstream):
+        repository = self._get_class("repository", type)(url)
+        repository.upstream = upstream
+        return repository
+
+    def _launch_mode(self, type, state):
+        return self._get_class("launch_mode", type)(**dict((str(k), v) for k, v in state.items()))
+
+    def _datastore(self, type, state):
+        return self._get_class("datastore", type)(**dict((str(k), v) for k, v in state.items()))
+
+    def _dependency(self, module, name, path, version, diff, source):
+        return self._get_class("dependency", module)(name, path, version, diff, source)
+
+    def _platform(self, state):
+        return launch.PlatformInformation(**dict((str(k), v) for k, v in state.items()))
+
+    def _parameters(self, type, content):
+        if type == "dict":
+            return content
+        return self._get_class("parameters", type)(content)
+
+    @staticmethod
+    def _data_key(path, digest, creation, metadata):
+        return datastore.DataKey(path, digest, creation,
+                                 **dict((str(k), v) for k, v in metadata.items()))
+
+    def build(self, values):
+        (label, timestamp, reason, duration, executable, repository, main_file, version,
+         parameter_set, launch_mode, data_store, input_datastore, input_data,
+         script_arguments, outcome, stdout_stderr, output_data, tags, diff, user,
+         dependencies, platforms, repeats) = values[:23]
+        record = Record.__new__(Record)
+        record.__setstate__({
+            "label": label,
+            "timestamp": timestamp,
+            "reason": reason,
+            "duration": duration,
+            "executable": self._get_object("executable", executable, self._executable),
+            "repository": self._get_object("repository", repository, self._repository),
+            "main_file": main_file,
+            "version": version,
+            "parameters": self._parameters(*parameter_set),
+            "launch_mode": self._get_object("launch_mode", launch_mode, self._launch_mode),
+            "datastore": self._get_object("datastore", data_store, self._datastore),
+            "input_datastore": self._get_object("datastore", input_datastore, self._datastore),
+            "input_data": [self._data_key(*key) for key in input_data],
+            "script_arguments": script_arguments,
+            "outcome": outcome,
+            "stdout_stderr": stdout_stderr,
+            "output_data": [self._data_key(*key) for key in output_data],
+            "tags": set(tags),
+            "diff": diff,
+            "user": user,
+            "on_changed": "error",
+            "dependencies": [self._get_object("dependency", dep, self._dependency)
+                             for dep in dependencies],
+            "platforms": [self._get_object("platform", [platform], self._platform)
+                          for platform in platforms],
+            "repeats": repeats,
+        })
+        return record
+
+
+def _check_header(data):
+    if bytes(data[:len(MAGIC)]) != MAGIC:
+        raise BinaryFormatError("Not a binary Sumatra record")
+    version = data[len(MAGIC)]
+    if version > FORMAT_VERSION:
+        raise BinaryFormatError("Binary record format version %d is not supported by this "
+                                "version of Sumatra (maximum %d)" % (version, FORMAT_VERSION))
+    return len(MAGIC) + 1
+
+
+def _header():
+    out = bytearray(MAGIC)
+    out.append(FORMAT_VERSION)
+    return out
+
+
+def _decode(decoder, data, pos):
+    try:
+        return decoder.decode(data, pos)
+    except (IndexError, struct.error, UnicodeDecodeError):
+        raise BinaryFormatError("Truncated or corrupted binary record")
+
+
+def encode_record(record):
+    """Encode a Sumatra record in the binary format."""
+    out = _header()
+    Encoder().encode(record_values(record), out)
+    return bytes(out)
+
+
+def decode_record(content):
+    """Create a Sumatra record from the output of :func:`encode_record`."""
+    data = bytearray(content)
+    values, pos = _decode(Decoder(), data, _check_header(data))
+    return RecordBuilder().build(values)
+
+
+def is_binary(content):
+    """Does *content* start with the header of the binary format?"""
+    return isinstance(content, (bytes, bytearray)) and bytes(content[:len(MAGIC)]) == MAGIC
+
+
+def dump_records(records, fp):
+    """
+    Write records to a binary file-like object, one at a time. `records` may
+    be any iterable, so the records need not all be held in memory at once.
+    """
+    fp.write(bytes(_header()))
+    encoder = Encoder()
+    for record in records:
+        body = bytearray()
+        encoder.encode(record_values(record), body)
+        length = bytearray()
+        _write_varint(length, len(body))
+        fp.write(bytes(length + body))
+
+
+def _read_frame_length(fp):
+    """Return the length of the next record in *fp*, or None at the end of the file."""
+    n = 0
+    shift = 0
+    while True:
+        byte = fp.read(1)
+        if not byte:
+            if shift:
+                raise BinaryFormatError("Unexpected end of file")
+            return None
+        byte = bytearray(byte)[0]
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n
+        shift += 7
+
+
+def load_records(fp):
+    """
+    Create Sumatra records one at a time from a binary file-like object
+    written by :func:`dump_records`. This is a generator: only one record is
+    held in memory at a time.
+    """
+    header = bytearray(fp.read(len(MAGIC) + 1))
+    if len(header) < len(MAGIC) + 1:
+        raise BinaryFormatError("Not a binary Sumatra record file")
+    _check_header(header)
+    decoder = Decoder()
+    builder = RecordBuilder()
+    while True:
+        length = _read_frame_length(fp)
+        if length is None:
+            return
+        data = bytearray(fp.read(length))
+        if len(data) < length:
+            raise BinaryFormatError("Unexpected end of file")
+        values, pos = _decode(decoder, data, 0)
+        yield builder.build(values)
+
+
+def decode_records(content):
+    """Create a list of Sumatra records from the output of :func:`dump_records`."""
+    return list(load_records(BytesIO(content)))
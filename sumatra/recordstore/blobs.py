@@ -0,0 +1,59 @@
+"""
+Storage of the large text attributes of records, i.e., the captured output
+of the computation and the diff of the working copy, separately from the
+records themselves.
+
+Repeated runs often produce exactly the same output, or are launched from
+the same modified working copy. Rather than storing such text inline in each
+record, the record stores keep it in a table of compressed "blobs", keyed by
+the SHA1 digest of the text, which is shared by all the records that contain
+the same text. The blobs are only retrieved when the attribute is needed.
+
+Short values, such as "No output.", are not worth a separate lookup, and are
+stored inline as before.
+
+
+:copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+from __future__ import unicode_literals
+
+import zlib
+import hashlib
+
+#: the record attributes which are stored as blobs
+BLOB_ATTRIBUTES = ("stdout_stderr", "diff")
+#: values shorter than this (in characters) are stored inline
+MIN_BLOB_SIZE = 1024
+COMPRESSION_LEVEL = 6
+
+
+def is_blob(text):
+    """Should *text* be stored as a blob, rather than inline?"""
+    return text is not None and len(text) >= MIN_BLOB_SIZE
+
+
+def blob_digest(text):
+    """Return the key under which *text* is stored."""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def compress(text):
+    return zlib.compress(text.encode('utf-8'), COMPRESSION_LEVEL)
+
+
+def decompress(content):
+    return zlib.decompress(content).decode('utf-8')
+
+
+def extract_blobs(data):
+    """
+    Remove the values which should be stored as blobs from *data*, a dict
+    containing record attributes (or the output of
+    :func:`sumatra.formatting.record2dict`), and return them in a new dict.
+    """
+    texts = {}
+    for name in BLOB_ATTRIBUTES:
+        if is_blob(data.get(name)):
+            texts[name] = data.pop(name)
+    return texts
@@ -22,7 +22,10 @@ import imp
 import django.conf as django_conf
 from django.core import management
 import django
-from sumatra.recordstore.base import RecordStore
+from sumatra.recordstore.base import (RecordStore, check_filters, matches_parameters,
+                                      slice_records, _chunks)
+from sumatra.recordstore import blobs
+from sumatra.recordstore.serialization import record_digest
 from ...core import component
 from urllib.request import urlparse
 from io import StringIO
@@ -112,6 +115,8 @@ class DjangoConfiguration(object):
                 management.call_command('migrate', database=label, verbosity=0)
             except django.core.management.base.CommandError:
                 management.call_command('syncdb', database=label, verbosity=0)
+            from .models import upgrade_schema
+            upgrade_schema(using=label)
 
     def configure(self):
         settings = django_conf.settings
@@ -175,9 +180,8 @@ class DjangoRecordStore(RecordStore):
         models = self._get_models()
         return models.Record.objects.using(self._db_label)
 
-    def _get_db_record(self, project_name, record):
+    def _get_db_record(self, db_project, record):
         models = self._get_models()
-        db_project = self._get_db_project(project_name)
         try:
             db_record = self._manager.get(label=record.label, project=db_project)
         except models.Record.DoesNotExist:
@@ -206,8 +210,30 @@ class DjangoRecordStore(RecordStore):
         models = self._get_models()
         return [project.id for project in models.Project.objects.using(self._db_label).all()]
 
+    def _get_db_objs(self, db_class, objs, lookup_field):
+        models = self._get_models()
+        cls = getattr(models, db_class)
+        return cls.objects.get_or_create_many_from_sumatra_objects(objs, lookup_field,
+                                                                   using=self._db_label)
+
     def save(self, project_name, record):
-        db_record = self._get_db_record(project_name, record)
+        self.save_many(project_name, [record])
+
+    def save_many(self, project_name, records):
+        """
+        Store the given records under the given project, in a single
+        transaction, so that the database is locked only once, and either all
+        or none of the records are stored.
+        """
+        from django.db import transaction
+        with transaction.atomic(using=self._db_label):
+            db_project = self._get_db_project(project_name)
+            for record in records:
+                self._save(db_project, record)
+
+    def _save(self, db_project, record):
+        models = self._get_models()
+        db_record = self._get_db_record(db_project, record)
         for attr in 'reason', 'duration', 'outcome', 'main_file', 'version', 'timestamp':
             value = getattr(record, attr)
             if value is not None:
@@ -220,28 +246,29 @@ class DjangoRecordStore(RecordStore):
         db_record.parameters = self._get_db_obj('ParameterSet', record.parameters)
         db_record.script_arguments = record.script_arguments
         db_record.user = record.user
-        db_record.tags = ",".join(record.tags)
-        db_record.stdout_stderr = record.stdout_stderr
-        # should perhaps check here for any orphan Tags, i.e., those that are no longer associated with any records, and delete them
+        texts = blobs.extract_blobs(dict((name, getattr(record, name))
+                                         for name in blobs.BLOB_ATTRIBUTES))
+        db_record.stdout_stderr = "" if "stdout_stderr" in texts else record.stdout_stderr
+        db_record.diff = "" if "diff" in texts else record.diff
+        db_record.repeats = record.repeats
+        db_record.digest = record_digest(record)
         db_record.save(using=self._db_label)  # need to save before using many-to-many relationship
-        chunk_size = 900  # SQLite has problems with inserts >= ca. 1000, so for safety we split it into chunks
-        for i in range(0, len(record.input_data), chunk_size):
-            db_keys = (self._get_db_obj('DataKey', key) for key in record.input_data[i:i + chunk_size])
-            db_record.input_data.add(*db_keys)
-        for i in range(0, len(record.output_data), chunk_size):
-            db_keys = (self._get_db_obj('DataKey', key) for key in record.output_data[i:i + chunk_size])
-            for key in db_keys:
-                key.output_from_record = db_record
-                key.save()
+        db_record.set_tags(record.tags)
+        db_record.set_texts(texts)
+        # related objects are looked up, and created if necessary, in bulk
+        chunk_size = models.BULK_CHUNK_SIZE  # SQLite has problems with inserts >= ca. 1000
+        db_keys = self._get_db_objs('DataKey', record.input_data, 'path')
+        for i in range(0, len(db_keys), chunk_size):
+            db_record.input_data.add(*db_keys[i:i + chunk_size])
+        db_keys = self._get_db_objs('DataKey', record.output_data, 'path')
+        for i in range(0, len(db_keys), chunk_size):
+            models.DataKey.objects.using(self._db_label).filter(
+                pk__in=[key.pk for key in db_keys[i:i + chunk_size]]).update(output_from_record=db_record)
         if record.dependencies:
-            for dep in record.dependencies:
-                # print "Adding dependency %s to db_record" % dep
-                db_record.dependencies.add(self._get_db_obj('Dependency', dep))
-        for pi in record.platforms:
-            db_record.platforms.add(self._get_db_obj('PlatformInformation', pi))
-        db_record.diff = record.diff
-        db_record.repeats = record.repeats
-        db_record.save(using=self._db_label)
+            db_record.dependencies.add(*self._get_db_objs('Dependency', record.dependencies, 'name'))
+        if record.platforms:
+            db_record.platforms.add(*self._get_db_objs('PlatformInformation', record.platforms,
+                                                       'network_name'))
 
     def get(self, project_name, label):
         models = self._get_models()
@@ -251,15 +278,21 @@ class DjangoRecordStore(RecordStore):
             raise KeyError(label)
         return db_record.to_sumatra()
 
+    def get_many(self, project_name, labels):
+        models = self._get_models()
+        db_records = self._manager.filter(project__id=project_name, label__in=labels)
+        records = dict((record.label, record) for record in models.records_to_sumatra(db_records))
+        return [records[label] for label in labels]
+
     def list(self, project_name, tags=None):
-        db_records = self._manager.filter(project__id=project_name).select_related()
+        models = self._get_models()
+        db_records = self._manager.filter(project__id=project_name)
         if tags:
-            if not hasattr(tags, "__len__"):
+            if not isinstance(tags, list):
                 tags = [tags]
-            for tag in tags:
-                db_records = db_records.filter(tags__contains=tag)
+            db_records = models.filter_by_tags(db_records, tags)
         try:
-            records = [db_record.to_sumatra() for db_record in db_records]
+            records = models.records_to_sumatra(db_records, lazy=True)
         except Exception as err:
             errmsg = dedent("""\
                 Sumatra could not retrieve the record from the record store.
@@ -269,18 +302,79 @@ class DjangoRecordStore(RecordStore):
             raise Exception(errmsg)
         return records
 
+    def query(self, project_name, order_by="-timestamp", limit=None, offset=0, **filters):
+        check_filters(filters)
+        models = self._get_models()
+        db_records = self._manager.filter(project__id=project_name)
+        for name, match_all in (("tags", False), ("all_tags", True)):
+            tags = filters.get(name)
+            if tags:
+                if not isinstance(tags, list):
+                    tags = [tags]
+                db_records = models.filter_by_tags(db_records, tags, match_all)
+        lookups = {"since": "timestamp__gte", "until": "timestamp__lte",
+                   "outcome": "outcome__icontains", "user": "user",
+                   "version": "version", "main_file": "main_file"}
+        for name, lookup in lookups.items():
+            if filters.get(name) is not None:
+                db_records = db_records.filter(**{lookup: filters[name]})
+        db_records = db_records.order_by(order_by)
+        parameters = filters.get("parameters")
+        if parameters:
+            # parameter sets are stored as text, so they are checked once the
+            # records have been retrieved
+            records = [record for record in models.records_to_sumatra(db_records)
+                       if matches_parameters(record.parameters, parameters)]
+            return slice_records(records, limit, offset)
+        if limit is None:
+            db_records = db_records[offset:]
+        else:
+            db_records = db_records[offset:offset + limit]
+        return models.records_to_sumatra(db_records, lazy=True)
+
     def labels(self, project_name):
-        return [record.label for record in self._manager.filter(project__id=project_name)]
+        return list(self._manager.filter(project__id=project_name)
+                    .order_by("-timestamp").values_list("label", flat=True))
+
+    def digests(self, project_name):
+        models = self._get_models()
+        db_records = self._manager.filter(project__id=project_name)
+        models.update_digests(db_records)  # those of records modified since they were saved
+        return dict(db_records.values_list("label", "digest"))
 
     def delete(self, project_name, label):
+        models = self._get_models()
         db_record = self._manager.get(label=label, project__id=project_name)
         db_record.delete()
+        models.delete_unused_blobs(self._db_label)
+
+    def tag_counts(self, project_name):
+        models = self._get_models()
+        return models.tag_counts(self._manager.filter(project__id=project_name))
+
+    def add_tags(self, project_name, labels, tags):
+        models = self._get_models()
+        from django.db import transaction
+        with transaction.atomic(using=self._db_label):
+            for chunk in _chunks(labels, models.BULK_CHUNK_SIZE):
+                models.add_tags(self._manager.filter(project__id=project_name, label__in=chunk),
+                                list(tags))
+
+    def remove_tags(self, project_name, labels, tags):
+        models = self._get_models()
+        from django.db import transaction
+        with transaction.atomic(using=self._db_label):
+            for chunk in _chunks(labels, models.BULK_CHUNK_SIZE):
+                models.remove_tags(self._manager.filter(project__id=project_name,
+                                                        label__in=chunk), list(tags))
 
     def delete_by_tag(self, project_name, tag):
-        db_records = self._manager.filter(project__id=project_name, tags__contains=tag)
+        models = self._get_models()
+        db_records = models.filter_by_tags(self._manager.filter(project__id=project_name), [tag])
         n = db_records.count()
         for db_record in db_records:
             db_record.delete()
+        models.delete_unused_blobs(self._db_label)
         return n
 
     def most_recent(self, project_name):
@@ -302,7 +396,7 @@ class DjangoRecordStore(RecordStore):
             db_config.configure()
         #management.call_command('sqlclear', 'django_store', database=self._db_label)  # this produces coloured output, need no_color option from Django 1.7
         cmds = ["BEGIN;"] + ['DROP TABLE "django_store_{0}";'.format(x)
-                             for x in ("record", "record_input_data", "record_dependencies",
+                             for x in ("schemaversion", "recordtag", "recordblob", "blob", "record", "record_input_data", "record_dependencies",
                                        "record_platforms", "platforminformation", "datakey", "datastore", "launchmode",
                                        "parameterset", "repository", "dependency", "executable", "project")] + ["COMMIT;"]
         from django.db import connection
@@ -10,19 +10,87 @@ from builtins import str
 from builtins import object
 
 import json
-from django.db import models
+import functools
+from django.db import models, transaction, connections
 from sumatra import programs, launch, datastore, records, versioncontrol, parameters, dependency_finder
-import tagging.fields
-from tagging.models import Tag
+from django.db.models import Count
+from tagging.utils import parse_tag_input, edit_string_for_tags
 import datetime
 import django
 from distutils.version import LooseVersion
 from sumatra.core import get_registered_components
+from sumatra.recordstore.interning import intern_object, intern_record
+from sumatra.recordstore import blobs
+from sumatra.recordstore.serialization import record_digest
+
+
+# SQLite limits the number of parameters in a query to 999
+BULK_CHUNK_SIZE = 900
+#: 1: as created by Sumatra 0.7 and earlier
+#: 2: tags are stored in the RecordTag table, and the digest of each record
+#:    in the record table
+SCHEMA_VERSION = 2
 
 
 class SumatraObjectsManager(models.Manager):
 
     def get_or_create_from_sumatra_object(self, obj, using='default'):
+        attributes = self.attributes_from_sumatra_object(obj)
+        return self.using(using).get_or_create(**attributes)
+
+    def get_or_create_many_from_sumatra_objects(self, objs, lookup_field, using='default'):
+        """
+        Return a list of the database objects corresponding to the Sumatra
+        objects *objs*, creating those that do not yet exist.
+
+        Rather than looking up each object separately, the candidates are
+        retrieved with an "in" query on *lookup_field*, and the missing
+        objects are created with a single bulk insert (for each chunk of
+        :data:`BULK_CHUNK_SIZE` objects).
+        """
+        attributes = [self.attributes_from_sumatra_object(obj) for obj in objs]
+        if not attributes:
+            return []
+        field_names = sorted(attributes[0])
+
+        def signature(values):
+            return tuple(self.model._meta.get_field(name).to_python(values[name])
+                         for name in field_names)
+
+        found = {}
+
+        def find(lookup_values):
+            lookup_values = list(set(lookup_values))
+            for i in range(0, len(lookup_values), BULK_CHUNK_SIZE):
+                candidates = self.using(using).filter(
+                    **{lookup_field + "__in": lookup_values[i:i + BULK_CHUNK_SIZE]})
+                for db_obj in candidates:
+                    values = dict((name, getattr(db_obj, name)) for name in field_names)
+                    found.setdefault(signature(values), db_obj)
+
+        find(attrs[lookup_field] for attrs in attributes)
+        missing = {}
+        for attrs in attributes:
+            if signature(attrs) not in found:
+                missing[signature(attrs)] = attrs
+        if missing:
+            new_objs = [self.model(**attrs) for attrs in missing.values()]
+            for i in range(0, len(new_objs), BULK_CHUNK_SIZE):
+                self.using(using).bulk_create(new_objs[i:i + BULK_CHUNK_SIZE])
+            find(attrs[lookup_field] for attrs in missing.values())
+        db_objs = []
+        for attrs in attributes:
+            db_obj = found.get(signature(attrs))
+            if db_obj is None:  # the database stores some value differently
+                db_obj, created = self.using(using).get_or_create(**attrs)
+            db_objs.append(db_obj)
+        return db_objs
+
+    def attributes_from_sumatra_object(self, obj):
+        """
+        Return a dict containing the values of the database fields for the
+        Sumatra object *obj*.
+        """
         # automatically retrieving the field names is nice, but leads
         # to all the special cases below when we have subclasses that we
         # want to store in a single table in the database.
@@ -47,7 +115,7 @@ class SumatraObjectsManager(models.Manager):
                         attributes[name] = str(obj)  # ParameterSet
                     else:
                         raise
-        return self.using(using).get_or_create(**attributes)
+        return attributes
 
 
 class BaseModel(models.Model):
@@ -233,6 +301,18 @@ class PlatformInformation(BaseModel):
         return launch.PlatformInformation(**pi)
 
 
+class Blob(models.Model):
+    """
+    Compressed text, e.g. the output of a computation, which is shared by all
+    the records containing it (see :mod:`sumatra.recordstore.blobs`).
+    """
+    digest = models.CharField(max_length=40, primary_key=True)
+    content = models.BinaryField()
+
+    def text(self):
+        return blobs.decompress(bytes(self.content))
+
+
 class Record(BaseModel):
     label = models.CharField(max_length=100, unique=False)  # make this a SlugField? samarkanov changed unique to False for the search form.
     db_id = models.AutoField(primary_key=True)  # django-tagging needs an integer as primary key - see http://code.google.com/p/django-tagging/issues/detail?id=15
@@ -249,57 +329,386 @@ class Record(BaseModel):
     input_datastore = models.ForeignKey(Datastore, related_name="input_to_records")
     outcome = models.TextField(blank=True)
     timestamp = models.DateTimeField()
-    tags = tagging.fields.TagField()
+    # tags are stored in the RecordTag table. This column held the tags as a
+    # single string in earlier versions; it is emptied by migrate_tags()
+    tags = models.CharField(max_length=255, blank=True)
     dependencies = models.ManyToManyField(Dependency)
     platforms = models.ManyToManyField(PlatformInformation)
+    # large diffs and outputs are stored in the Blob table, via RecordBlob
     diff = models.TextField(blank=True)
     user = models.CharField(max_length=100)
     project = models.ForeignKey(Project, null=True)
     script_arguments = models.TextField(blank=True)
     stdout_stderr = models.TextField(blank=True)
     repeats = models.CharField(max_length=100, null=True, blank=True)
+    # see sumatra.recordstore.serialization.record_digest; empty if the
+    # record has been modified since the digest was calculated
+    digest = models.CharField(max_length=40, blank=True, default="")
 
     # parameters which will be used in the fulltext search (see sumatra.web.services fulltext_search)
-    params_search = ('label', 'reason', 'duration', 'main_file', 'outcome', 'user', 'tags')
+    params_search = ('label', 'reason', 'duration', 'main_file', 'outcome', 'user')
 
     class Meta(object):
         ordering = ('-timestamp',)
 
-    def to_sumatra(self):
+    def to_sumatra(self, tags=None, datastores=None, load=None):
+        """
+        Return the equivalent :class:`sumatra.records.Record`.
+
+        *tags*, if given, is the set of names of the tags of this record,
+        which would otherwise be retrieved from the database. *datastores*,
+        if given, is a dict used to share converted data stores between
+        records (see :func:`records_to_sumatra`).
+
+        If *load* is given, a :class:`sumatra.records.LazyRecord` is returned
+        instead, and *load* is the function which it calls to retrieve its
+        lazy attributes (see :meth:`lazy_attributes`), which are not needed
+        here.
+        """
+        if datastores is None:
+            datastores = {}
+        for db_datastore in (self.datastore, self.input_datastore):
+            if db_datastore.pk not in datastores:
+                datastores[db_datastore.pk] = db_datastore.to_sumatra()
         record = records.Record(
             self.executable.to_sumatra(),
             self.repository.to_sumatra(),
             self.main_file,
             self.version,
             self.launch_mode.to_sumatra(),
-            self.datastore.to_sumatra(),
-            self.parameters.to_sumatra(),
-            [key.to_sumatra() for key in self.input_data.all()],
+            datastores[self.datastore.pk],
+            {},
+            [],
             self.script_arguments,
             self.label,
             self.reason,
-            self.diff,
+            "",
             self.user,
-            input_datastore=self.input_datastore.to_sumatra(),
+            input_datastore=datastores[self.input_datastore.pk],
             timestamp=self.timestamp)
-        record.stdout_stderr = self.stdout_stderr
         record.duration = self.duration
         record.outcome = self.outcome
-        record.tags = set(tag.name for tag in Tag.objects.get_for_object(self))
-        record.output_data = [key.to_sumatra() for key in self.output_data.all()]
-        record.dependencies = [dep.to_sumatra() for dep in self.dependencies.all()]
-        record.platforms = [pi.to_sumatra() for pi in self.platforms.all()]
+        if tags is None:
+            tags = set(tag.name for tag in self.tag_set.all())
+        record.tags = tags
         record.repeats = self.repeats
+        intern_record(record)
+        if load is not None:
+            return records.LazyRecord(record, load)
+        for name, value in self.lazy_attributes().items():
+            setattr(record, name, value)
         return record
 
+    def lazy_attributes(self):
+        """
+        Return a dict containing the values of the attributes of the
+        equivalent Sumatra record that are named in
+        :data:`sumatra.records.LAZY_ATTRIBUTES`.
+        """
+        return {
+            "parameters": self.parameters.to_sumatra(),
+            "input_data": [key.to_sumatra() for key in self.input_data.all()],
+            "output_data": [key.to_sumatra() for key in self.output_data.all()],
+            "stdout_stderr": self.get_stdout_stderr(),
+            "diff": self.get_diff(),
+            "dependencies": [intern_object(dep.to_sumatra()) for dep in self.dependencies.all()],
+            "platforms": [intern_object(pi.to_sumatra()) for pi in self.platforms.all()],
+        }
+
     def __unicode__(self):
         return self.label
 
+    def _get_text(self, name):
+        # looping over all() makes use of any prefetched blobs
+        for record_blob in self.blob_set.all():
+            if record_blob.name == name:
+                return record_blob.blob.text()
+        return getattr(self, name)
+
+    def get_stdout_stderr(self):
+        return self._get_text("stdout_stderr")
+
+    def get_diff(self):
+        return self._get_text("diff")
+
+    def has_diff(self):
+        """Does the record have a diff? Prefetch "blob_set" to avoid retrieving it."""
+        return bool(self.diff) or any(record_blob.name == "diff"
+                                      for record_blob in self.blob_set.all())
+
+    def set_texts(self, texts):
+        """
+        Replace the blobs of this record, which must already have been saved,
+        with the given texts, in a dict keyed by attribute name (see
+        :func:`sumatra.recordstore.blobs.extract_blobs`).
+        """
+        using = self._state.db
+        record_blobs = RecordBlob.objects.using(using).filter(record=self)
+        replaced = list(record_blobs.values_list("blob", flat=True))
+        record_blobs.delete()
+        digests = dict((name, blobs.blob_digest(text)) for name, text in texts.items())
+        existing = set(Blob.objects.using(using).filter(
+            digest__in=list(digests.values())).values_list("digest", flat=True))
+        new_blobs = {}
+        for name, text in texts.items():
+            if digests[name] not in existing:
+                new_blobs[digests[name]] = Blob(digest=digests[name], content=blobs.compress(text))
+        Blob.objects.using(using).bulk_create(list(new_blobs.values()))
+        RecordBlob.objects.using(using).bulk_create(
+            [RecordBlob(record=self, name=name, blob_id=digest) for name, digest in digests.items()])
+        delete_unused_blobs(using, replaced)
+
     def tag_objects(self):
-        return Tag.objects.get_for_object(self)
+        # sorted here rather than in the database, to make use of any prefetched tags
+        return sorted(self.tag_set.all(), key=lambda tag: tag.name)
+
+    def tag_string(self):
+        """Return the tags as a comma-separated string, as accepted by set_tags()."""
+        return edit_string_for_tags(self.tag_objects())
+
+    def set_tags(self, names):
+        """
+        Replace the tags of this record, which must already have been saved,
+        with the given tag names. *names* may also be a comma-separated string.
+        """
+        if isinstance(names, str):
+            names = parse_tag_input(names)
+        names = set(names)
+        db_tags = RecordTag.objects.using(self._state.db).filter(record=self)
+        current = set(db_tags.values_list("name", flat=True))
+        if current - names:
+            db_tags.filter(name__in=current - names).delete()
+        RecordTag.objects.using(self._state.db).bulk_create(
+            [RecordTag(record=self, name=name) for name in names - current])
 
     def command_line(self):
         return self.to_sumatra().command_line
 
     def working_directory(self):
         return self.launch_mode.get_parameters().get('working_directory', None)
+
+
+class SchemaVersion(models.Model):
+    """
+    The version of the database schema (see :data:`SCHEMA_VERSION`), which
+    is recorded by :func:`upgrade_schema`.
+    """
+    version = models.IntegerField()
+
+
+class RecordTag(models.Model):
+    """
+    A tag attached to a record. Tag names are indexed, so that the records
+    with a given tag can be found without examining every record.
+    """
+    record = models.ForeignKey(Record, related_name="tag_set")
+    name = models.CharField(max_length=100, db_index=True)
+
+    class Meta(object):
+        unique_together = ("record", "name")
+
+    def __unicode__(self):
+        return self.name
+
+
+class RecordBlob(models.Model):
+    """Associates a record with the blob holding one of its attributes."""
+    record = models.ForeignKey(Record, related_name="blob_set")
+    name = models.CharField(max_length=20)
+    blob = models.ForeignKey(Blob)
+
+    class Meta(object):
+        unique_together = ("record", "name")
+
+
+def delete_unused_blobs(using="default", digests=None):
+    """
+    Delete the blobs which are no longer used by any record, considering only
+    the given digests, if any.
+    """
+    unused = Blob.objects.using(using).filter(recordblob__isnull=True)
+    if digests is not None:
+        unused = unused.filter(digest__in=digests)
+    unused.delete()
+
+
+def filter_by_tags(db_records, tags, match_all=False):
+    """
+    Restrict a queryset of :class:`Record` objects to the records that have
+    any of the given tags or, if *match_all* is True, all of them.
+    """
+    tagged = RecordTag.objects.using(db_records.db)
+    if match_all:
+        for tag in tags:
+            db_records = db_records.filter(pk__in=tagged.filter(name=tag).values("record"))
+        return db_records
+    return db_records.filter(pk__in=tagged.filter(name__in=tags).values("record"))
+
+
+def tag_counts(db_records):
+    """
+    Return a dict containing, for each tag used by the records in a
+    queryset, the number of those records that have been tagged with it.
+    """
+    counts = RecordTag.objects.using(db_records.db).filter(
+        record__in=db_records).values("name").annotate(count=Count("pk"))
+    return dict((row["name"], row["count"]) for row in counts)
+
+
+def add_tags(db_records, tags):
+    """
+    Add the given tags to all the records in a queryset, with a single
+    insert for each chunk of records.
+    """
+    using = db_records.db
+    pks = list(db_records.values_list("pk", flat=True))
+    for start in range(0, len(pks), BULK_CHUNK_SIZE):
+        chunk_pks = pks[start:start + BULK_CHUNK_SIZE]
+        existing = set(RecordTag.objects.using(using).filter(
+            record__in=chunk_pks, name__in=tags).values_list("record", "name"))
+        RecordTag.objects.using(using).bulk_create(
+            [RecordTag(record_id=pk, name=tag) for pk in chunk_pks for tag in tags
+             if (pk, tag) not in existing])
+        Record.objects.using(using).filter(pk__in=chunk_pks).update(digest="")
+
+
+def remove_tags(db_records, tags):
+    """Remove the given tags from all the records in a queryset."""
+    RecordTag.objects.using(db_records.db).filter(record__in=db_records, name__in=tags).delete()
+    db_records.update(digest="")
+
+
+def update_digests(db_records):
+    """
+    Calculate and store the digests of those records in a queryset whose
+    digest is not known.
+    """
+    using = db_records.db
+    pks = sorted(db_records.filter(digest="").values_list("pk", flat=True))
+    with transaction.atomic(using=using):
+        for start in range(0, len(pks), BULK_CHUNK_SIZE):
+            chunk = Record.objects.using(using).filter(
+                pk__in=pks[start:start + BULK_CHUNK_SIZE]).order_by("pk")
+            chunk_pks = list(chunk.values_list("pk", flat=True))
+            for pk, record in zip(chunk_pks, records_to_sumatra(chunk)):
+                Record.objects.using(using).filter(pk=pk).update(digest=record_digest(record))
+
+
+def migrate_tags(using="default"):
+    """
+    Move the tags of records stored by earlier versions of Sumatra, which are
+    held as a comma-separated string in the "tags" column of the record
+    table, into the RecordTag table, and empty the column.
+    """
+    with transaction.atomic(using=using):
+        db_records = Record.objects.using(using).exclude(tags="")
+        for db_id, tag_string in db_records.values_list("pk", "tags"):
+            add_tags(Record.objects.using(using).filter(pk=db_id), parse_tag_input(tag_string))
+        db_records.update(tags="")
+
+
+def _add_digest_column(using):
+    """Add the digest column to a record table created by Sumatra 0.7 or earlier."""
+    connection = connections[using]
+    table = Record._meta.db_table
+    cursor = connection.cursor()
+    columns = [column.name for column in connection.introspection.get_table_description(cursor, table)]
+    if "digest" not in columns:
+        cursor.execute("ALTER TABLE %s ADD COLUMN digest varchar(40) NOT NULL DEFAULT ''"
+                       % connection.ops.quote_name(table))
+
+
+def upgrade_schema(using="default"):
+    """
+    Bring a database created by an earlier version of Sumatra up to date,
+    once its tables have been created, and record the current
+    :data:`SCHEMA_VERSION` in it, so that each step is only carried out once.
+    """
+    versions = SchemaVersion.objects.using(using)
+    db_version = versions.first()
+    version = db_version and db_version.version or 1
+    if version >= SCHEMA_VERSION:
+        return
+    if version < 2:
+        _add_digest_column(using)
+        migrate_tags(using)
+        update_digests(Record.objects.using(using).all())
+    versions.all().delete()
+    versions.create(version=SCHEMA_VERSION)
+
+
+RELATED_FIELDS = ("executable", "repository", "parameters", "launch_mode",
+                  "datastore", "input_datastore")
+PREFETCHED_FIELDS = ("input_data", "output_data", "dependencies", "platforms", "blob_set__blob")
+# the fields which are not needed to create a LazyRecord
+LAZY_FIELDS = ("parameters", "stdout_stderr", "diff")
+
+
+class _LazyAttributeLoader(object):
+    """
+    Retrieves the lazy attributes of a chunk of records (see
+    :meth:`Record.lazy_attributes`), all at once, the first time that those
+    of any record in the chunk are needed.
+    """
+
+    def __init__(self, pks, using):
+        self.pks = pks
+        self.using = using
+        self.attributes = None
+
+    def __call__(self, pk):
+        if self.attributes is None:
+            chunk = Record.objects.using(self.using).filter(pk__in=self.pks).only(
+                *LAZY_FIELDS).select_related("parameters").prefetch_related(*PREFETCHED_FIELDS)
+            self.attributes = dict((db_record.pk, db_record.lazy_attributes())
+                                   for db_record in chunk)
+        return self.attributes.pop(pk)
+
+
+def _record_tags(db_records, using):
+    """
+    Return a dict containing the set of tag names for each of the given
+    records, keyed by primary key, retrieved in a single query.
+    """
+    tags = dict((db_record.pk, set()) for db_record in db_records)
+    tagged = RecordTag.objects.using(using).filter(record__in=list(tags))
+    for pk, name in tagged.values_list("record", "name"):
+        tags[pk].add(name)
+    return tags
+
+
+def records_to_sumatra(db_records, lazy=False):
+    """
+    Convert a queryset of :class:`Record` objects into a list of
+    :class:`sumatra.records.Record` objects.
+
+    Calling :meth:`Record.to_sumatra` for each record needs several queries
+    per record, to retrieve its data keys, dependencies, platforms and tags.
+    Here, the records are retrieved in chunks, and the related rows of all
+    the records in a chunk are retrieved together, so that the number of
+    queries does not depend on the number of records in a chunk.
+
+    If *lazy* is True, :class:`sumatra.records.LazyRecord` objects are
+    returned, and the lazy attributes of each chunk of records are only
+    retrieved when first needed.
+    """
+    using = db_records.db
+    pks = list(db_records.values_list("pk", flat=True))  # in the order of the queryset
+    datastores = {}
+    sumatra_records = []
+    for start in range(0, len(pks), BULK_CHUNK_SIZE):
+        chunk_pks = pks[start:start + BULK_CHUNK_SIZE]
+        chunk = Record.objects.using(using).filter(pk__in=chunk_pks)
+        if lazy:
+            chunk = chunk.defer(*LAZY_FIELDS).select_related(
+                *[name for name in RELATED_FIELDS if name not in LAZY_FIELDS])
+            loader = _LazyAttributeLoader(chunk_pks, using)
+        else:
+            chunk = chunk.select_related(*RELATED_FIELDS).prefetch_related(*PREFETCHED_FIELDS)
+        chunk = dict((db_record.pk, db_record) for db_record in chunk)
+        tags = _record_tags(list(chunk.values()), using)
+        for pk in chunk_pks:
+            load = lazy and functools.partial(loader, pk) or None
+            sumatra_records.append(chunk[pk].to_sumatra(tags=tags[pk], datastores=datastores,
+                                                        load=load))
+    return sumatra_records
@@ -13,28 +13,88 @@ and should both accept and return JSON-encoded data when the Accept header is
 
 The required JSON structure can be seen in recordstore.serialization.
 
+Servers may optionally support two further representations of the project
+resource, selected with the Accept header:
+
+"application/vnd.sumatra.record-list-v4+json"
+    a page of full records, ``{"records": [<record>, ...], "next": <url>}``,
+    controlled by the ``offset`` and ``limit`` query parameters, where "next"
+    is the URL of the following page, or null for the last page.
+"application/vnd.sumatra.label-list-v4+json"
+    a list of the labels of all records in the project, most recent first.
+"application/vnd.sumatra.digest-list-v4+json"
+    an object mapping the label of each record in the project to the digest
+    of its content, as calculated by recordstore.serialization.record_digest.
+
+Servers that support the record-list representation should also accept the
+following query parameters, which restrict and order the records in the list
+(see RecordStore.query): ``since`` and ``until`` (timestamps in the format
+"YYYY-MM-DD HH:MM:SS"), ``outcome``, ``user``, ``version``, ``main_file``,
+``parameters.<name>`` and ``order_by``.
+
+Servers that do not support these return the normal project representation,
+and the client falls back to retrieving records one at a time (and to
+filtering them itself).
+
+If the store is created with ``binary=True``, records are also requested in
+the compact binary format of :mod:`recordstore.binary`, which servers may
+optionally support:
+
+"application/vnd.sumatra.record-v4+smtb"
+    a single record, as written by binary.encode_record. Records are also
+    sent in this format when saving them; a server which does not accept it
+    should respond with status 415, and the client then falls back to JSON.
+"application/vnd.sumatra.record-list-v4+smtb"
+    a page of full records, as written by binary.dump_records, with the URL
+    of the following page, if any, in a ``Link: <url>; rel="next"`` header.
+
+The client decodes the response according to its Content-Type header.
+
 
 :copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
 :license: BSD 2-clause, see LICENSE for details.
 """
 from __future__ import unicode_literals
+from builtins import str
 from future import standard_library
 standard_library.install_aliases()
 
+import re
+import socket
+import time
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from queue import Queue, Empty
 from warnings import warn
-from urllib.parse import urlparse, urlunparse
+from urllib.parse import urlparse, urlunparse, quote, unquote
 try:
     import httplib2
     have_http = True
 except ImportError:
     have_http = False
-from sumatra.recordstore.base import RecordStore, RecordStoreAccessError
-from sumatra.recordstore import serialization
+from sumatra.recordstore.base import (RecordStore, RecordStoreAccessError, check_filters,
+                                      matches, matches_all_tags, sort_records, slice_records)
+from sumatra.recordstore import serialization, binary
 from ..core import conditional_component
 
 
 API_VERSION = 4
 
+if have_http:
+    CONNECTION_ERRORS = (socket.error, httplib2.HttpLib2Error)
+else:
+    CONNECTION_ERRORS = (socket.error,)
+
+
+BINARY_MEDIA_TYPES = ("record", "record-list")
+BINARY_SUFFIX = "+smtb"
+NEXT_LINK = re.compile(r'<([^>]*)>\s*;\s*rel="?next"?')
+
+
+def is_binary_response(response):
+    return response.get("content-type", "").split(";")[0].strip().endswith(BINARY_SUFFIX)
+
 
 def domain(url):
     return urlparse(url).netloc
@@ -56,6 +116,16 @@ def process_url(url):
     return url, username, password
 
 
+def add_query(url, **params):
+    """Append query parameters to a URL which may already have a query string."""
+    query = "&".join("%s=%s" % (name, quote(str(value), safe=","))
+                     for name, value in sorted(params.items()))
+    if "?" in url:
+        return "%s&%s" % (url, query)
+    else:
+        return "%s?%s" % (url, query)
+
+
 @conditional_component(condition=have_http)
 class HttpRecordStore(RecordStore):
     """
@@ -74,42 +144,122 @@ class HttpRecordStore(RecordStore):
     "application/json".
 
     The required JSON structure can be seen in :mod:`recordstore.serialization`.
+
+    If the server supports the "record-list" and "label-list" media types (see
+    the module documentation), :meth:`list` retrieves records in pages of
+    :attr:`batch_size` and :meth:`labels` needs only a single request.
+
+    Independent requests (e.g. when retrieving or saving many records during
+    :meth:`sync` or :meth:`import_`) are sent concurrently by up to
+    *max_workers* threads, each reusing a persistent (keep-alive) connection.
+    Requests that fail with a connection error or a 502, 503 or 504 response
+    are retried up to *max_retries* times, waiting *retry_backoff* seconds
+    before the first retry and twice as long before each subsequent one.
+    *timeout* is the socket timeout, in seconds, for each request.
+
+    If *binary* is True, records are transferred in the binary format of
+    :mod:`recordstore.binary` if the server supports it.
     """
+    batch_size = 1000
+    retry_statuses = (502, 503, 504)
 
     def __init__(self, server_url, username=None, password=None,
-                 disable_ssl_certificate_validation=True):
+                 disable_ssl_certificate_validation=True, max_workers=4,
+                 timeout=60, max_retries=3, retry_backoff=0.5, binary=False):
         self.server_url, _username, _password = process_url(server_url)
-        username = username or _username
-        password = password or _password
+        self._username = username or _username
+        self._password = password or _password
         if self.server_url[-1] != "/":
             self.server_url += "/"
-        self.client = httplib2.Http(
-            '.cache',
-            disable_ssl_certificate_validation=disable_ssl_certificate_validation
-        )
-        if username:
-            self.client.add_credentials(username, password, domain(self.server_url))
+        self.disable_ssl_certificate_validation = disable_ssl_certificate_validation
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.binary = binary
+        self._clients = Queue()
+        self.client = self._new_client()
+        self._clients.put(self.client)
 
     def __str__(self):
         return "Interface to remote record store at %s using HTTP" % self.server_url
 
     def __getstate__(self):
-        username = password = None
-        if self.client.credentials.credentials:
-            username = self.client.credentials.credentials[0][1]
-            password = self.client.credentials.credentials[0][2]
         return {
             'server_url': self.server_url,
-            'username': username,
-            'password': password,
+            'username': self._username,
+            'password': self._password,
+            'max_workers': self.max_workers,
+            'timeout': self.timeout,
+            'max_retries': self.max_retries,
+            'retry_backoff': self.retry_backoff,
+            'binary': self.binary,
         }
 
     def __setstate__(self, state):
-        self.__init__(state['server_url'], state['username'], state['password'])
+        self.__init__(**state)
+
+    def _new_client(self):
+        client = httplib2.Http(
+            '.cache',
+            disable_ssl_certificate_validation=self.disable_ssl_certificate_validation,
+            timeout=self.timeout
+        )
+        if self._username:
+            client.add_credentials(self._username, self._password, domain(self.server_url))
+        return client
+
+    @contextmanager
+    def _checkout_client(self):
+        """
+        Provide an HTTP client for the exclusive use of the current thread.
+
+        httplib2 clients are not thread-safe, so we keep a pool of them, each
+        of which holds its connections open between requests.
+        """
+        try:
+            client = self._clients.get_nowait()
+        except Empty:
+            client = self._new_client()
+        try:
+            yield client
+        finally:
+            self._clients.put(client)
+
+    def _request(self, url, method="GET", body=None, headers=None):
+        attempt = 0
+        while True:
+            try:
+                with self._checkout_client() as client:
+                    response, content = client.request(url, method, body, headers=headers)
+            except CONNECTION_ERRORS as err:
+                if attempt >= self.max_retries:
+                    raise RecordStoreAccessError("Could not access %s\n%s" % (url, err))
+            else:
+                if response.status not in self.retry_statuses or attempt >= self.max_retries:
+                    return response, content
+            time.sleep(self.retry_backoff * 2 ** attempt)
+            attempt += 1
+
+    def _map(self, func, items):
+        """Apply func to each of items, using up to max_workers concurrent threads."""
+        items = list(items)
+        if self.max_workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        pool = ThreadPool(min(self.max_workers, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
 
     def _get(self, url, media_type):
-        headers = {'Accept': 'application/vnd.sumatra.%s-v%d+json, application/json' % (media_type, API_VERSION)}
-        response, content = self.client.request(url, headers=headers)
+        accept = 'application/vnd.sumatra.%s-v%d+json, application/json' % (media_type, API_VERSION)
+        if self.binary and media_type in BINARY_MEDIA_TYPES:
+            accept = 'application/vnd.sumatra.%s-v%d%s, %s' % (media_type, API_VERSION,
+                                                               BINARY_SUFFIX, accept)
+        headers = {'Accept': accept}
+        response, content = self._request(url, headers=headers)
         return response, content
 
     def list_projects(self):
@@ -122,8 +272,7 @@ class HttpRecordStore(RecordStore):
         url = "%s%s/" % (self.server_url, project_name)
         data = serialization.encode_project_info(long_name, description)
         headers = {'Content-Type': 'application/vnd.sumatra.project-v%d+json' % API_VERSION}
-        response, content = self.client.request(url, 'PUT', data,
-                                                headers=headers)
+        response, content = self._request(url, 'PUT', data, headers=headers)
         return response, content
 
     def create_project(self, project_name, long_name='', description=''):
@@ -157,17 +306,34 @@ class HttpRecordStore(RecordStore):
         data = serialization.decode_project_data(content)
         return dict((k, data[k]) for k in ("name", "description"))
 
-    def save(self, project_name, record):
-        if not self.has_project(project_name):
-            self.create_project(project_name)
+    def _put_record(self, project_name, record):
         url = "%s%s/%s/" % (self.server_url, project_name, record.label)
+        if self.binary:
+            headers = {'Content-Type': 'application/vnd.sumatra.record-v%d%s' % (API_VERSION,
+                                                                                BINARY_SUFFIX)}
+            response, content = self._request(url, 'PUT', binary.encode_record(record),
+                                              headers=headers)
+            if response.status != 415:
+                if response.status not in (200, 201):
+                    raise RecordStoreAccessError("%d\n%s" % (response.status, content))
+                return
+            self.binary = False  # the server does not support the binary format
         headers = {'Content-Type': 'application/vnd.sumatra.record-v%d+json' % API_VERSION}
         data = serialization.encode_record(record)
-        response, content = self.client.request(url, 'PUT', data,
-                                                headers=headers)
+        response, content = self._request(url, 'PUT', data, headers=headers)
         if response.status not in (200, 201):
             raise RecordStoreAccessError("%d\n%s" % (response.status, content))
 
+    def save(self, project_name, record):
+        if not self.has_project(project_name):
+            self.create_project(project_name)
+        self._put_record(project_name, record)
+
+    def save_many(self, project_name, records):
+        if not self.has_project(project_name):
+            self.create_project(project_name)
+        self._map(partial(self._put_record, project_name), records)
+
     def _get_record(self, url):
         response, content = self._get(url, 'record')
         if response.status != 200:
@@ -175,39 +341,123 @@ class HttpRecordStore(RecordStore):
                 raise KeyError("No record was found at %s" % url)
             else:
                 raise RecordStoreAccessError("%d\n%s" % (response.status, content))
+        if is_binary_response(response):
+            return binary.decode_record(content)
         return serialization.decode_record(content)
 
     def get(self, project_name, label):
         url = "%s%s/%s/" % (self.server_url, project_name, label)
         return self._get_record(url)
 
-    def list(self, project_name, tags=None):
+    def get_many(self, project_name, labels):
+        return self._map(partial(self.get, project_name), labels)
+
+    def _list(self, url, limit=None):
+        """
+        Retrieve the records at the given project URL, following "next" links
+        until *limit* records have been retrieved. Returns the records, and a
+        flag saying whether the server supports the record-list media type.
+        """
+        records = []
+        batched = True
+        while url and (limit is None or len(records) < limit):
+            response, content = self._get(url, 'record-list')
+            if response.status != 200:
+                raise RecordStoreAccessError("Could not access %s\n%s: %s" % (url, response.status, content))
+            if is_binary_response(response):
+                records.extend(binary.decode_records(content))
+                match = NEXT_LINK.search(response.get("link", ""))
+                url = match and match.group(1)
+                continue
+            data = serialization.decode_project_data(content)
+            entries = data["records"]
+            if entries and not isinstance(entries[0], dict):
+                # the server does not support batches, and has given us the record URLs
+                batched = False
+                records.extend(self._map(self._get_record, entries))
+            else:
+                records.extend(serialization.build_record(entry) for entry in entries)
+            url = data.get("next")
+        return records, batched
+
+    def _tags_url(self, project_name, tags):
         project_url = "%s%s/" % (self.server_url, project_name)
         if tags:
             if not isinstance(tags, list):
                 tags = [tags]
             project_url += "?tags=%s" % ",".join(tags)
-        response, content = self._get(project_url, 'project')
+        return project_url
+
+    def list(self, project_name, tags=None):
+        url = add_query(self._tags_url(project_name, tags), offset=0, limit=self.batch_size)
+        return self._list(url)[0]
+
+    def query(self, project_name, order_by="-timestamp", limit=None, offset=0, **filters):
+        check_filters(filters)
+        if filters.get("all_tags"):
+            # the server can only select records that have any of several
+            # tags, so those records are retrieved and filtered here
+            other_filters = dict(filters, all_tags=None,
+                                 tags=filters.get("tags") or filters["all_tags"])
+            records = [record for record in self.query(project_name, order_by, **other_filters)
+                       if matches_all_tags(record.tags, filters["all_tags"])]
+            return slice_records(records, limit, offset)
+        params = dict((name, value) for name, value in filters.items()
+                      if value is not None
+                      and name not in ("tags", "all_tags", "since", "until", "parameters"))
+        for name in ("since", "until"):
+            if filters.get(name) is not None:
+                params[name] = filters[name].strftime("%Y-%m-%d %H:%M:%S")
+        for name, value in (filters.get("parameters") or {}).items():
+            params["parameters.%s" % name] = value
+        page_size = self.batch_size if limit is None else min(limit, self.batch_size)
+        url = add_query(self._tags_url(project_name, filters.get("tags")),
+                        order_by=order_by, offset=offset, limit=page_size, **params)
+        records, batched = self._list(url, limit)
+        if batched:
+            # the server has filtered, sorted and sliced the records
+            return records[:limit]
+        records = [record for record in records if matches(record, **filters)]
+        return slice_records(sort_records(records, order_by), limit, offset)
+
+    def labels(self, project_name):
+        project_url = "%s%s/" % (self.server_url, project_name)
+        response, content = self._get(project_url, 'label-list')
         if response.status != 200:
             raise RecordStoreAccessError("Could not access %s\n%s: %s" % (project_url, response.status, content))
-        record_urls = serialization.decode_project_data(content)["records"]
-        records = []
-        for record_url in record_urls:
-            records.append(self._get_record(record_url))
-        return records
+        data = serialization.decode_project_data(content)
+        if isinstance(data, list):
+            return data
+        # the server does not support label lists, so we extract the labels
+        # from the record URLs, only retrieving the record if that fails
+        labels = []
+        for record_url in data["records"]:
+            if record_url.startswith(project_url):
+                labels.append(unquote(record_url[len(project_url):].rstrip("/")))
+            else:
+                labels.append(self._get_record(record_url).label)
+        return labels
 
-    def labels(self, project_name):
-        return [record.label for record in self.list(project_name)]  # probably inefficient
+    def digests(self, project_name):
+        project_url = "%s%s/" % (self.server_url, project_name)
+        response, content = self._get(project_url, 'digest-list')
+        if response.status != 200:
+            raise RecordStoreAccessError("Could not access %s\n%s: %s" % (project_url, response.status, content))
+        data = serialization.decode_project_data(content)
+        if isinstance(data.get("records"), list):
+            # the server does not support digest lists, and has given us the project data
+            return super(HttpRecordStore, self).digests(project_name)
+        return data
 
     def delete(self, project_name, label):
         url = "%s%s/%s/" % (self.server_url, project_name, label)
-        response, deleted_content = self.client.request(url, 'DELETE')
+        response, deleted_content = self._request(url, 'DELETE')
         if response.status != 204:
             raise RecordStoreAccessError("%d\n%s" % (response.status, deleted_content))
 
     def delete_by_tag(self, project_name, tag):
         url = "%s%s/tag/%s/" % (self.server_url, project_name, tag)
-        response, n_records = self.client.request(url, 'DELETE')
+        response, n_records = self._request(url, 'DELETE')
         if response.status != 200:
             raise RecordStoreAccessError("%d\n%s" % (response.status, n_records))
         return int(n_records)
@@ -219,7 +469,7 @@ class HttpRecordStore(RecordStore):
     def sync(self, other, project_name):
         if not self.has_project(project_name):
             self.create_project(project_name)
-        super(HttpRecordStore, self).sync(other, project_name)
+        return super(HttpRecordStore, self).sync(other, project_name)
 
     def clear(self):
         warn("Cannot clear a remote record store directly. Contact the record store administrator")
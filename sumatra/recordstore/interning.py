@@ -0,0 +1,92 @@
+"""
+Sharing of identical sub-objects between the records loaded from a record
+store.
+
+The records of a project mostly share the same executable, repository, launch
+mode, data stores, platform information and dependencies. Rather than holding
+a separate copy of each of these objects for every record loaded into memory,
+the record stores replace them with a single shared instance, using
+:func:`intern_record`.
+
+Shared objects must therefore not be modified in place: to change, for
+example, the data store of one record, assign a modified copy of the data
+store to the record.
+
+
+:copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+from __future__ import unicode_literals
+
+import pickle
+import threading
+import weakref
+
+#: the record attributes holding objects which may be shared between records
+SHARED_ATTRIBUTES = ("executable", "repository", "launch_mode", "datastore", "input_datastore")
+#: the record attributes holding lists of objects which may be shared between records
+SHARED_LIST_ATTRIBUTES = ("dependencies", "platforms")
+
+_interned = weakref.WeakValueDictionary()
+_lock = threading.Lock()
+_shareable_types = None
+
+
+def is_shareable(obj):
+    """
+    Can *obj* be shared between records, i.e., is it an executable,
+    repository, launch mode, data store, platform information or dependency?
+    """
+    global _shareable_types
+    if _shareable_types is None:  # imported here to avoid circular imports
+        from sumatra.programs import Executable
+        from sumatra.versioncontrol.base import Repository
+        from sumatra.launch import LaunchMode, PlatformInformation
+        from sumatra.datastore.base import DataStore
+        from sumatra.dependency_finder.core import BaseDependency
+        _shareable_types = (Executable, Repository, LaunchMode, DataStore,
+                            PlatformInformation, BaseDependency)
+    return isinstance(obj, _shareable_types)
+
+
+def _key(obj):
+    state = obj.__getstate__()
+    if isinstance(state, dict):
+        state = sorted(state.items())
+    return (type(obj), pickle.dumps(state, protocol=2))
+
+
+def intern_object(obj):
+    """
+    Return an object identical to *obj*, which is shared with any other
+    record that contains an identical object. If there is no such object
+    already in memory, *obj* itself is returned, and will be shared in future.
+    """
+    if not is_shareable(obj):
+        return obj
+    try:
+        key = _key(obj)
+    except Exception:  # e.g. unpicklable options, or a partly-initialised object
+        return obj
+    with _lock:
+        shared = _interned.get(key)
+        if shared is None:
+            _interned[key] = shared = obj
+    return shared
+
+
+def intern_record(record):
+    """
+    Replace the sub-objects of *record* by shared instances (see
+    :func:`intern_object`), and return the record. Attributes of a
+    :class:`sumatra.records.LazyRecord` which have not been retrieved yet are
+    left alone.
+    """
+    attributes = record._attributes()
+    for name in SHARED_ATTRIBUTES:
+        if attributes.get(name) is not None:
+            setattr(record, name, intern_object(attributes[name]))
+    for name in SHARED_LIST_ATTRIBUTES:
+        if attributes.get(name):
+            setattr(record, name, [intern_object(obj) for obj in attributes[name]])
+    return record
@@ -9,10 +9,12 @@ from __future__ import unicode_literals
 from builtins import str
 
 import json
+import hashlib
 from datetime import datetime
 from sumatra import programs, launch, datastore, versioncontrol, parameters, dependency_finder
-from sumatra.records import Record
+from sumatra.records import Record, LazyRecord
 from ..core import get_registered_components
+from .interning import intern_record
 from sumatra.formatting import record2json, record2dict
 
 
@@ -20,6 +22,15 @@ def encode_record(record, indent=None):
     return record2json(record, indent)
 
 
+def record_digest(record):
+    """
+    Return a SHA1 hash of the content of a record, which may be used to check
+    whether two records are identical without comparing them field by field.
+    """
+    content = json.dumps(record2dict(record), sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
 def encode_project_info(long_name, description):
     """Encode a Sumatra project as JSON"""
     data = {}
@@ -148,7 +159,24 @@ def build_record(data):
         dep = getattr(dependency_finder, depdata["module"]).Dependency(*dep_args)
         record.dependencies.append(dep)
     record.repeats = data.get("repeats", None)
-    return record
+    return intern_record(record)
+
+
+# values used for the lazy attributes of a record while building a LazyRecord
+_PLACEHOLDERS = {"parameters": {"type": "dict", "content": "{}"}, "input_data": [],
+                 "output_data": [], "stdout_stderr": "", "diff": "", "dependencies": [],
+                 "platforms": []}
+
+
+def build_lazy_record(data, load):
+    """
+    Create a :class:`LazyRecord` from a nested dictionary from which the
+    entries for the lazy attributes (see :data:`sumatra.records.LAZY_ATTRIBUTES`)
+    may have been left out. *load* is a function returning the complete
+    dictionary, which is called when one of these attributes is first needed.
+    """
+    record = build_record(dict(_PLACEHOLDERS, **data))
+    return LazyRecord(record, lambda: build_record(load())._attributes())
 
 
 def decode_record(content):
@@ -159,3 +187,75 @@ def decode_record(content):
 def decode_records(content):
     """Create multiple Sumatra records from a JSON string."""
     return [build_record(data) for data in json.loads(content)]
+
+
+def dump_records(records, fp, indent=None):
+    """
+    Write records to a file-like object as a JSON array, one record at a time.
+
+    `records` may be any iterable, so the records need not all be held in
+    memory at once. The output can be read by :func:`decode_records` or, with
+    bounded memory, by :func:`load_records`.
+    """
+    fp.write("[")
+    separator = "\n"
+    for record in records:
+        fp.write(separator)
+        fp.write(encode_record(record, indent=indent))
+        separator = ",\n"
+    fp.write("\n]\n")
+
+
+def load_records(fp, chunk_size=65536):
+    """
+    Create Sumatra records one at a time from a file-like object containing a
+    JSON array of records.
+
+    This is a generator: only one record, and the text of at most one record,
+    is held in memory at any time.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    at_end_of_file = False
+    expected = "["
+    while True:
+        # skip whitespace and the array punctuation between records
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer) or at_end_of_file:
+                break
+            buffer = fp.read(chunk_size)
+            position = 0
+            at_end_of_file = not buffer
+        if position == len(buffer):
+            raise ValueError("Unexpected end of file: incomplete JSON array")
+        char = buffer[position]
+        if char == "]" and expected != "[":
+            return
+        elif char == expected:
+            position += 1
+            expected = "record"
+            continue
+        elif expected == "[":
+            raise ValueError("Expected a JSON array of records")
+        elif expected == ",":
+            raise ValueError("Expected ',' or ']' between records, found %r" % char)
+        # decode the next record, reading more of the file until it is complete
+        buffer = buffer[position:]
+        position = 0
+        while True:
+            try:
+                data, position = decoder.raw_decode(buffer)
+                break
+            except ValueError:
+                if at_end_of_file:
+                    raise
+                # read at least as much again as we already have, so that
+                # large records are not re-parsed too many times
+                more = fp.read(max(chunk_size, len(buffer)))
+                at_end_of_file = not more
+                buffer += more
+        expected = ","
+        yield build_record(data)
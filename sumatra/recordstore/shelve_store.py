@@ -2,6 +2,24 @@
 Handles storage of simulation/analysis records based on the Python standard
 shelve module.
 
+Each record is stored under its own key, together with a small per-project
+index containing the label, timestamp, tags and digest of every record, so that
+saving, retrieving or deleting a record does not require unpickling all the
+other records in the project. Shelves created by older versions of Sumatra,
+which stored all the records of a project as a single pickled dict, are
+converted to this layout when they are opened.
+
+The executable, repository, launch mode, data stores, platform information
+and dependencies of a record are usually the same as for many other records,
+so each distinct object is pickled once, under its own key, and the pickled
+records refer to it by its digest (see :mod:`sumatra.recordstore.interning`).
+Large outputs and diffs are likewise stored once, compressed, under their
+digest (see :mod:`sumatra.recordstore.blobs`), and are only unpickled when
+they are needed. Since finding out whether a shared object or blob is still
+used means examining every record, these are not removed when records are
+deleted, but by :meth:`ShelveRecordStore.collect_garbage`, which
+:command:`smt delete` calls once all the records have been deleted.
+
 :copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
 :license: BSD 2-clause, see LICENSE for details.
 """
@@ -9,12 +27,57 @@ from __future__ import unicode_literals
 from builtins import str
 
 import os
+import pickle
 import shelve
+import hashlib
+from io import BytesIO
 from datetime import datetime
-from sumatra.recordstore.base import RecordStore
+from sumatra.recordstore.base import (RecordStore, check_filters, parse_order_by, matches,
+                                      matches_tags, matches_all_tags, sort_records, slice_records)
+from sumatra.recordstore.serialization import record_digest
+from sumatra.recordstore.interning import is_shareable, intern_object, intern_record
+from sumatra.recordstore import blobs
+from sumatra.records import LazyRecord, LAZY_ATTRIBUTES
 from ..core import component
 
 
+# Project names may not contain colons (see Project.valid_name_pattern), so
+# these prefixes cannot clash with the project keys used by the old layout.
+LAYOUT_KEY = "meta:layout"
+#: 1: a single dict of records per project (Sumatra 0.7 and earlier, no layout key)
+#: 2: a record per key, with a (timestamp, tags) index per project
+#: 3: as 2, with the record digest added to the index entries
+LAYOUT_VERSION = 3
+
+
+def _index_key(project_name):
+    return "index:%s" % project_name
+
+
+def _record_key(project_name, label):
+    return "record:%s:%s" % (project_name, label)
+
+
+def _object_key(digest):
+    return "object:%s" % digest
+
+
+def _blob_key(digest):
+    return "blob:%s" % digest
+
+
+class _BlobReference(object):
+    """Stands in for a blob in an unpickled record, until it is retrieved."""
+
+    def __init__(self, digest):
+        self.digest = digest
+
+
+def _index_entry(record):
+    """Return the information about a record that is kept in the project index."""
+    return (record.timestamp, frozenset(record.tags), record_digest(record))
+
+
 def check_name(f):
     """
     Some backends to shelve do not accept unicode variables as keys.
@@ -22,9 +85,9 @@ def check_name(f):
     before calling the wrapped method. See http://bugs.python.org/issue1036490
     """
 
-    def wrapped(self, project_name, *args):
+    def wrapped(self, project_name, *args, **kwargs):
         project_name = project_name.__str__()
-        return f(self, project_name, *args)
+        return f(self, project_name, *args, **kwargs)
     return wrapped
 
 
@@ -48,6 +111,13 @@ class ShelveRecordStore(RecordStore):
         initial_dir_contents = set(os.listdir(dir))
         self.shelf = shelve.open(shelf_name)
         self._shelf_files = set(os.listdir(dir)).difference(initial_dir_contents)
+        self._objects = {}  # shared objects which have been loaded or saved, by digest
+        layout = self.shelf.get(LAYOUT_KEY, 1)
+        if layout > LAYOUT_VERSION:
+            raise Exception("The record store %s was created by a newer version of Sumatra "
+                            "(layout version %s)" % (shelf_name, layout))
+        if layout < LAYOUT_VERSION:
+            self.upgrade_layout(layout)
 
     def __del__(self):
         if hasattr(self, "shelf"):
@@ -62,66 +132,256 @@ class ShelveRecordStore(RecordStore):
     def __setstate__(self, state):
         self.__init__(**state)
 
+    def upgrade_layout(self, from_version=1):
+        """
+        Convert a shelf written with an earlier layout (see
+        :data:`LAYOUT_VERSION`) to the current one.
+        """
+        if from_version < 2:
+            self._split_projects()
+        elif from_version < 3:
+            self._add_digests_to_index()
+        self.shelf[LAYOUT_KEY] = LAYOUT_VERSION
+        self.shelf.sync()
+
+    def _split_projects(self):
+        """
+        Convert a shelf in which each project is stored as a single dict of
+        records (Sumatra 0.7 and earlier) to the per-record layout.
+        """
+        for key in list(self.shelf.keys()):
+            key = str(key)
+            if ":" in key:
+                continue
+            records = self.shelf[key]
+            if not isinstance(records, dict):
+                continue
+            index = {}
+            for label, record in records.items():
+                self.shelf[_record_key(key, label)] = self._dump_record(record)
+                index[label] = _index_entry(record)
+            self.shelf[_index_key(key)] = index
+            del self.shelf[key]
+
+    def _add_digests_to_index(self):
+        """Add the digest of each record to the (timestamp, tags) project indexes."""
+        for project_name in self.list_projects():
+            index = self._get_index(project_name)
+            for label, (timestamp, tags) in index.items():
+                record = self._load_record(project_name, label)
+                index[label] = (timestamp, tags, record_digest(record))
+            self.shelf[_index_key(project_name)] = index
+
+    def _dump_record(self, record):
+        """
+        Pickle a record, storing each of its shareable sub-objects and blobs
+        under its own key, unless an identical one has been stored already.
+        """
+        texts = blobs.extract_blobs(dict((name, getattr(record, name))
+                                         for name in blobs.BLOB_ATTRIBUTES))
+        # the pickler is given the same string objects as are found here
+        blob_ids = dict((id(text), ("blob", self._save_blob(text))) for text in texts.values())
+
+        def persistent_id(obj):
+            if id(obj) in blob_ids:
+                return blob_ids[id(obj)]
+            if not is_shareable(obj):
+                return None
+            content = pickle.dumps(obj, protocol=2)
+            digest = hashlib.sha1(content).hexdigest()
+            # the object may have been removed by collect_garbage(), even if it is in self._objects
+            if _object_key(digest) not in self.shelf:
+                self.shelf[_object_key(digest)] = content
+            self._objects.setdefault(digest, obj)
+            return digest
+        buffer = BytesIO()
+        pickler = pickle.Pickler(buffer, protocol=2)
+        pickler.persistent_id = persistent_id
+        pickler.dump(record)
+        return buffer.getvalue()
+
+    def _save_blob(self, text):
+        digest = blobs.blob_digest(text)
+        if _blob_key(digest) not in self.shelf:
+            self.shelf[_blob_key(digest)] = blobs.compress(text)
+        return digest
+
+    def _load_object(self, digest):
+        if isinstance(digest, tuple):  # ("blob", digest)
+            return _BlobReference(digest[1])
+        obj = self._objects.get(digest)
+        if obj is None:
+            obj = intern_object(pickle.loads(self.shelf[_object_key(digest)]))
+            self._objects[digest] = obj
+        return obj
+
+    def _load_record(self, project_name, label):
+        content = self.shelf[_record_key(project_name, label)]
+        if not isinstance(content, bytes):  # a Record, stored by an earlier version
+            return intern_record(content)
+        unpickler = pickle.Unpickler(BytesIO(content))
+        unpickler.persistent_load = self._load_object
+        record = unpickler.load()
+        references = dict((name, getattr(record, name).digest) for name in blobs.BLOB_ATTRIBUTES
+                          if isinstance(getattr(record, name, None), _BlobReference))
+        if not references:
+            return record
+        values = dict((name, getattr(record, name)) for name in LAZY_ATTRIBUTES
+                      if name not in references and hasattr(record, name))
+
+        def load():
+            for name, digest in references.items():
+                values[name] = blobs.decompress(self.shelf[_blob_key(digest)])
+            return values
+        return LazyRecord(record, load)
+
+    def _get_index(self, project_name):
+        return self.shelf.get(_index_key(project_name), {})
+
     def list_projects(self):
-        return [str(key) for key in self.shelf.keys()]
+        n = len(_index_key(""))
+        return [str(key)[n:] for key in self.shelf.keys()
+                if str(key).startswith(_index_key(""))]
 
     @check_name
     def save(self, project_name, record):
-        if project_name in self.shelf:
-            records = self.shelf[project_name]
-        else:
-            records = {}
-        records[record.label] = record
-        self.shelf[project_name] = records
+        index = self._get_index(project_name)
+        index[record.label] = _index_entry(record)
+        self.shelf[_record_key(project_name, record.label)] = self._dump_record(record)
+        self.shelf[_index_key(project_name)] = index
 
     @check_name
     def get(self, project_name, label):
-        return self.shelf[project_name][label]
+        return self._load_record(project_name, label)
 
     @check_name
     def list(self, project_name, tags=None):
-        if project_name in self.shelf:
-            if tags:
-                if not isinstance(tags, list):
-                    tags = [tags]
-                records = [record for record in self.shelf[project_name].values()
-                           if any([tag in record.tags for tag in tags])]
-            else:
-                records = list(self.shelf[project_name].values())
+        index = self._get_index(project_name)
+        if tags:
+            if not isinstance(tags, list):
+                tags = [tags]
+            labels = [label for label, (timestamp, record_tags, digest) in index.items()
+                      if any([tag in record_tags for tag in tags])]
         else:
-            records = []
-        return records
+            labels = index.keys()
+        return [self._load_record(project_name, label) for label in labels]
+
+    @check_name
+    def query(self, project_name, order_by="-timestamp", limit=None, offset=0, **filters):
+        check_filters(filters)
+        since = filters.get("since")
+        until = filters.get("until")
+        entries = [(label, timestamp)
+                   for label, (timestamp, tags, digest) in self._get_index(project_name).items()
+                   if matches_tags(tags, filters.get("tags"))
+                   and matches_all_tags(tags, filters.get("all_tags"))
+                   and (since is None or timestamp >= since)
+                   and (until is None or timestamp <= until)]
+        attribute, reverse = parse_order_by(order_by)
+        remaining = [name for name, value in filters.items()
+                     if value is not None and name not in ("tags", "all_tags", "since", "until")]
+        if attribute in ("label", "timestamp") and not remaining:
+            # everything needed is in the index, so only the requested
+            # records need to be loaded
+            position = 0 if attribute == "label" else 1
+            entries.sort(key=lambda entry: entry[position], reverse=reverse)
+            labels = slice_records([label for label, timestamp in entries], limit, offset)
+            return [self._load_record(project_name, label) for label in labels]
+        records = [self._load_record(project_name, label) for label, timestamp in entries]
+        records = [record for record in records if matches(record, **filters)]
+        return slice_records(sort_records(records, order_by), limit, offset)
 
     @check_name
     def labels(self, project_name):
-        if project_name in self.shelf:
-            return list(self.shelf[project_name].keys())
-        else:
-            return []
+        index = self._get_index(project_name)
+        return sorted(index, key=lambda label: index[label][0], reverse=True)
+
+    @check_name
+    def digests(self, project_name):
+        return dict((label, digest)
+                    for label, (timestamp, tags, digest) in self._get_index(project_name).items())
+
+    @check_name
+    def tag_counts(self, project_name):
+        counts = {}
+        for timestamp, tags, digest in self._get_index(project_name).values():
+            for tag in tags:
+                counts[tag] = counts.get(tag, 0) + 1
+        return counts
 
     @check_name
     def delete(self, project_name, label):
-        records = self.shelf[project_name]
-        records.pop(label)
-        self.shelf[project_name] = records
+        index = self.shelf[_index_key(project_name)]
+        index.pop(label)
+        del self.shelf[_record_key(project_name, label)]
+        self.shelf[_index_key(project_name)] = index
 
     @check_name
     def delete_by_tag(self, project_name, tag):
-        for_deletion = [record for record in self.shelf[project_name].values() if tag in record.tags]
-        for record in for_deletion:
-            self.delete(project_name, record.label)
+        index = self.shelf[_index_key(project_name)]
+        for_deletion = [label for label, (timestamp, tags, digest) in index.items() if tag in tags]
+        for label in for_deletion:
+            index.pop(label)
+            del self.shelf[_record_key(project_name, label)]
+        self.shelf[_index_key(project_name)] = index
         return len(for_deletion)
 
+    def _references(self, content):
+        """
+        Return the digests of the shared objects, and of the blobs, referred
+        to by a pickled record.
+        """
+        objects, blobs_ = set(), set()
+        if not isinstance(content, bytes):  # a Record, stored by an earlier version
+            return objects, blobs_
+
+        def persistent_load(pid):
+            if isinstance(pid, tuple):  # ("blob", digest)
+                blobs_.add(pid[1])
+            else:
+                objects.add(pid)
+            return pid
+        unpickler = pickle.Unpickler(BytesIO(content))
+        unpickler.persistent_load = persistent_load
+        unpickler.load()
+        return objects, blobs_
+
+    def collect_garbage(self):
+        """
+        Remove the shared objects and blobs which are no longer used by any
+        record, and return the number removed.
+        """
+        used_objects, used_blobs = set(), set()
+        keys = [str(key) for key in self.shelf.keys()]
+        for key in keys:
+            if key.startswith("record:"):
+                objects, blobs_ = self._references(self.shelf[key])
+                used_objects.update(objects)
+                used_blobs.update(blobs_)
+        unused = ([key for key in keys if key.startswith(_object_key(""))
+                   and key[len(_object_key("")):] not in used_objects] +
+                  [key for key in keys if key.startswith(_blob_key(""))
+                   and key[len(_blob_key("")):] not in used_blobs])
+        for key in unused:
+            del self.shelf[key]
+            self._objects.pop(key[len(_object_key("")):], None)
+        self.shelf.sync()
+        return len(unused)
+
     @check_name
     def most_recent(self, project_name):
         most_recent = None
         most_recent_timestamp = datetime.min
-        for record in self.shelf[project_name].values():
-            if record.timestamp > most_recent_timestamp:
-                most_recent_timestamp = record.timestamp
-                most_recent = record.label
+        for label, (timestamp, tags, digest) in self.shelf[_index_key(project_name)].items():
+            if timestamp > most_recent_timestamp:
+                most_recent_timestamp = timestamp
+                most_recent = label
         return most_recent
 
+    @check_name
+    def has_project(self, project_name):
+        return _index_key(project_name) in self.shelf
+
     def clear(self):
         for path in self._shelf_files:
             os.remove(path)
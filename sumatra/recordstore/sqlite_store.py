@@ -0,0 +1,355 @@
+"""
+Handles storage of simulation/analysis records in an SQLite database, using
+the Python standard :mod:`sqlite3` module directly rather than going through
+the Django ORM.
+
+Each record is stored as a JSON document (see
+:mod:`sumatra.recordstore.serialization`), alongside indexed columns for the
+fields that are used for looking records up, and a separate table of tags.
+Large outputs and diffs are stored, compressed, in a table of blobs shared
+between records (see :mod:`sumatra.recordstore.blobs`).
+
+
+:copyright: Copyright 2006-2015 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+from __future__ import unicode_literals
+from builtins import str
+
+import os
+import json
+import sqlite3
+from sumatra.recordstore.base import (RecordStore, check_filters, parse_order_by, matches,
+                                      slice_records)
+from sumatra.recordstore import serialization, blobs
+from sumatra.formatting import record2dict
+from sumatra.records import LAZY_ATTRIBUTES
+from ..core import component
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS record (
+    project TEXT NOT NULL,
+    label TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    main_file TEXT,
+    version TEXT,
+    user TEXT,
+    outcome TEXT,
+    digest TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (project, label)
+);
+CREATE INDEX IF NOT EXISTS record_timestamp ON record (project, timestamp);
+CREATE INDEX IF NOT EXISTS record_main_file ON record (project, main_file);
+CREATE INDEX IF NOT EXISTS record_version ON record (project, version);
+CREATE TABLE IF NOT EXISTS tag (
+    project TEXT NOT NULL,
+    label TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (project, name, label),
+    FOREIGN KEY (project, label) REFERENCES record (project, label) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS tag_record ON tag (project, label);
+CREATE TABLE IF NOT EXISTS blob (
+    digest TEXT PRIMARY KEY,
+    content BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS record_blob (
+    project TEXT NOT NULL,
+    label TEXT NOT NULL,
+    name TEXT NOT NULL,
+    digest TEXT NOT NULL REFERENCES blob (digest),
+    PRIMARY KEY (project, label, name),
+    FOREIGN KEY (project, label) REFERENCES record (project, label) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS record_blob_digest ON record_blob (digest);
+"""
+
+# the timestamp column is compared as text, so it must have a fixed-width format
+TIMESTAMP_COLUMN_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# record attributes that have their own column, and can therefore be used for
+# filtering and sorting in SQL
+COLUMNS = ("label", "timestamp", "main_file", "version", "user", "outcome")
+
+
+@component
+class SQLiteRecordStore(RecordStore):
+    """
+    Handles storage of simulation/analysis records in an SQLite database,
+    without requiring Django.
+
+    The label, timestamp, main file, version and tags of each record are
+    indexed, so that listing, filtering by tag and finding the most recent
+    record do not require decoding every record in the project. Identical
+    large outputs and diffs are stored only once.
+
+    By default the database is put into write-ahead-logging (WAL) mode, which
+    allows records to be read while another process is writing to the
+    database. Set *wal* to False if the database is on a network filesystem,
+    where WAL mode is not supported.
+    """
+
+    def __init__(self, db_file=".smt/records.sqlite", wal=True, timeout=30.0):
+        if db_file.startswith("sqlite://"):
+            db_file = db_file[len("sqlite://"):]
+        self._db_file = db_file
+        self._wal = wal
+        self._timeout = timeout
+        dir = os.path.dirname(os.path.abspath(db_file))
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        self._connection = sqlite3.connect(db_file, timeout=timeout)
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        if wal:
+            self._connection.execute("PRAGMA journal_mode = WAL")
+        with self._connection:
+            self._connection.executescript(SCHEMA)
+        try:
+            self._connection.execute("SELECT json_remove('{}', '$.a')")
+            self._lazy = True
+        except sqlite3.OperationalError:  # SQLite was built without JSON support
+            self._lazy = False
+
+    def __del__(self):
+        if hasattr(self, "_connection"):
+            self._connection.close()
+
+    def __str__(self):
+        return "Record store using SQLite (database file=%s)" % self._db_file
+
+    def __getstate__(self):
+        return {'db_file': self._db_file, 'wal': self._wal, 'timeout': self._timeout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _execute(self, sql, *args):
+        return self._connection.execute(sql, args)
+
+    def list_projects(self):
+        return [str(row[0]) for row in self._execute("SELECT DISTINCT project FROM record")]
+
+    def save(self, project_name, record):
+        # a lazy record may need to retrieve its attributes from the row
+        # that is about to be replaced, so it is encoded first
+        digest = serialization.record_digest(record)
+        data = record2dict(record)
+        texts = blobs.extract_blobs(data)
+        data = json.dumps(data)
+        with self._connection:
+            replaced = [row[0] for row in self._execute(
+                "SELECT digest FROM record_blob WHERE project = ? AND label = ?",
+                project_name, record.label)]
+            self._execute("DELETE FROM record WHERE project = ? AND label = ?",
+                          project_name, record.label)
+            self._execute("INSERT INTO record (project, label, timestamp, main_file, version, "
+                          "user, outcome, digest, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          project_name, record.label,
+                          record.timestamp.strftime(TIMESTAMP_COLUMN_FORMAT),
+                          record.main_file, record.version, record.user,
+                          record.outcome or "", digest, data)
+            self._connection.executemany("INSERT INTO tag (project, label, name) VALUES (?, ?, ?)",
+                                         [(project_name, record.label, tag) for tag in record.tags])
+            for name, text in texts.items():
+                blob_digest = self._save_blob(text)
+                self._execute("INSERT INTO record_blob (project, label, name, digest) "
+                              "VALUES (?, ?, ?, ?)", project_name, record.label, name, blob_digest)
+            self._delete_unused_blobs(replaced)
+
+    def _save_blob(self, text):
+        digest = blobs.blob_digest(text)
+        if self._execute("SELECT 1 FROM blob WHERE digest = ?", digest).fetchone() is None:
+            self._execute("INSERT INTO blob (digest, content) VALUES (?, ?)",
+                          digest, sqlite3.Binary(blobs.compress(text)))
+        return digest
+
+    def _delete_unused_blobs(self, digests=None):
+        """
+        Delete the blobs which are no longer used by any record, considering
+        only the given digests, if any.
+        """
+        sql = ("DELETE FROM blob WHERE NOT EXISTS "
+               "(SELECT 1 FROM record_blob WHERE record_blob.digest = blob.digest)")
+        if digests is None:
+            self._execute(sql)
+        elif digests:
+            self._execute(sql + " AND digest IN (%s)" % ", ".join("?" * len(digests)), *digests)
+
+    def _load_data(self, project_name, content):
+        """Return the nested dict for a record from its data column, with its blobs."""
+        data = json.loads(content)
+        for name, blob in self._execute(
+                "SELECT record_blob.name, blob.content FROM record_blob "
+                "JOIN blob ON blob.digest = record_blob.digest "
+                "WHERE record_blob.project = ? AND record_blob.label = ?",
+                project_name, data["label"]):
+            data[name] = blobs.decompress(blob)
+        return data
+
+    def get(self, project_name, label):
+        row = self._execute("SELECT data FROM record WHERE project = ? AND label = ?",
+                            project_name, label).fetchone()
+        if row is None:
+            raise KeyError(label)
+        return serialization.build_record(self._load_data(project_name, row[0]))
+
+    def _list_column(self):
+        """
+        Return the SQL expression for the record data to be retrieved when
+        listing records: if possible, the data without the lazy attributes.
+        """
+        if self._lazy:
+            return "json_remove(data, %s)" % ", ".join("'$.%s'" % name for name in LAZY_ATTRIBUTES)
+        return "data"
+
+    def _decode_listed(self, project_name, content):
+        """Create a record from the data retrieved using :meth:`_list_column`."""
+        if not self._lazy:
+            return serialization.build_record(self._load_data(project_name, content))
+        data = json.loads(content)
+        label = data["label"]
+
+        def load():
+            row = self._execute("SELECT data FROM record WHERE project = ? AND label = ?",
+                                project_name, label).fetchone()
+            if row is None:  # deleted since it was listed
+                raise KeyError(label)
+            return self._load_data(project_name, row[0])
+        return serialization.build_lazy_record(data, load)
+
+    def list(self, project_name, tags=None):
+        if tags:
+            if not isinstance(tags, list):
+                tags = [tags]
+            cursor = self._execute(
+                "SELECT %s FROM record WHERE project = ? AND label IN "
+                "(SELECT label FROM tag WHERE project = ? AND name IN (%s)) "
+                "ORDER BY timestamp DESC" % (self._list_column(), ", ".join("?" * len(tags))),
+                project_name, project_name, *tags)
+        else:
+            cursor = self._execute("SELECT %s FROM record WHERE project = ? "
+                                   "ORDER BY timestamp DESC" % self._list_column(),
+                                   project_name)
+        return [self._decode_listed(project_name, row[0]) for row in cursor]
+
+    def query(self, project_name, order_by="-timestamp", limit=None, offset=0, **filters):
+        check_filters(filters)
+        where = ["project = ?"]
+        args = [project_name]
+        tags = filters.get("tags")
+        if tags:
+            if not isinstance(tags, list):
+                tags = [tags]
+            where.append("label IN (SELECT label FROM tag WHERE project = ? AND name IN (%s))"
+                         % ", ".join("?" * len(tags)))
+            args.append(project_name)
+            args.extend(tags)
+        all_tags = filters.get("all_tags")
+        if all_tags:
+            if not isinstance(all_tags, list):
+                all_tags = [all_tags]
+            for tag in all_tags:
+                where.append("label IN (SELECT label FROM tag WHERE project = ? AND name = ?)")
+                args.extend([project_name, tag])
+        for name, operator in (("since", ">="), ("until", "<=")):
+            if filters.get(name) is not None:
+                where.append("timestamp %s ?" % operator)
+                args.append(filters[name].strftime(TIMESTAMP_COLUMN_FORMAT))
+        if filters.get("outcome") is not None:
+            where.append("outcome LIKE ? ESCAPE '\\'")
+            outcome = filters["outcome"]
+            for special in ("\\", "%", "_"):
+                outcome = outcome.replace(special, "\\" + special)
+            args.append("%%%s%%" % outcome)
+        for name in ("user", "version", "main_file"):
+            if filters.get(name) is not None:
+                where.append("%s = ?" % name)
+                args.append(filters[name])
+        attribute, reverse = parse_order_by(order_by)
+        if attribute not in COLUMNS:
+            raise ValueError("Cannot order records by '%s'" % attribute)
+        sql = "SELECT %%s FROM record WHERE %s ORDER BY %s %s" % (
+            " AND ".join(where), attribute, reverse and "DESC" or "ASC")
+        parameters = filters.get("parameters")
+        if parameters:
+            # parameter sets are only stored within the JSON document
+            records = [serialization.build_record(self._load_data(project_name, row[0]))
+                       for row in self._execute(sql % "data", *args)]
+            records = [record for record in records if matches(record, parameters=parameters)]
+            return slice_records(records, limit, offset)
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            args.extend([-1 if limit is None else limit, offset])
+        return [self._decode_listed(project_name, row[0])
+                for row in self._execute(sql % self._list_column(), *args)]
+
+    def iter_records(self, project_name):
+        # the cursor fetches rows from the database as they are needed
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT data FROM record WHERE project = ? ORDER BY timestamp DESC",
+                       (project_name,))
+        for row in cursor:
+            yield serialization.build_record(self._load_data(project_name, row[0]))
+
+    def labels(self, project_name):
+        return [row[0] for row in self._execute("SELECT label FROM record WHERE project = ? "
+                                                "ORDER BY timestamp DESC", project_name)]
+
+    def digests(self, project_name):
+        return dict(self._execute("SELECT label, digest FROM record WHERE project = ?",
+                                  project_name))
+
+    def tag_counts(self, project_name):
+        return dict(self._execute("SELECT name, COUNT(*) FROM tag WHERE project = ? GROUP BY name",
+                                  project_name))
+
+    def delete(self, project_name, label):
+        with self._connection:
+            cursor = self._execute("DELETE FROM record WHERE project = ? AND label = ?",
+                                   project_name, label)
+            self._delete_unused_blobs()
+        if cursor.rowcount == 0:
+            raise KeyError(label)
+
+    def delete_all(self):
+        """Delete all records from the store."""
+        with self._connection:
+            self._execute("DELETE FROM record")
+            self._execute("DELETE FROM blob")
+
+    def delete_by_tag(self, project_name, tag):
+        with self._connection:
+            cursor = self._execute("DELETE FROM record WHERE project = ? AND label IN "
+                                   "(SELECT label FROM tag WHERE project = ? AND name = ?)",
+                                   project_name, project_name, tag)
+            n = cursor.rowcount
+            self._delete_unused_blobs()
+        return n
+
+    def most_recent(self, project_name):
+        row = self._execute("SELECT label FROM record WHERE project = ? "
+                            "ORDER BY timestamp DESC LIMIT 1", project_name).fetchone()
+        return row and row[0]
+
+    def has_project(self, project_name):
+        row = self._execute("SELECT 1 FROM record WHERE project = ? LIMIT 1",
+                            project_name).fetchone()
+        return row is not None
+
+    def clear(self):
+        """
+        Drop all Sumatra-related tables from the database.
+
+        WARNING: this will delete all data. Make sure you have a backup first.
+        """
+        with self._connection:
+            self._connection.executescript("DROP TABLE IF EXISTS tag; DROP TABLE IF EXISTS record_blob; "
+                                             "DROP TABLE IF EXISTS blob; DROP TABLE IF EXISTS record;")
+        with self._connection:
+            self._connection.executescript(SCHEMA)
+
+    @classmethod
+    def accepts_uri(cls, uri):
+        return uri.startswith("sqlite://") or os.path.splitext(uri)[1] in (".sqlite", ".sqlite3")
@@ -11,8 +11,13 @@ from builtins import str
 import ast
 
 
+import re
 import mimetypes
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:  # Django < 1.5
+    StreamingHttpResponse = HttpResponse
 from django.shortcuts import render_to_response
 from django.views.generic.list import ListView
 try:
@@ -23,12 +28,15 @@ except ImportError:  # older versions of Django
 import json
 import os.path
 from django.views.generic import View, DetailView
-from tagging.models import Tag
 from sumatra.recordstore.serialization import datestring_to_datetime
-from sumatra.recordstore.django_store.models import Project, Record, DataKey, Datastore
+from sumatra.recordstore.django_store.models import (Project, Record, DataKey, Datastore,
+                                                     tag_counts)
 from sumatra.records import RecordDifference
+from sumatra.datastore.line_index import get_line_index
 
 DEFAULT_MAX_DISPLAY_LENGTH = 10 * 1024
+DEFAULT_PREVIEW_LINES = 200
+BYTE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
 global_conf_file = os.path.expanduser(os.path.join("~", ".smtrc"))
 mimetypes.init()
 
@@ -64,12 +72,14 @@ class RecordListView(ListView):
     template_name = 'record_list.html'
 
     def get_queryset(self):
-        return Record.objects.filter(project__id=self.kwargs["project"]).order_by('-timestamp')
+        return Record.objects.filter(project__id=self.kwargs["project"]).order_by(
+            '-timestamp').prefetch_related('tag_set', 'blob_set')
 
     def get_context_data(self, **kwargs):
         context = super(RecordListView, self).get_context_data(**kwargs)
         context['project'] = Project.objects.get(pk=self.kwargs["project"])
-        context['tags'] = Tag.objects.all()  # would be better to filter, to return only tags used in this project.
+        counts = tag_counts(Record.objects.filter(project__id=self.kwargs["project"]))
+        context['tags'] = [{'name': name, 'count': counts[name]} for name in sorted(counts)]
         return context
 
 
@@ -97,11 +107,15 @@ class RecordDetailView(DetailView):
 
     def post(self, request, *args, **kwargs):
         record = self.get_object()
-        for attr in ("reason", "outcome", "tags"):
+        for attr in ("reason", "outcome"):
             value = request.POST.get(attr, None)
             if value is not None:
                 setattr(record, attr, value)
+        record.digest = ""  # recalculated when next needed
         record.save()
+        tags = request.POST.get("tags", None)
+        if tags is not None:
+            record.set_tags(tags)
         return HttpResponse('OK')
 
 
@@ -121,6 +135,13 @@ class DataListView(ListView):
 class DataDetailView(DetailView):
     context_object_name = 'data_key'
 
+    def get(self, request, *args, **kwargs):
+        try:
+            self.paging = parse_paging_parameters(request.GET)
+        except ValueError as err:
+            return HttpResponseBadRequest(str(err))
+        return super(DataDetailView, self).get(request, *args, **kwargs)
+
     def get_object(self):
         attrs = dict(path=self.request.GET['path'],
                      digest=self.request.GET['digest'],
@@ -130,14 +151,7 @@ class DataDetailView(DetailView):
     def get_context_data(self, **kwargs):
         context = super(DataDetailView, self).get_context_data(**kwargs)
         context['project_name'] = self.kwargs["project"]  # use project full name?
-
-        if 'truncate' in self.request.GET:
-            if self.request.GET['truncate'].lower() == 'false':
-                max_display_length = None
-            else:
-                max_display_length = int(self.request.GET['truncate']) * 1024
-        else:
-            max_display_length = DEFAULT_MAX_DISPLAY_LENGTH
+        max_display_length, first_line, n_lines = self.paging
 
         datakey = self.object
         mimetype = datakey.to_sumatra().metadata["mimetype"]
@@ -147,29 +161,42 @@ class DataDetailView(DetailView):
             datastore = datakey.input_to_records.first().input_datastore
         context['datastore_id'] = datastore.pk
 
-        content_dispatch = {
+        paged_dispatch = {
             "text/csv": self.handle_csv,
             "text/plain": self.handle_plain_text,
-            "application/zip": self.handle_zipfile
         }
-        if mimetype in content_dispatch:
+        if mimetype in paged_dispatch:
+            # only the lines being viewed are read from the data store
+            data_item = datastore.to_sumatra().get_data_item(datakey.to_sumatra())
+            index = get_line_index(data_item, (datakey.path, datakey.digest))
+            lines = [line.decode("utf-8", "replace")
+                     for line in index.get_lines(first_line, n_lines)]
+            context.update(paged=True,
+                           first_line=first_line + 1,
+                           last_line=first_line + len(lines),
+                           total_lines=index.n_lines,
+                           page_size=n_lines)
+            if first_line > 0:
+                context['previous_offset'] = max(first_line - (n_lines or 0), 0)
+            if first_line + len(lines) < index.n_lines:
+                context['next_offset'] = first_line + len(lines)
+            context['truncated'] = first_line > 0 or 'next_offset' in context
+            context = paged_dispatch[mimetype](context, lines)
+        elif mimetype == "application/zip":
             content = datastore.to_sumatra().get_content(datakey.to_sumatra(),
                                                          max_length=max_display_length)
             context['truncated'] = (max_display_length is not None
                                     and len(content) >= max_display_length)
-
-            context = content_dispatch[mimetype](context, content)
+            context = self.handle_zipfile(context, content)
         return context
 
-    def handle_csv(self, context, content):
+    def handle_csv(self, context, lines):
         import csv
-        content = content.rpartition('\n')[0]
-        lines = content.splitlines()
         context['reader'] = csv.reader(lines)
         return context
 
-    def handle_plain_text(self, context, content):
-        context["content"] = content
+    def handle_plain_text(self, context, lines):
+        context["content"] = "\n".join(lines)
         return context
 
     def handle_zipfile(self, context, content):
@@ -218,18 +245,110 @@ def delete_records(request, project):
     return HttpResponse('OK')
 
 
+def _non_negative_int(query, name, default):
+    value = query.get(name, default)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("'%s' must be an integer, not '%s'" % (name, value))
+    if value < 0:
+        raise ValueError("'%s' must not be negative" % name)
+    return value
+
+
+def parse_paging_parameters(query):
+    """
+    Parse the query parameters which select the part of a data file to be
+    previewed: "truncate" (the maximum length, in kB, of the content shown,
+    or "false"), "offset" (the first line) and "lines" (the number of lines).
+
+    Return a (max_display_length, first_line, n_lines) tuple, where
+    max_display_length and n_lines are None if the content is not to be
+    truncated. Raise ValueError if any of the parameters is invalid.
+    """
+    if query.get('truncate', '').lower() == 'false':
+        max_display_length = None
+    else:
+        max_display_length = _non_negative_int(query, 'truncate', DEFAULT_MAX_DISPLAY_LENGTH // 1024) * 1024
+    first_line = _non_negative_int(query, 'offset', 0)
+    if max_display_length is None:
+        n_lines = None
+    else:
+        n_lines = _non_negative_int(query, 'lines', DEFAULT_PREVIEW_LINES)
+    return max_display_length, first_line, n_lines
+
+
+def parse_byte_range(header, size):
+    """
+    Parse the value of an HTTP Range header, for a resource of *size* bytes.
+
+    Return a (start, stop) tuple, or None if the header is missing or cannot
+    be handled (only single byte ranges are supported), in which case the
+    whole resource should be sent. Raise ValueError if the range cannot be
+    satisfied.
+    """
+    match = header and BYTE_RANGE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        stop = min(int(last) + 1, size) if last else size
+        if last and int(last) < start:
+            return None  # syntactically invalid, so ignored
+    elif last:  # the final bytes
+        start = max(size - int(last), 0)
+        stop = size
+    else:
+        return None
+    if start >= size or start >= stop:
+        raise ValueError("Range %s not satisfiable for %d bytes" % (header, size))
+    return start, stop
+
+
 def show_content(request, datastore_id):
+    """
+    Send the content of a data item, a block at a time. The digest of the
+    content is used as its ETag, and single byte ranges are supported, so
+    that downloads can be resumed.
+    """
     datastore = Datastore.objects.get(pk=datastore_id).to_sumatra()
     attrs = dict(path=request.GET['path'],
                  digest=request.GET['digest'],
                  creation=datestring_to_datetime(request.GET['creation']))
     data_key = DataKey.objects.get(**attrs).to_sumatra()
     mimetype = data_key.metadata["mimetype"]
+    etag = '"%s"' % data_key.digest
+    if etag in [tag.strip() for tag in request.META.get("HTTP_IF_NONE_MATCH", "").split(",")]:
+        response = HttpResponse(status=304)
+        response["ETag"] = etag
+        return response
     try:
-        content = datastore.get_content(data_key)
+        data_item = datastore.get_data_item(data_key)
     except (IOError, KeyError):
         raise Http404
-    return HttpResponse(content, content_type=mimetype)
+    size = data_item.size
+    byte_range = None
+    if size >= 0 and request.META.get("HTTP_IF_RANGE", etag) == etag:
+        try:
+            byte_range = parse_byte_range(request.META.get("HTTP_RANGE"), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = "bytes */%d" % size
+            return response
+    if byte_range:
+        start, stop = byte_range
+        response = StreamingHttpResponse(data_item.iter_range(start, stop),
+                                         content_type=mimetype, status=206)
+        response["Content-Range"] = "bytes %d-%d/%d" % (start, stop - 1, size)
+        response["Content-Length"] = str(stop - start)
+    else:
+        response = StreamingHttpResponse(data_item.iter_content(), content_type=mimetype)
+        if size >= 0:
+            response["Content-Length"] = str(size)
+    response["ETag"] = etag
+    response["Accept-Ranges"] = "bytes"
+    return response
 
 
 def compare_records(request, project):
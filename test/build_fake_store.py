@@ -32,7 +32,6 @@ for i in range(50):
                     on_changed='store-diff', stdout_stderr='srgvrgvsgverhcser')
     record.duration = random.gammavariate(1.0, 1000.0)
     record.outcome = "lghsvdghsg zskjdcghnskdjgc ckdjshcgndsg"
-    record.data_key = "['output.data']"
     record.dependencies = []
     record.platforms = serial.get_platform_information()
     project.add_record(record)
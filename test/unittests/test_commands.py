@@ -16,6 +16,7 @@ import os
 import hashlib
 from datetime import datetime
 from sumatra import commands, launch, datastore
+from sumatra.datastore import watchers
 from sumatra.parameters import (SimpleParameterSet, JSONParameterSet,
                                 YAMLParameterSet, ConfigParserParameterSet)
 
@@ -63,6 +64,11 @@ class MockRecordStore(object):
         return []
     def update(self, project, field, value):
         self.updated = (field, value)
+    def labels(self, project):
+        return []
+    def collect_garbage(self):
+        self.garbage_collected = True
+        return 0
 
 
 class MockRepository(object):
@@ -136,8 +142,9 @@ class MockProject(object):
         self.launch_args.update(parameters=parameters,
                                 input_data=input_data,
                                 script_args=script_args)
-    def format_records(self, format='text', mode='short', tags=None, reverse=False):
+    def format_records(self, format='text', mode='short', tags=None, reverse=False, **filters):
         self.format_args = {"tags": tags, "mode": mode, "format": format, "reverse": reverse}
+        self.format_args.update(filters)
     def delete_record(self, label, delete_data=False):
         if "nota" in label:
             raise KeyError  # or just emit a warning?
@@ -145,7 +152,7 @@ class MockProject(object):
             self._records_deleted.append(label)
     def delete_by_tag(self, tag, delete_data=False):
         self._records_deleted.append("records_tagged_with_%s" % tag)
-    def export(self): self.exported = True
+    def export(self, format="json"): self.exported = format
     def most_recent(self):
         return MockRecord("most_recent")
     def add_comment(self, label, comment, replace=False):
@@ -345,6 +352,19 @@ class ConfigureCommandTests(unittest.TestCase):
         self.assertEqual(self.prj.data_store.root, "/path/to/data")
         self.assertEqual(self.prj.input_datastore.root, "/path/to/input/data")
 
+    def test_set_change_detection(self):
+        commands.configure(["--change-detection", "manifest"])
+        self.assertEqual(self.prj.data_store.change_detection, "manifest")
+        self.assertRaises(SystemExit, commands.configure, ["--change-detection", "psychic"])
+
+    def test_set_change_detection_to_unavailable_inotify(self):
+        have_inotify = watchers.have_inotify
+        watchers.have_inotify = False
+        try:
+            self.assertRaises(SystemExit, commands.configure, ["--change-detection", "inotify"])
+        finally:
+            watchers.have_inotify = have_inotify
+
     def test_set_on_changed_with_valid_value(self):
         for value in "error", "store-diff":
             commands.configure(["-c", value])
@@ -593,13 +613,34 @@ class ListCommandTests(unittest.TestCase):
 
     def test_with_no_args(self):
         commands.list([])
-        # need some assertion about self.prj.format_args
+        self.assertEqual(self.prj.format_args,
+                         {"tags": [], "mode": "short", "format": "text", "reverse": False})
+
+    def test_with_filters(self):
+        commands.list(["foo", "--since", "2015-03-01", "--until", "2015-03-02 12:00",
+                       "--user", "bob", "--main", "main.py", "-p", "a=1", "-p", "b.c=x=y",
+                       "--limit", "5"])
+        self.assertEqual(self.prj.format_args,
+                         {"tags": ["foo"], "mode": "short", "format": "text", "reverse": False,
+                          "since": datetime(2015, 3, 1), "until": datetime(2015, 3, 2, 12, 0),
+                          "user": "bob", "main_file": "main.py",
+                          "parameters": {"a": "1", "b.c": "x=y"}, "limit": 5})
+
+    def test_with_any_tags(self):
+        commands.list(["foo", "bar", "--any-tags"])
+        self.assertEqual(self.prj.format_args,
+                         {"tags": ["foo", "bar"], "any_tags": True, "mode": "short",
+                          "format": "text", "reverse": False})
+
+    def test_with_invalid_date(self):
+        self.assertRaises(SystemExit, commands.list, ["--since", "yesterday"])
 
 
 class DeleteCommandTests(unittest.TestCase):
 
     def setUp(self):
         self.prj = MockProject()
+        self.prj.record_store = MockRecordStore("default")
         commands.load_project = lambda: self.prj
 
     def test_with_no_args(self):
@@ -609,6 +650,7 @@ class DeleteCommandTests(unittest.TestCase):
         commands.delete(["recordA", "recordB"])
         self.assertEqual(self.prj._records_deleted,
                          ["recordA", "recordB"])
+        self.assertTrue(self.prj.record_store.garbage_collected)
 
     def test_with_invalid_record_labels(self):
         commands.delete(["recordA", "notarecordB", "recordC"])
@@ -742,7 +784,7 @@ class ExportCommandTests(unittest.TestCase):
 
     def test_project_exported(self):
         commands.export([])
-        assert self.prj.exported
+        self.assertEqual(self.prj.exported, "json")
 
     def test_with_args(self):
         self.assertRaises(SystemExit, commands.export, ['foo'])
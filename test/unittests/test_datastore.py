@@ -10,9 +10,25 @@ import unittest
 import shutil
 import os
 import datetime
+import io
+import gzip
 import hashlib
+import tarfile
+import tempfile
+import threading
+import pickle
+import warnings
+from contextlib import closing
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from sumatra.datastore import digest_cache, watchers
+from sumatra.datastore import blob_cache
+from sumatra.datastore.blob_cache import BlobCache
+from sumatra.datastore.line_index import LineIndex
+from sumatra.datastore.mirroredfs import MirroredFileSystemDataStore
+from sumatra.datastore.compression import ParallelCompressedFile, CODECS
 from sumatra.datastore import FileSystemDataStore, ArchivingFileSystemDataStore, get_data_store, DataKey
-from sumatra.datastore.base import DataStore
+from sumatra.datastore.base import DataStore, DataItem
+from sumatra.datastore import filesystem, archivingfs
 from sumatra.datastore.filesystem import DataFile
 from sumatra.core import TIMESTAMP_FORMAT
 
@@ -67,6 +83,69 @@ class TestFileSystemDataStore(unittest.TestCase):
         content = self.ds.get_content(key, max_length=10)
         self.assertEqual(content, self.test_data[:10])
 
+    def test__find_new_data__should_ignore_vcs_directories(self):
+        os.mkdir(os.path.join(self.root_dir, '.git'))
+        with open(os.path.join(self.root_dir, '.git', 'index'), 'wb') as f:
+            f.write(self.test_data)
+        self.assertEqual(set(key.path for key in self.ds.find_new_data(self.now)),
+                         self.test_files)
+
+    def test__find_new_data__should_calculate_digests_in_parallel(self):
+        self.ds.hash_workers = 3
+        digest = hashlib.sha1(self.test_data).hexdigest()
+        keys = self.ds.find_new_data(self.now)
+        self.assertEqual(set(key.digest for key in keys), set([digest]))
+        self.assertEqual(set(key.metadata['size'] for key in keys), set([len(self.test_data)]))
+
+    def test__invalid_change_detection_mode__should_raise_ValueError(self):
+        self.assertRaises(ValueError, FileSystemDataStore, self.root_dir, change_detection="psychic")
+
+    def test__inotify_when_unavailable__should_fall_back_to_mtime(self):
+        have_inotify = watchers.have_inotify
+        watchers.have_inotify = False
+        try:
+            ds = FileSystemDataStore(self.root_dir, change_detection="inotify")
+            ds = pickle.loads(pickle.dumps(ds))  # e.g. a project created on another system
+            self.assertEqual(ds.change_detection, "inotify")
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                ds.start_watching()
+            self.assertEqual(len(caught), 1)
+            self.assertIsNone(ds._watcher)
+            self.assertEqual(set(key.path for key in ds.find_new_data(self.now)), self.test_files)
+        finally:
+            watchers.have_inotify = have_inotify
+
+    def check_change_detection(self, mode):
+        ds = FileSystemDataStore(self.root_dir, change_detection=mode)
+        self.assertEqual(ds.__getstate__(), {'root': self.root_dir, 'change_detection': mode})
+        ds.start_watching()
+        # modifying an existing file, creating a new file and a new directory
+        with open(os.path.join(self.root_dir, 'test_file1'), 'ab') as f:
+            f.write(self.test_data)
+        os.makedirs(os.path.join(self.root_dir, 'new_dir', 'sub_dir'))
+        for path in ('new_file', 'new_dir/sub_dir/test_file4'):
+            with open(os.path.join(self.root_dir, path), 'wb') as f:
+                f.write(self.test_data)
+        # files older than the timestamp are still found
+        tomorrow = self.now + datetime.timedelta(1)
+        self.assertEqual(set(key.path for key in ds.find_new_data(tomorrow)),
+                         set(['test_file1', 'new_file', 'new_dir/sub_dir/test_file4']))
+
+    def test__find_new_data_with_manifest(self):
+        self.check_change_detection("manifest")
+
+    @unittest.skipUnless(watchers.have_inotify, "inotify not available")
+    def test__find_new_data_with_inotify(self):
+        self.check_change_detection("inotify")
+
+    def test__digest__should_read_file_in_chunks(self):
+        data_file = DataFile('test_file1', self.ds)
+        chunks = list(data_file.iter_content(chunk_size=10))
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(b"".join(chunks), self.test_data)
+        self.assertEqual(data_file.digest, hashlib.sha1(self.test_data).hexdigest())
+
     def test__delete__should_remove_files(self):
         assert os.path.exists(os.path.join(self.root_dir, 'test_file1'))
         digest = hashlib.sha1(self.test_data).hexdigest()
@@ -74,6 +153,30 @@ class TestFileSystemDataStore(unittest.TestCase):
         self.ds.delete(*keys)
         self.assert_(not os.path.exists(os.path.join(self.root_dir, 'test_file1')))
 
+    def test__save_copies__should_copy_all_items(self):
+        keys = self.ds.generate_keys(*sorted(self.test_files))
+        copy_dir = tempfile.mkdtemp()
+        try:
+            paths = self.ds.save_copies(keys, copy_dir)
+            self.assertEqual(paths, [os.path.join(copy_dir, key.path) for key in keys])
+            for path in paths:
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(), self.test_data)
+        finally:
+            shutil.rmtree(copy_dir)
+
+    def test__copy_file__should_fall_back_to_copying_blocks(self):
+        source = os.path.join(self.root_dir, 'test_file1')
+        destination = os.path.join(self.root_dir, 'copy')
+        methods = filesystem.KERNEL_COPY_METHODS
+        filesystem.KERNEL_COPY_METHODS = []
+        try:
+            filesystem.copy_file(source, destination)
+        finally:
+            filesystem.KERNEL_COPY_METHODS = methods
+        with open(destination, 'rb') as f:
+            self.assertEqual(f.read(), self.test_data)
+
 
 class TestArchivingFileSystemDataStore(unittest.TestCase):
 
@@ -111,6 +214,11 @@ class TestArchivingFileSystemDataStore(unittest.TestCase):
         self.assertEqual(self.ds.__getstate__(),
                          {'root': self.root_dir, 'archive': self.archive_dir})
 
+    def test__get_state__should_omit_default_compression_level(self):
+        ds = ArchivingFileSystemDataStore(self.root_dir, self.archive_dir, compression="gzip",
+                                          compression_level=CODECS["gzip"].default_level)
+        self.assertEqual(ds.__getstate__(), {'root': self.root_dir, 'archive': self.archive_dir})
+
     def test__find_new_data__should_return_list_of_keys_matching_new_files(self):
         self.assertEqual(set("/".join(key.path.split("/")[1:]) for key in self.ds.find_new_data(self.now)),
                          self.test_files)
@@ -138,6 +246,16 @@ class TestArchivingFileSystemDataStore(unittest.TestCase):
         content = self.ds.get_content(key)
         self.assertEqual(content, self.test_data)
 
+    def test__save_copy__should_stream_archived_file(self):
+        key, = [key for key in self.ds.find_new_data(self.now) if key.path.endswith('test_file1')]
+        copy_dir = tempfile.mkdtemp()
+        try:
+            path = self.ds.get_data_item(key).save_copy(copy_dir)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), self.test_data)
+        finally:
+            shutil.rmtree(copy_dir)
+
     def test__get_content__should_truncate_long_files(self):
         self.ds.find_new_data(self.now)
         digest = hashlib.sha1(self.test_data).hexdigest()
@@ -148,6 +266,102 @@ class TestArchivingFileSystemDataStore(unittest.TestCase):
         self.assertEqual(content, self.test_data[:10])
 
 
+class TestZipArchivingFileSystemDataStore(TestArchivingFileSystemDataStore):
+
+    def setUp(self):
+        super(TestZipArchivingFileSystemDataStore, self).setUp()
+        self.ds = ArchivingFileSystemDataStore(self.root_dir, self.archive_dir, archive_format="zip")
+
+    def test__get_state__should_return_dict_containing_root_and_archive_store(self):
+        self.assertEqual(self.ds.__getstate__(),
+                         {'root': self.root_dir, 'archive': self.archive_dir,
+                          'archive_format': 'zip'})
+
+    def test__archive__should_create_a_tarball(self):
+        self.ds._archive('test', self.test_files)
+        self.assert_(os.path.exists(os.path.join(self.archive_dir, 'test.zip')))
+        self.assert_(not os.path.exists(os.path.join(self.archive_dir, 'test.tar.gz')))
+
+    def test__get_data_item__should_read_from_zip(self):
+        keys = self.ds.find_new_data(self.now)
+        for key in keys:
+            data_item = self.ds.get_data_item(key)
+            self.assert_(data_item.archive_path.endswith('.zip'))
+            self.assertEqual(data_item.size, len(self.test_data))
+            self.assertEqual(data_item.get_content(max_length=5), self.test_data[:5])
+
+    def test__archive_without_zip_streaming(self):
+        # as on Python versions earlier than 3.6
+        archivingfs.ZIP_STREAMING = False
+        try:
+            keys = self.ds.find_new_data(self.now)
+        finally:
+            archivingfs.ZIP_STREAMING = True
+        digest = hashlib.sha1(self.test_data).hexdigest()
+        self.assertEqual(len(keys), 3)
+        for key in keys:
+            self.assertEqual(key.digest, digest)
+            self.assertEqual(self.ds.get_data_item(key).get_content(), self.test_data)
+
+    def test__invalid_archive_format__should_raise_ValueError(self):
+        self.assertRaises(ValueError, ArchivingFileSystemDataStore, self.root_dir,
+                          self.archive_dir, archive_format="rar")
+
+
+@unittest.skipIf("xz" not in CODECS, "lzma module not available")
+class TestXzArchivingFileSystemDataStore(TestArchivingFileSystemDataStore):
+
+    def setUp(self):
+        super(TestXzArchivingFileSystemDataStore, self).setUp()
+        self.ds = ArchivingFileSystemDataStore(self.root_dir, self.archive_dir,
+                                               compression="xz", compression_level=1)
+
+    def test__get_state__should_return_dict_containing_root_and_archive_store(self):
+        self.assertEqual(self.ds.__getstate__(),
+                         {'root': self.root_dir, 'archive': self.archive_dir,
+                          'compression': 'xz', 'compression_level': 1})
+
+    def test__archive__should_create_a_tarball(self):
+        self.ds._archive('test', self.test_files)
+        self.assertEqual(os.listdir(self.archive_dir), ['test.tar.xz'])
+
+    def test__find_new_data__should_return_keys_with_digests(self):
+        digest = hashlib.sha1(self.test_data).hexdigest()
+        for key in self.ds.find_new_data(self.now):
+            self.assertEqual(key.digest, digest)
+            self.assertEqual(key.metadata['size'], len(self.test_data))
+            self.assertEqual(self.ds.get_data_item(key).digest, digest)
+
+    def test__invalid_compression__should_raise_ValueError(self):
+        self.assertRaises(ValueError, ArchivingFileSystemDataStore, self.root_dir,
+                          self.archive_dir, compression="rar")
+
+
+class TestParallelCompressedFile(unittest.TestCase):
+
+    def test__compressed_blocks__should_decompress_as_a_single_stream(self):
+        data = os.urandom(1000) * 100
+        buffer = io.BytesIO()
+        buffer.close = lambda: None
+        with ParallelCompressedFile(buffer, "gzip", level=1, n_workers=3, block_size=7000) as f:
+            for i in range(0, len(data), 3000):
+                f.write(data[i:i + 3000])
+        self.assertEqual(gzip.decompress(buffer.getvalue()), data)
+
+    def test__tar_file__should_be_readable_by_tarfile(self):
+        buffer = io.BytesIO()
+        buffer.close = lambda: None
+        with ParallelCompressedFile(buffer, "bzip2", n_workers=2, block_size=1000) as f:
+            with tarfile.open(fileobj=f, mode="w|") as tf:
+                content = b"abcdefgh" * 1000
+                info = tarfile.TarInfo("data.txt")
+                info.size = len(content)
+                tf.addfile(info, io.BytesIO(content))
+        buffer.seek(0)
+        with tarfile.open(fileobj=buffer, mode="r:bz2") as tf:
+            self.assertEqual(tf.extractfile("data.txt").read(), content)
+
+
 class MockDataStore(object):
         root = os.getcwd()
 
@@ -175,7 +389,27 @@ class TestDataFile(unittest.TestCase):
     def test_sorted_content(self):
         self.assertEqual(self.data_file.sorted_content,
                          b'crgqgjch,kgch\nlicgsnireugcsenrigucsic')
-        os.remove("%s,sorted" % self.test_file)
+        self.assertFalse(os.path.exists("%s,sorted" % self.test_file))
+
+    def test_iter_lines__should_join_lines_split_between_chunks(self):
+        self.assertEqual(list(self.data_file.iter_lines(chunk_size=5)),
+                         [b'licgsnireugcsenrigucsic', b'crgqgjch,kgch'])
+
+    def test_unordered_digest__should_not_depend_on_line_order(self):
+        with open("test_file2", 'wb') as f:
+            f.write(b'crgqgjch,kgch\nlicgsnireugcsenrigucsic')
+        other_data_file = DataFile("test_file2", MockDataStore())
+        self.assertEqual(self.data_file.unordered_digest, other_data_file.unordered_digest)
+        self.assertNotEqual(self.data_file.digest, other_data_file.digest)
+        os.remove("test_file2")
+
+    def test_iter_range(self):
+        self.assertEqual(b"".join(self.data_file.iter_range(3, 10, chunk_size=4)),
+                         self.test_data[3:10])
+        self.assertEqual(b"".join(self.data_file.iter_range(30)), self.test_data[30:])
+        # the generic implementation, for data items which cannot seek
+        self.assertEqual(b"".join(DataItem.iter_range(self.data_file, 3, 10, chunk_size=4)),
+                         self.test_data[3:10])
 
     def test_eq(self):
         same_data_file = DataFile(self.test_file, MockDataStore())
@@ -185,7 +419,6 @@ class TestDataFile(unittest.TestCase):
         sorted_data_file = DataFile("test_file2", MockDataStore())
         self.assertEqual(self.data_file, sorted_data_file)
         os.remove("test_file2")
-        os.remove("test_file2,sorted")
 
     def test_ne(self):
         with open("test_file3", "w") as f:
@@ -195,6 +428,276 @@ class TestDataFile(unittest.TestCase):
         os.remove("test_file3")
 
 
+class TestDigestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd_before_test = os.getcwd()
+        self.project_dir = tempfile.mkdtemp(prefix='sumatra-test-')
+        os.chdir(self.project_dir)
+        os.mkdir('.smt')
+        self.ds = FileSystemDataStore('Data')
+        self.test_data = b'licgsnireugcsenrigucsic\ncrgqgjch,kgch'
+        self.path = os.path.join(self.ds.root, 'test_file1')
+        with open(self.path, 'wb') as f:
+            f.write(self.test_data)
+
+    def tearDown(self):
+        os.chdir(self.cwd_before_test)
+        shutil.rmtree(self.project_dir)
+
+    def test_digest_is_cached(self):
+        digest = DataFile('test_file1', self.ds).digest
+        self.assertEqual(digest, hashlib.sha1(self.test_data).hexdigest())
+        cache = digest_cache.get_digest_cache()
+        self.assertEqual(cache.get(self.path, os.stat(self.path)), digest)
+        # the cached value is used as long as the file appears unchanged
+        cache.set(self.path, os.stat(self.path), "not really a digest")
+        self.assertEqual(DataFile('test_file1', self.ds).digest, "not really a digest")
+
+    def test_modified_file_is_hashed_again(self):
+        DataFile('test_file1', self.ds).digest
+        with open(self.path, 'ab') as f:
+            f.write(b'more data')
+        self.assertEqual(DataFile('test_file1', self.ds).digest,
+                         hashlib.sha1(self.test_data + b'more data').hexdigest())
+
+    def test_eviction(self):
+        cache = digest_cache.DigestCache(os.path.join('.smt', 'test_digests.sqlite'), max_entries=2)
+        stats = os.stat(self.path)
+        for name in ('a', 'b', 'c'):
+            cache.set(name, stats, name * 40)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a', stats), None)
+        self.assertEqual(cache.get('c', stats), 'c' * 40)
+
+    def test_batch(self):
+        cache = digest_cache.DigestCache(os.path.join('.smt', 'test_digests.sqlite'), max_entries=2)
+        stats = os.stat(self.path)
+        with cache.batch():
+            for name in ('a', 'b', 'c'):
+                cache.set(name, stats, name * 40)
+            # the entries are only written at the end of the batch
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(cache.get('a', stats), 'a' * 40)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a', stats), None)
+        self.assertEqual(cache.get('c', stats), 'c' * 40)
+
+    def test_no_cache_outside_project(self):
+        os.chdir(self.ds.root)
+        self.assertEqual(digest_cache.get_digest_cache(), None)
+        self.assertEqual(DataFile('test_file1', self.ds).digest,
+                         hashlib.sha1(self.test_data).hexdigest())
+
+
+class TestBlobCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='sumatra-test-')
+        self.cache = BlobCache(self.cache_dir, max_size=25)
+        self.test_data = b'0123456789'
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_fetch(self):
+        digest = hashlib.sha1(self.test_data).hexdigest()
+        self.assertEqual(self.cache.get(digest), None)
+        path = self.cache.fetch(digest, lambda: io.BytesIO(self.test_data), digest=digest)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.test_data)
+        # once cached, the remote data are not read again
+        self.assertEqual(self.cache.fetch(digest, None), path)
+
+    def test_corrupted_download_is_not_cached(self):
+        digest = hashlib.sha1(self.test_data).hexdigest()
+        self.assertRaises(IOError, self.cache.fetch, digest,
+                          lambda: io.BytesIO(b'corrupted'), digest=digest)
+        self.assertRaises(IOError, self.cache.fetch, "foo",
+                          lambda: io.BytesIO(self.test_data), size=5)
+        self.assertEqual(self.cache.size(), 0)
+        self.assertEqual(self.cache.get(digest), None)
+
+    def test_least_recently_used_blobs_are_evicted(self):
+        for key in ('aa', 'bb'):
+            self.cache.fetch(key, lambda: io.BytesIO(self.test_data))
+        os.utime(self.cache.get('aa'), (0, 0))
+        os.utime(self.cache.get('bb'), (1, 1))
+        self.cache.get('aa')
+        self.cache.fetch('cc', lambda: io.BytesIO(self.test_data))
+        self.assertEqual(self.cache.get('bb'), None)
+        self.assertNotEqual(self.cache.get('aa'), None)
+        self.assertEqual(self.cache.size(), 20)
+
+    def test_blob_just_fetched_is_not_evicted(self):
+        data = b'x' * 20
+        self.cache.fetch('aa', lambda: io.BytesIO(data))
+        path = self.cache.fetch('bb', lambda: io.BytesIO(data))
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self.cache.get('aa'), None)
+
+    def test_blob_larger_than_cache_is_not_cached(self):
+        data = b'x' * 30  # max_size is 25
+        digest = hashlib.sha1(data).hexdigest()
+        self.assertEqual(self.cache.fetch(digest, lambda: io.BytesIO(data), size=30), None)
+        self.assertEqual(self.cache.fetch(digest, lambda: io.BytesIO(data), digest=digest), None)
+        self.assertEqual(self.cache.size(), 0)
+        with closing(self.cache.open_blob(digest, lambda: io.BytesIO(data), digest=digest)) as f:
+            self.assertEqual(f.read(), data)
+        # the digest is still checked, even though the blob is not cached
+        self.assertRaises(IOError, self.cache.fetch, digest,
+                          lambda: io.BytesIO(b'y' * 30), digest=digest)
+
+    def test_open_blob(self):
+        with closing(self.cache.open_blob('aa', lambda: io.BytesIO(self.test_data))) as f:
+            self.assertEqual(f.read(), self.test_data)
+        self.assertNotEqual(self.cache.get('aa'), None)
+
+    def test_blob_larger_than_cache_is_read_once(self):
+        data = b'x' * 30  # max_size is 25
+        opened = []
+
+        def open_remote():
+            f = io.BytesIO(data)
+            opened.append(f)
+            return f
+        with closing(self.cache.open_blob('aa', open_remote)) as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(len(opened), 1)
+        self.assertEqual(self.cache.size(), 0)
+        self.assertEqual(os.listdir(os.path.join(self.cache_dir, 'aa')), [])
+
+    def test_blob_larger_than_cache_is_not_downloaded_if_content_length_is_given(self):
+        class Response(io.BytesIO):
+            headers = {"Content-Length": "30"}
+        response = Response(b'x' * 30)
+        self.assertEqual(self.cache.fetch('aa', lambda: response), None)
+        self.assertTrue(response.closed)
+        response = Response(b'x' * 30)
+        self.assertIs(self.cache.open_blob('aa', lambda: response), response)
+        self.assertEqual(response.tell(), 0)
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serves files from the working directory, honouring simple Range headers."""
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("Range")))
+        if self.headers.get("Range"):
+            with open(self.translate_path(self.path), 'rb') as f:
+                content = f.read()
+            start, end = self.headers["Range"][len("bytes="):].split("-")
+            content = content[int(start):int(end) + 1]
+            self.send_response(206)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            SimpleHTTPRequestHandler.do_GET(self)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMirroredFileSystemDataStore(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd_before_test = os.getcwd()
+        self.project_dir = tempfile.mkdtemp(prefix='sumatra-test-')
+        os.chdir(self.project_dir)
+        os.mkdir('.smt')
+        os.mkdir('mirror')
+        self.test_data = b'licgsnireugcsenrigucsic\ncrgqgjch,kgch'
+        with open(os.path.join('mirror', 'test_file1'), 'wb') as f:
+            f.write(self.test_data)
+        RangeRequestHandler.requests = []
+        self.server = HTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        # the data are only available from the mirror
+        self.ds = MirroredFileSystemDataStore('Data', 'http://127.0.0.1:%d/mirror/' % self.server.server_port)
+        self.key = DataKey('test_file1', hashlib.sha1(self.test_data).hexdigest(), creation=None)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        os.chdir(self.cwd_before_test)
+        shutil.rmtree(self.project_dir)
+
+    def test__get_state__should_omit_default_change_detection(self):
+        self.assertEqual(self.ds.__getstate__(),
+                         {'root': self.ds.root, 'mirror_base_url': self.ds.mirror_base_url})
+
+    def test_get_content_with_max_length_uses_range_request(self):
+        self.assertEqual(self.ds.get_content(self.key, max_length=5), self.test_data[:5])
+        self.assertEqual(RangeRequestHandler.requests, [('/mirror/test_file1', 'bytes=0-4')])
+
+    def test_mirrored_file_is_downloaded_once(self):
+        for i in range(3):
+            self.assertEqual(self.ds.get_content(self.key), self.test_data)
+        self.assertEqual(self.ds.get_content(self.key, max_length=5), self.test_data[:5])
+        self.assertEqual(RangeRequestHandler.requests, [('/mirror/test_file1', None)])
+
+    def test_file_too_large_to_cache_is_downloaded_once_per_read(self):
+        directory = os.path.abspath(blob_cache.BLOB_CACHE_DIR)
+        blob_cache._caches[directory] = BlobCache(directory, max_size=len(self.test_data) - 1)
+        try:
+            df = self.ds.get_data_item(self.key)  # checks the digest
+            self.assertEqual(df.get_content(), self.test_data)
+        finally:
+            del blob_cache._caches[directory]
+        self.assertEqual(RangeRequestHandler.requests, [('/mirror/test_file1', None)] * 2)
+
+    def test_wrong_digest_raises_KeyError(self):
+        key = DataKey('test_file1', hashlib.sha1(b'other data').hexdigest(), creation=None)
+        self.assertRaises(KeyError, self.ds.get_data_item, key)
+
+
+class TestLineIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.test_file = 'test_lines.txt'
+        self.lines = [("line %d" % i).encode("ascii") for i in range(25)]
+        with open(self.test_file, 'wb') as f:
+            f.write(b"\n".join(self.lines))
+        self.data_file = DataFile(self.test_file, MockDataStore())
+
+    def tearDown(self):
+        os.remove(self.test_file)
+
+    def test_offsets(self):
+        index = LineIndex(self.data_file, step=10)
+        self.assertEqual(index.n_lines, 25)
+        content = self.data_file.content
+        self.assertEqual([content[offset:offset + 7] for offset in index.offsets],
+                         [b"line 0\n", b"line 10", b"line 20"])
+
+    def test_get_lines(self):
+        index = LineIndex(self.data_file, step=10)
+        self.assertEqual(index.get_lines(8, 5), self.lines[8:13])
+        self.assertEqual(index.get_lines(22, 5), self.lines[22:])
+        self.assertEqual(index.get_lines(21), self.lines[21:])
+        self.assertEqual(index.get_lines(30, 5), [])
+
+
+class TestDataKey(unittest.TestCase):
+
+    def test_pickle_round_trip(self):
+        import pickle
+        key = DataKey("a/b.dat", "0123456789abcdef", datetime.datetime(2015, 1, 2, 3, 4, 5), size=42)
+        key2 = pickle.loads(pickle.dumps(key))
+        self.assertEqual(key2, key)
+        self.assertEqual(key2.metadata, {"size": 42})
+
+    def test_setstate_accepts_old_instance_dict(self):
+        key = DataKey.__new__(DataKey)
+        key.__setstate__({"path": "a.dat", "digest": "abc", "creation": None, "metadata": {}})
+        self.assertEqual(key.path, "a.dat")
+        self.assertFalse(hasattr(key, "__dict__"))
+
+
 class TestModuleFunctions(unittest.TestCase):
 
     def test__get_data_store__should_return_DataStore_object(self):
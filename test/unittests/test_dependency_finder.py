@@ -198,6 +198,14 @@ class TestPythonDependency(unittest.TestCase):
         dep = df.python.Dependency("main", os.path.join(self.example_project, "main.py"), version="1.2.3b")
         self.assertEqual(dep.version, "1.2.3b")
 
+    def test_pickle_round_trip(self):
+        import pickle
+        dep = df.python.Dependency("main", os.path.join(self.example_project, "main.py"), version="1.2.3b")
+        dep2 = pickle.loads(pickle.dumps(dep))
+        self.assertEqual(dep2, dep)
+        self.assertEqual(dep2.version, "1.2.3b")
+        self.assertFalse(hasattr(dep2, "__dict__"))
+
     @unittest.skipUnless(have_numpy, "test requires NumPy")
     def test__from_module(self):
         dep = df.python.Dependency.from_module(sys.modules['numpy'], None)
@@ -279,6 +287,105 @@ class TestRDependency(unittest.TestCase):
         self.assertNotEqual(dep1, dep2)
 
 
+class TestDependencyCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.project_dir = tempfile.mkdtemp()
+        os.chdir(self.project_dir)
+        os.mkdir(".smt")
+        for name in ("main.py", "helper.py", "dependency.py"):
+            with open(name, "w") as f:
+                f.write("import os\n")
+        self.executable = MockExecutable("python")
+        self.executable.version = "3.4.1"
+        self.real_find_dependencies = df.python.find_dependencies
+        self.n_searches = 0
+        self.dependency_path = os.path.abspath("dependency.py")
+        self.unresolved = []
+
+        def find_dependencies(filename, executable, unresolved=None):
+            self.n_searches += 1
+            unresolved.extend(self.unresolved)
+            return [df.python.Dependency("dependency", self.dependency_path, "1.0")]
+        df.python.find_dependencies = find_dependencies
+
+    def tearDown(self):
+        df.python.find_dependencies = self.real_find_dependencies
+        df.cache._caches.clear()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.project_dir)
+
+    def find(self, filename="main.py"):
+        return df.find_dependencies(filename, self.executable)
+
+    def test_search_is_only_repeated_when_files_change(self):
+        deps = self.find()
+        self.assertEqual(self.find(), deps)
+        self.assertEqual(self.n_searches, 1)
+        for name in ("main.py", "helper.py", "dependency.py"):
+            with open(name, "a") as f:
+                f.write("import sys\n")
+            self.find()
+            self.find()
+        self.assertEqual(self.n_searches, 4)
+
+    def test_search_is_repeated_when_files_in_subpackages_change(self):
+        os.makedirs(os.path.join("package", "subpackage", "__pycache__"))
+        for name in ("__init__.py", os.path.join("subpackage", "__init__.py"),
+                     os.path.join("subpackage", "module.py")):
+            with open(os.path.join("package", name), "w") as f:
+                f.write("import os\n")
+        self.dependency_path = os.path.abspath("package")
+        self.find()
+        with open(os.path.join("package", "subpackage", "__pycache__", "module.pyc"), "w") as f:
+            f.write("compiled")
+        self.find()
+        self.assertEqual(self.n_searches, 1)
+        with open(os.path.join("package", "subpackage", "module.py"), "a") as f:
+            f.write("import sys\n")
+        self.find()
+        self.assertEqual(self.n_searches, 2)
+
+    def test_search_is_repeated_when_missing_module_is_installed(self):
+        self.executable.path = sys.executable
+        self.unresolved = ["sumatra_test_missing_module"]
+        self.find()
+        self.find()
+        self.assertEqual(self.n_searches, 1)
+        with open("sumatra_test_missing_module.py", "w") as f:  # importable from the working directory
+            f.write("\n")
+        self.find()
+        self.assertEqual(self.n_searches, 2)
+
+    def test_search_is_repeated_for_a_different_interpreter(self):
+        self.find()
+        self.executable.version = "3.5.0"
+        self.find()
+        self.assertEqual(self.n_searches, 2)
+
+    def test_no_cache_outside_a_project(self):
+        os.rmdir(".smt")
+        self.find()
+        self.find()
+        self.assertEqual(self.n_searches, 2)
+        self.assertFalse(os.path.exists(".smt"))
+
+    def test_use_cache_false(self):
+        self.find()
+        df.find_dependencies("main.py", self.executable, use_cache=False)
+        self.assertEqual(self.n_searches, 2)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = df.cache.get_dependency_cache()
+        cache.max_entries = 2
+        for name in ("main.py", "helper.py", "dependency.py"):
+            self.find(name)
+        self.assertEqual(len(cache._entries()), 2)
+        self.find("dependency.py")
+        self.assertEqual(self.n_searches, 3)
+
+
 def setup():
     global tmpdir
     tmpdir = tempfile.mkdtemp()
@@ -10,7 +10,7 @@ try:
     import unittest2 as unittest
 except ImportError:
     import unittest
-from sumatra.launch import SerialLaunchMode, DistributedLaunchMode
+from sumatra.launch import SerialLaunchMode, DistributedLaunchMode, PlatformInformation
 import sys
 import os
 
@@ -25,7 +25,15 @@ class MockExecutable(object):
 
 
 class TestPlatformInformation(unittest.TestCase):
-    pass
+
+    def test_pickle_round_trip(self):
+        import pickle
+        pfi = PlatformInformation(system_name="Linux", release="3.2.0", ip_addr="127.0.0.1")
+        pfi2 = pickle.loads(pickle.dumps(pfi))
+        self.assertEqual(pfi2.__getstate__(), pfi.__getstate__())
+
+    def test_has_no_instance_dict(self):
+        self.assertFalse(hasattr(PlatformInformation(), "__dict__"))
 
 
 class BaseTestLaunchMode(object):
@@ -148,7 +148,7 @@ class MockRecord(object):
         self.stdout_stderr = ''
         self.output_data = []
 
-    def difference(r1, r2, igm, igf):
+    def difference(r1, r2, igm, igf, ignore_line_order=False):
         return ""
 
 
@@ -176,6 +176,10 @@ class MockRecordStore(object):
         return [self.get(project_name, 'foo_label'),
                 self.get(project_name, 'bar_label')]
 
+    def query(self, project_name, order_by="-timestamp", limit=None, offset=0, **filters):
+        self.query_filters = filters
+        return self.list(project_name, filters.get("tags"))
+
     def delete(self, project_name, label):
         self.deleted = label
 
@@ -185,6 +189,9 @@ class MockRecordStore(object):
     def most_recent(self, project):
         return "last"
 
+    def export_to_file(self, project_name, fp, format="json"):
+        fp.write(b"" if format == "binary" else "")
+
     def __getstate__(self):
         return {}
 
@@ -217,6 +224,16 @@ class TestProject(unittest.TestCase):
         proj = Project("test_project", record_store=MockRecordStore())
         proj.info()
 
+    def test_export_removes_export_in_other_format(self):
+        proj = Project("test_project", record_store=MockRecordStore())
+        proj.export(format="binary")
+        self.assertTrue(os.path.exists(".smt/records_export.smtb"))
+        proj.export()
+        self.assertTrue(os.path.exists(".smt/records_export.json"))
+        self.assertFalse(os.path.exists(".smt/records_export.smtb"))
+        proj.export(format="binary")
+        self.assertFalse(os.path.exists(".smt/records_export.json"))
+
     def test_new_record_with_minimal_args_should_set_defaults(self):
         self.write_test_script("test.py")
         proj = Project("test_project",
@@ -277,6 +294,14 @@ class TestProject(unittest.TestCase):
         proj.format_records('shell')
         proj.format_records('json')
 
+    def test__find_records__requires_all_tags_by_default(self):
+        proj = Project("test_project",
+                       record_store=MockRecordStore())
+        proj.find_records(tags=["a", "b"])
+        self.assertEqual(proj.record_store.query_filters, {"tags": None, "all_tags": ["a", "b"]})
+        proj.find_records(tags=["a", "b"], any_tags=True)
+        self.assertEqual(proj.record_store.query_filters, {"tags": ["a", "b"]})
+
     def test__get_record__calls_get_on_the_record_store(self):
         proj = Project("test_project",
                        record_store=MockRecordStore())
@@ -9,8 +9,14 @@ import tempfile
 import shutil
 import time
 import os
+import pickle
+import threading
+import warnings
 from pathlib import Path
-from sumatra.records import Record, RecordDifference, check_file_under_version_control
+import sumatra.records
+from sumatra.records import (Record, LazyRecord, RecordDifference, ModifiedDuringRunError,
+                             check_file_under_version_control)
+from sumatra.datastore import FileSystemDataStore
 
 
 class MockExecutable(object):
@@ -58,12 +64,15 @@ class MockDataStore(object):
     #    return [MockFile("1.dat"), MockFile("2.dat")]
     def copy(self):
         return self
+    def start_watching(self):
+        pass
     def find_new_data(self, timestamp):
         pass
 
 class MockDependency(object):
-    def __init__(self, name):
+    def __init__(self, name, path=None):
         self.name = name
+        self.path = path
 
 
 class MockWorkingCopy(object):
@@ -83,6 +92,131 @@ class TestRecord(unittest.TestCase):
                     999, MockLaunchMode(), MockDataStore(), {"a": 3}, label="A")
         r1.run(with_label='parameters')
 
+    def test_pickle_round_trip(self):
+        r1 = Record(MockExecutable("1"), MockRepository(), "test.py",
+                    999, MockLaunchMode(), MockDataStore(), {"a": 3}, label="A")
+        r2 = pickle.loads(pickle.dumps(r1))
+        self.assertEqual(r2.label, "A")
+        self.assertEqual(r2.parameters, {"a": 3})
+        self.assertFalse(hasattr(r2, "__dict__"))
+
+    def test_setstate_ignores_unused_attributes(self):
+        record = Record.__new__(Record)
+        record.__setstate__({"label": "A", "data_key": "['output.data']"})
+        self.assertEqual(record._attributes(), {"label": "A"})
+
+
+class MockRegistrationWorkingCopy(object):
+    def has_changed(self):
+        return False
+    def current_version(self):
+        return 999
+
+
+class TestBackgroundRegistration(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.main_file = os.path.join(self.tmpdir, "test.py")
+        self.dependency_file = os.path.join(self.tmpdir, "dependency.py")
+        for path in (self.main_file, self.dependency_file):
+            with open(path, "w") as f:
+                f.write("import os\n")
+        self.threads = []
+
+        def find_dependencies(filename, executable):
+            self.threads.append(threading.current_thread())
+            if self.error:
+                raise self.error
+            return [MockDependency("dependency", self.dependency_file)]
+        self.error = None
+        self.real_find_dependencies = sumatra.records.dependency_finder.find_dependencies
+        self.real_get_user = sumatra.records.get_user
+        sumatra.records.dependency_finder.find_dependencies = find_dependencies
+        sumatra.records.get_user = lambda working_copy: "user"
+        launch_mode = MockLaunchMode()
+        launch_mode.get_platform_information = lambda: ["platform"]
+        self.record = Record(MockExecutable("1"), MockRepository(), self.main_file,
+                             999, launch_mode, MockDataStore(), label="A")
+
+    def tearDown(self):
+        sumatra.records.dependency_finder.find_dependencies = self.real_find_dependencies
+        sumatra.records.get_user = self.real_get_user
+        shutil.rmtree(self.tmpdir)
+
+    def touch(self, path):
+        later = time.time() + 10
+        os.utime(path, (later, later))
+
+    def test_environment_is_captured_in_background(self):
+        registration = self.record.start_registration(MockRegistrationWorkingCopy())
+        self.record.run()
+        registration.finish(on_modified="error")
+        self.assertEqual([dep.name for dep in self.record.dependencies], ["dependency"])
+        self.assertEqual(self.record.platforms, ["platform"])
+        self.assertEqual(self.record.user, "user")
+        self.assertIsNot(self.threads[0], threading.current_thread())
+
+    def test_files_modified_during_run(self):
+        for path in (self.main_file, self.dependency_file):
+            registration = self.record.start_registration(MockRegistrationWorkingCopy())
+            self.touch(path)
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                registration.finish()
+            self.assertEqual(len(caught), 1)
+            self.assertIn(path, str(caught[0].message))
+            registration = self.record.start_registration(MockRegistrationWorkingCopy())
+            self.touch(path)
+            self.assertRaises(ModifiedDuringRunError, registration.finish, on_modified="error")
+
+    def test_errors_are_reported_as_warnings_by_finish(self):
+        self.error = IOError("no such file")
+        registration = self.record.start_registration(MockRegistrationWorkingCopy())
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            registration.finish(on_modified="error")
+        self.assertEqual(len(caught), 1)
+        self.assertIn("no such file", str(caught[0].message))
+        self.assertEqual(self.record.dependencies, [])
+
+
+class TestLazyRecord(unittest.TestCase):
+
+    def setUp(self):
+        record = Record(MockExecutable("1"), MockRepository(), "test.py",
+                        999, MockLaunchMode(), MockDataStore(), {"a": 3}, label="A",
+                        diff="+ changed")
+        self.calls = 0
+
+        def load():
+            self.calls += 1
+            return {"diff": "+ changed", "parameters": {"a": 3}, "output_data": [],
+                    "stdout_stderr": "done"}
+        self.record = LazyRecord(record, load)
+
+    def test_lazy_attributes_are_loaded_on_first_access(self):
+        self.assertEqual(self.record.label, "A")
+        self.assertEqual(self.calls, 0)
+        self.assertEqual(self.record.diff, "+ changed")
+        self.assertEqual(self.record.stdout_stderr, "done")
+        self.assertEqual(self.calls, 1)
+
+    def test_attributes_set_before_loading_are_kept(self):
+        self.record.stdout_stderr = "replaced"
+        self.assertEqual(self.record.parameters, {"a": 3})
+        self.assertEqual(self.record.stdout_stderr, "replaced")
+
+    def test_missing_attribute(self):
+        self.assertRaises(AttributeError, getattr, self.record, "dependencies")
+        self.assertRaises(AttributeError, getattr, self.record, "colour")
+
+    def test_pickling_loads_all_attributes(self):
+        copy = pickle.loads(pickle.dumps(self.record))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(copy.diff, "+ changed")
+        self.assertEqual(copy.label, "A")
+
 
 class TestHelperFunctions(unittest.TestCase):
 
@@ -196,6 +330,26 @@ class TestRecordDifference(unittest.TestCase):
         diff = RecordDifference(r1, r2)
         diff.output_data_differences
 
+    def test__output_data_differ__with_ignore_line_order(self):
+        root = tempfile.mkdtemp(prefix='sumatra-test-')
+        try:
+            datastore = FileSystemDataStore(root)
+            for filename, content in (("a.dat", b"1\n2\n3\n"), ("b.dat", b"3\n1\n2\n")):
+                with open(os.path.join(root, filename), "wb") as f:
+                    f.write(content)
+            r1 = Record(MockExecutable(), MockRepository(), "test.py",
+                        999, MockLaunchMode(), datastore, label="A")
+            r2 = Record(MockExecutable(), MockRepository(), "test.py",
+                        999, MockLaunchMode(), datastore, label="B")
+            r1.output_data = datastore.generate_keys("a.dat")
+            r2.output_data = datastore.generate_keys("b.dat")
+            self.assertEqual(RecordDifference(r1, r2).output_data_differ, True)
+            diff = RecordDifference(r1, r2, ignore_line_order=True)
+            self.assertEqual(diff.output_data_differ, False)
+            self.assertEqual(diff.output_data_differences, ([], []))
+        finally:
+            shutil.rmtree(root)
+
     def test__repr(self):
         r1 = Record(MockExecutable("1"), MockRepository(), "test.py",
                     999, MockLaunchMode(), MockDataStore(), {"a": 3}, label="A")
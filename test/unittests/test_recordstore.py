@@ -20,16 +20,17 @@ import shutil
 from datetime import datetime, timedelta
 from glob import glob
 
-from sumatra.records import Record
+from sumatra.records import Record, LazyRecord
 from sumatra.programs import Executable
 from sumatra.recordstore import (shelve_store, django_store, http_store,
-                                 serialization, get_record_store)
+                                 sqlite_store, serialization, binary, get_record_store)
 from sumatra.versioncontrol import vcs_list
 import sumatra.launch
 import sumatra.datastore
 import sumatra.parameters
 from sumatra.core import component
 import json
+import hashlib
 import urllib.parse
 
 
@@ -105,6 +106,8 @@ class MockParameterSet(object):
         return {}
     def pop(self, k, d):
         return None
+    def __str__(self):
+        return "{}"
 
 
 class MockRecord(object):
@@ -286,6 +289,89 @@ class BaseTestRecordStore(object):
         self.assertEqual(sorted(rec.label for rec in self.store.list(self.project.name)),
                          sorted(rec.label for rec in other_store.list(self.project.name)))
 
+    def test_digests(self):
+        self.add_some_records()
+        digests = self.store.digests(self.project.name)
+        self.assertEqual(sorted(digests), ["record1", "record2", "record3"])
+        r = self.store.get(self.project.name, "record1")
+        r.reason = "a different reason"
+        self.store.save(self.project.name, r)
+        self.assertNotEqual(self.store.digests(self.project.name)["record1"], digests["record1"])
+        self.assertEqual(self.store.digests(self.project.name)["record2"], digests["record2"])
+
+    def test_labels_are_most_recent_first(self):
+        self.add_some_records()
+        self.assertEqual(self.store.labels(self.project.name), ["record3", "record2", "record1"])
+
+    def test_export_to_file_and_import_from_file(self):
+        from io import StringIO
+        self.add_some_records()
+        fp = StringIO()
+        self.store.export_to_file(self.project.name, fp)
+        fp.seek(0)
+        other_store = shelve_store.ShelveRecordStore(shelf_name="test_record_store2")
+        other_store.import_from_file(self.project.name, fp)
+        self.assertEqual(sorted(other_store.labels(self.project.name)),
+                         ["record1", "record2", "record3"])
+
+    def test_export_and_import_binary(self):
+        from io import BytesIO
+        self.add_some_records()
+        fp = BytesIO()
+        self.store.export_to_file(self.project.name, fp, format="binary")
+        self.assertTrue(binary.is_binary(fp.getvalue()))
+        fp.seek(0)
+        other_store = shelve_store.ShelveRecordStore(shelf_name="test_record_store2")
+        other_store.import_from_file(self.project.name, fp, format="binary")
+        self.assertEqual(sorted(other_store.labels(self.project.name)),
+                         ["record1", "record2", "record3"])
+
+    def add_records_for_query(self):
+        for i, outcome in enumerate(["", "Converged", "did not converge"]):
+            r = MockRecord("record%d" % (i + 1), timestamp=datetime(2015, 3, 1, 12, i))
+            r.outcome = outcome
+            if i > 0:
+                r.tags.add("tag%d" % i)
+            self.store.save(self.project.name, r)
+
+    def query_labels(self, **kwargs):
+        return [record.label for record in self.store.query(self.project.name, **kwargs)]
+
+    def test_query_without_filters_returns_most_recent_first(self):
+        self.add_records_for_query()
+        self.assertEqual(self.query_labels(), ["record3", "record2", "record1"])
+        self.assertEqual(self.query_labels(order_by="timestamp"), ["record1", "record2", "record3"])
+        self.assertEqual(self.query_labels(order_by="-label"), ["record3", "record2", "record1"])
+
+    def test_query_with_limit_and_offset(self):
+        self.add_records_for_query()
+        self.assertEqual(self.query_labels(limit=2), ["record3", "record2"])
+        self.assertEqual(self.query_labels(limit=1, offset=1), ["record2"])
+        self.assertEqual(self.query_labels(offset=2), ["record1"])
+
+    def test_query_with_filters(self):
+        self.add_records_for_query()
+        self.assertEqual(self.query_labels(tags="tag1"), ["record2"])
+        self.assertEqual(self.query_labels(tags=["tag1", "tag2"]), ["record3", "record2"])
+        self.assertEqual(self.query_labels(since=datetime(2015, 3, 1, 12, 1)), ["record3", "record2"])
+        self.assertEqual(self.query_labels(until=datetime(2015, 3, 1, 12, 1)), ["record2", "record1"])
+        self.assertEqual(self.query_labels(outcome="converge"), ["record3", "record2"])
+        self.assertEqual(self.query_labels(user="michaelpälin", tags="tag2"), ["record3"])
+        self.assertEqual(self.query_labels(user="nobody"), [])
+        self.assertEqual(self.query_labels(main_file="test", version="99863a9dc5f", limit=1),
+                         ["record3"])
+
+    def test_query_with_all_tags(self):
+        self.add_some_records()
+        self.add_some_tags()
+        self.assertEqual(self.query_labels(all_tags="tag1"), ["record3", "record1"])
+        self.assertEqual(self.query_labels(all_tags=["tag1", "tag2"]), ["record1"])
+        self.assertEqual(self.query_labels(tags="tag2", all_tags=["tag1"]), ["record1"])
+        self.assertEqual(self.query_labels(all_tags=["tag1", "tag3"]), [])
+
+    def test_query_with_unknown_filter(self):
+        self.assertRaises(TypeError, self.store.query, self.project.name, colour="red")
+
     def test_update(self):
         self.add_some_records()
         self.store.update(self.project.name, "datastore.root", "/new/path/to/store")
@@ -316,6 +402,229 @@ class TestShelveRecordStore(unittest.TestCase, BaseTestRecordStore):
         self.store = pickle.loads(s)
         self.assertEqual(self.store._shelf_name, "test_record_store")
 
+    def test_sync_reports_differing_records(self):
+        self.add_some_records()
+        other_store = shelve_store.ShelveRecordStore(shelf_name="test_record_store2")
+        self.store.sync(other_store, self.project.name)
+        r = other_store.get(self.project.name, "record2")
+        r.duration = 1.0
+        other_store.save(self.project.name, r)
+        self.assertEqual(self.store.sync(other_store, self.project.name), ["record2"])
+
+    def test_upgrade_from_single_dict_layout(self):
+        import shelve
+        del self.store
+        old_shelf = shelve.open("old_record_store")
+        old_shelf[self.project.name.__str__()] = dict((r.label, r) for r in
+                                                      (MockRecord("record1"), MockRecord("record2")))
+        old_shelf.close()
+        self.store = shelve_store.ShelveRecordStore(shelf_name="old_record_store")
+        self.assertEqual(self.store.list_projects(), [self.project.name])
+        self.assertEqual(sorted(self.store.labels(self.project.name)), ["record1", "record2"])
+        self.assertEqual(self.store.get(self.project.name, "record2").label, "record2")
+
+    def test_upgrade_adds_digests_to_index(self):
+        import shelve
+        import pickle
+        del self.store
+        records = [MockRecord("record1"), MockRecord("record2")]
+        old_shelf = shelve.open("old_record_store")
+        for record in records:
+            old_shelf[shelve_store._record_key(self.project.name, record.label)] = pickle.dumps(record)
+        old_shelf[shelve_store._index_key(self.project.name)] = dict(
+            (r.label, (r.timestamp, frozenset(r.tags))) for r in records)
+        old_shelf[shelve_store.LAYOUT_KEY] = 2
+        old_shelf.close()
+        self.store = shelve_store.ShelveRecordStore(shelf_name="old_record_store")
+        self.assertEqual(self.store.shelf[shelve_store.LAYOUT_KEY], shelve_store.LAYOUT_VERSION)
+        self.assertEqual(self.store.digests(self.project.name),
+                         dict((r.label, serialization.record_digest(r)) for r in records))
+
+    def test_listed_records_have_all_attributes(self):
+        self.add_some_records()
+        for listed in self.store.list(self.project.name):
+            record = self.store.get(self.project.name, listed.label)
+            for name in ("stdout_stderr", "diff", "input_data", "output_data", "reason", "user",
+                         "tags"):
+                self.assertEqual(getattr(listed, name), getattr(record, name))
+            self.assertEqual(len(listed.dependencies), len(record.dependencies))
+            self.assertEqual(len(listed.platforms), len(record.platforms))
+            self.assertEqual(listed.parameters.as_dict(), record.parameters.as_dict())
+
+    def test_tag_counts(self):
+        self.add_some_records()
+        self.add_some_tags()
+        self.assertEqual(self.store.tag_counts(self.project.name), {"tag1": 2, "tag2": 1})
+        self.assertEqual(self.store.tag_counts("no_such_project"), {})
+
+    def test_add_and_remove_tags(self):
+        self.add_some_records()
+        self.add_some_tags()
+        self.store.add_tags(self.project.name, ["record1", "record2"], ["tag2", "tag3"])
+        self.assertEqual(self.store.get(self.project.name, "record1").tags,
+                         set(["tag1", "tag2", "tag3"]))
+        self.assertEqual(self.store.get(self.project.name, "record2").tags,
+                         set(["tag2", "tag3"]))
+        self.store.remove_tags(self.project.name, ["record1", "record3"], ["tag1"])
+        self.assertEqual(self.store.tag_counts(self.project.name),
+                         {"tag2": 2, "tag3": 2})
+
+    def test_has_project(self):
+        self.assertFalse(self.store.has_project(self.project.name))
+        self.add_some_records()
+        self.assertTrue(self.store.has_project(self.project.name))
+
+    def test_shared_objects_are_stored_once(self):
+        self.add_some_records()
+        object_keys = [key for key in self.store.shelf.keys() if key.startswith("object:")]
+        self.assertEqual(len(object_keys), 1)  # the executable
+        del self.store
+        self.store = shelve_store.ShelveRecordStore(shelf_name="test_record_store")
+        records = self.store.list(self.project.name)
+        self.assertEqual(len(records), 3)
+        self.assertIs(records[0].executable, records[1].executable)
+        self.assertIs(records[0].executable, self.store.get(self.project.name, "record3").executable)
+
+    def test_large_texts_are_stored_once_as_blobs(self):
+        with open(os.path.join(this_directory, "example_0.7.json")) as fp:
+            data = json.load(fp)
+        diff = "+ a changed line\n" * 1000
+        for label in ("record1", "record2"):
+            record = serialization.build_record(dict(data, label=label, diff=diff))
+            self.store.save(self.project.name, record)
+        blob_keys = [key for key in self.store.shelf.keys() if key.startswith("blob:")]
+        self.assertEqual(len(blob_keys), 1)
+        record = self.store.get(self.project.name, "record2")
+        self.assertIsInstance(record, LazyRecord)
+        self.assertEqual(record.diff, diff)
+
+    def test_collect_garbage_removes_unused_objects_and_blobs(self):
+        with open(os.path.join(this_directory, "example_0.7.json")) as fp:
+            data = json.load(fp)
+        for label, diff in (("record1", "+ a changed line\n" * 1000),
+                            ("record2", "+ a changed line\n" * 1000),
+                            ("record3", "- a removed line\n" * 1000)):
+            self.store.save(self.project.name, serialization.build_record(dict(data, label=label, diff=diff)))
+        self.assertEqual(self.store.collect_garbage(), 0)
+        self.store.delete(self.project.name, "record1")
+        self.assertEqual(self.store.collect_garbage(), 0)  # still used by record2
+        self.store.delete(self.project.name, "record3")
+        self.assertEqual(self.store.collect_garbage(), 1)
+        blob_keys = [key for key in self.store.shelf.keys() if key.startswith("blob:")]
+        self.assertEqual(len(blob_keys), 1)
+        self.assertEqual(self.store.get(self.project.name, "record2").diff, "+ a changed line\n" * 1000)
+        self.store.delete(self.project.name, "record2")
+        self.assertGreater(self.store.collect_garbage(), 1)
+        self.assertEqual([key for key in self.store.shelf.keys()
+                          if key.startswith("object:") or key.startswith("blob:")], [])
+        # objects which have been collected are stored again when needed
+        self.store.save(self.project.name, serialization.build_record(dict(data, label="record4")))
+        del self.store
+        self.store = shelve_store.ShelveRecordStore(shelf_name="test_record_store")
+        self.assertEqual(self.store.get(self.project.name, "record4").executable.name, data["executable"]["name"])
+
+
+class TestSQLiteRecordStore(unittest.TestCase, BaseTestRecordStore):
+
+    def setUp(self):
+        BaseTestRecordStore.setUp(self)
+        self.store = sqlite_store.SQLiteRecordStore(db_file="test_record_store.sqlite")
+        self.project = MockProject()
+
+    def tearDown(self):
+        del self.store
+        BaseTestRecordStore.tearDown(self)
+
+    def test_record_store_is_pickleable(self):
+        import pickle
+        self.add_some_records()
+        s = pickle.dumps(self.store)
+        del self.store
+        self.store = pickle.loads(s)
+        self.assertEqual(len(self.store.list(self.project.name)), 3)
+
+    def test_list_returns_most_recent_first(self):
+        self.add_some_records()
+        self.assertEqual([rec.label for rec in self.store.list(self.project.name)],
+                         ["record3", "record2", "record1"])
+
+    def test_tag_matching_is_exact(self):
+        self.add_some_records()
+        self.add_some_tags()
+        self.assertEqual(self.store.list(self.project.name, "tag"), [])
+
+    def test_save_replaces_tags(self):
+        self.add_some_records()
+        self.add_some_tags()
+        r = self.store.get(self.project.name, "record1")
+        r.tags.remove("tag1")
+        self.store.save(self.project.name, r)
+        self.assertEqual(len(self.store.list(self.project.name, "tag1")), 1)
+
+    def test_list_returns_lazy_records(self):
+        if not self.store._lazy:
+            raise unittest.SkipTest("SQLite was built without JSON support")
+        self.add_some_records()
+        record = self.store.query(self.project.name, limit=1)[0]
+        self.assertIsInstance(record, LazyRecord)
+        self.assertNotIn("stdout_stderr", record._attributes())
+        self.assertEqual(record.label, "record3")
+        self.assertEqual(record.stdout_stderr, "ok")
+        self.assertEqual(len(record.dependencies), 2)
+
+    def test_listed_records_have_all_attributes(self):
+        self.add_some_records()
+        for listed in self.store.list(self.project.name):
+            record = self.store.get(self.project.name, listed.label)
+            for name in ("stdout_stderr", "diff", "input_data", "output_data", "reason", "user",
+                         "tags"):
+                self.assertEqual(getattr(listed, name), getattr(record, name))
+            self.assertEqual(len(listed.dependencies), len(record.dependencies))
+            self.assertEqual(len(listed.platforms), len(record.platforms))
+            self.assertEqual(listed.parameters.as_dict(), record.parameters.as_dict())
+
+    def test_large_texts_are_stored_once_as_blobs(self):
+        now = datetime.now()
+        for i, label in enumerate(("record1", "record2")):
+            record = MockRecord(label, timestamp=now - timedelta(seconds=i))
+            record.stdout_stderr = "step\n" * 1000
+            self.store.save(self.project.name, record)
+        self.assertEqual(self.store._execute("SELECT COUNT(*) FROM blob").fetchone()[0], 1)
+        self.assertNotIn("step", self.store._execute("SELECT data FROM record").fetchone()[0])
+        self.assertEqual(self.store.get(self.project.name, "record1").stdout_stderr, "step\n" * 1000)
+        self.store.delete(self.project.name, "record1")
+        self.assertEqual(self.store._execute("SELECT COUNT(*) FROM blob").fetchone()[0], 1)
+        self.store.delete(self.project.name, "record2")
+        self.assertEqual(self.store._execute("SELECT COUNT(*) FROM blob").fetchone()[0], 0)
+
+    def test_tag_counts(self):
+        self.add_some_records()
+        self.add_some_tags()
+        self.assertEqual(self.store.tag_counts(self.project.name), {"tag1": 2, "tag2": 1})
+        self.assertEqual(self.store.tag_counts("no_such_project"), {})
+
+    def test_add_and_remove_tags(self):
+        self.add_some_records()
+        self.add_some_tags()
+        self.store.add_tags(self.project.name, ["record1", "record2"], ["tag2", "tag3"])
+        self.assertEqual(self.store.get(self.project.name, "record1").tags,
+                         set(["tag1", "tag2", "tag3"]))
+        self.assertEqual(self.store.get(self.project.name, "record2").tags,
+                         set(["tag2", "tag3"]))
+        self.store.remove_tags(self.project.name, ["record1", "record3"], ["tag1"])
+        self.assertEqual(self.store.tag_counts(self.project.name),
+                         {"tag2": 2, "tag3": 2})
+
+    def test_has_project(self):
+        self.assertFalse(self.store.has_project(self.project.name))
+        self.add_some_records()
+        self.assertTrue(self.store.has_project(self.project.name))
+        self.assertEqual(self.store.list_projects(), [self.project.name])
+
+    def test_uses_wal_mode(self):
+        mode, = self.store._connection.execute("PRAGMA journal_mode").fetchone()
+        self.assertEqual(mode, "wal")
+
 
 class TestDjangoRecordStore(unittest.TestCase, BaseTestRecordStore):
 
@@ -338,9 +647,93 @@ class TestDjangoRecordStore(unittest.TestCase, BaseTestRecordStore):
         #assert unpickled._shelf_name == "test_record_store"
         #assert os.path.exists(unpickled._shelf_name)
 
-
-class MockResponse(object):
-    def __init__(self, status):
+    def test_save_record_with_many_data_keys(self):
+        r1 = MockRecord("record1")
+        r1.output_data = [sumatra.datastore.DataKey("output%d.dat" % i, "%040d" % i,
+                                                    datetime(2015, 1, 1), size=i)
+                          for i in range(1000)]
+        r1.input_data = r1.output_data[:3]
+        r2 = MockRecord("record2", timestamp=datetime.now() + timedelta(seconds=1))
+        r2.input_data = r1.output_data[:10]
+        self.store.save_many(self.project.name, [r1, r2])
+        r1_copy = self.store.get(self.project.name, "record1")
+        self.assertEqual(len(r1_copy.output_data), 1000)
+        self.assertEqual(len(r1_copy.input_data), 3)
+        self.assertEqual(len(self.store.get(self.project.name, "record2").input_data), 10)
+        # saving again reuses the existing data keys
+        self.store.save(self.project.name, r1_copy)
+        models = self.store._get_models()
+        self.assertEqual(models.DataKey.objects.using(self.store._db_label).count(), 1000)
+
+    def test_tags_are_migrated_from_tag_column(self):
+        self.add_some_records()
+        models = self.store._get_models()
+        db_records = models.Record.objects.using(self.store._db_label)
+        # records saved by earlier versions have their tags only in the "tags" column
+        db_records.filter(label="record1").update(tags='tag1, "tag two"')
+        models.SchemaVersion.objects.using(self.store._db_label).all().delete()
+        models.upgrade_schema(using=self.store._db_label)
+        self.assertEqual(self.store.get(self.project.name, "record1").tags,
+                         set(["tag1", "tag two"]))
+        self.assertEqual(db_records.exclude(tags="").count(), 0)
+        self.assertEqual(len(self.store.list(self.project.name, "tag two")), 1)
+        # once the database has been upgraded, the record table is not scanned again
+        db_records.filter(label="record2").update(tags="tag3")
+        models.upgrade_schema(using=self.store._db_label)
+        self.assertEqual(db_records.exclude(tags="").count(), 1)
+
+    def expected_digests(self):
+        return dict((record.label, serialization.record_digest(record))
+                    for record in self.store.list(self.project.name))
+
+    def test_digests_are_kept_up_to_date(self):
+        record = MockRecord("record1")
+        self.store.save(self.project.name, record)
+        self.assertEqual(self.store.digests(self.project.name),
+                         {"record1": serialization.record_digest(record)})
+        # adding tags in the database invalidates the digest, which is
+        # recalculated when it is next needed
+        self.store.add_tags(self.project.name, ["record1"], ["tag1"])
+        self.assertEqual(self.store.digests(self.project.name), self.expected_digests())
+
+    def test_digest_column_is_added_by_upgrade_schema(self):
+        from django.db import connections
+        self.add_some_records()
+        models = self.store._get_models()
+        # databases created by earlier versions have no digest column
+        connections[self.store._db_label].cursor().execute(
+            "ALTER TABLE django_store_record DROP COLUMN digest")
+        models.SchemaVersion.objects.using(self.store._db_label).all().delete()
+        models.upgrade_schema(using=self.store._db_label)
+        self.assertEqual(self.store.digests(self.project.name), self.expected_digests())
+        self.assertEqual(models.SchemaVersion.objects.using(self.store._db_label).get().version,
+                         models.SCHEMA_VERSION)
+
+    def test_list_uses_constant_number_of_queries(self):
+        from django.db import connections
+        from django.test.utils import CaptureQueriesContext
+        now = datetime.now()
+        counts = []
+        for n in (2, 6):
+            for i in range(n):
+                record = MockRecord("record%d_%d" % (n, i), timestamp=now - timedelta(seconds=i))
+                record.tags.add("tag%d" % i)
+                self.store.save(self.project.name, record)
+            with CaptureQueriesContext(connections[self.store._db_label]) as queries:
+                records = self.store.list(self.project.name)
+                for record in records:
+                    record.output_data, record.diff
+            counts.append(len(queries))
+            self.store.delete_all()
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(len(records), 6)
+        self.assertEqual(set(records[0].tags), set(["tag0"]))
+
+
+class MockResponse(dict):
+    # like httplib2.Response, a dict of (lower-case) headers with a status
+    def __init__(self, status, **headers):
+        dict.__init__(self, headers)
         self.status = status
 
 
@@ -356,20 +749,53 @@ def check_record(record):
                                       "script_arguments", "stdout_stderr",
                                       "input_datastore", "repeats"])
 
+def filter_records(records, params):
+    """Filter and sort encoded records as a server supporting queries would."""
+    for name in ("user", "version", "main_file"):
+        if name in params:
+            records = [record for record in records if record[name] == params[name]]
+    if "outcome" in params:
+        records = [record for record in records
+                   if params["outcome"].lower() in (record["outcome"] or "").lower()]
+    if "since" in params:
+        records = [record for record in records if record["timestamp"] >= params["since"]]
+    if "until" in params:
+        records = [record for record in records if record["timestamp"] <= params["until"]]
+    order_by = params.get("order_by", "label")
+    return sorted(records, key=lambda record: record[order_by.lstrip("-")],
+                  reverse=order_by.startswith("-"))
+
+
 class MockCredentials(object):
         credentials = [['domain', 'username', 'password']]
 
 class MockHttp(object):
-    def __init__(self, *args, **kwargs):
-        self.records = {}
-        self.debug = False
-        self.last_record = None
-        self.credentials = MockCredentials()
+    # all clients created by the same MockHttpLib share their state, as if
+    # they were connected to the same server
+    def __init__(self, shared_state, *args, **kwargs):
+        self.__dict__ = shared_state
+        if not shared_state:
+            self.records = {}
+            self.debug = False
+            self.last_record = None
+            self.credentials = MockCredentials()
+            self.supports_batches = True
+            self.supports_binary = False
+            self.requests = []
+            self.n_unavailable = 0
     def add_credentials(self, *args, **kwargs):
         pass
     def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        self.requests.append((method, uri))
+        if self.n_unavailable > 0:
+            self.n_unavailable -= 1
+            return MockResponse(503), ""
         u = urllib.parse.urlparse(uri)
         parts = u.path.split("/")[1:-1]
+        query = urllib.parse.parse_qs(u.query)
+        accept = (headers or {}).get("Accept", "")
+        binary_requested = self.supports_binary and "+smtb" in accept
+        response_headers = {}
         if self.debug:
             print("\n<<<<< %s %s %d %s %s %s %s %s" % (uri, u.path, len(parts),
                                                        method, body, headers,
@@ -377,7 +803,12 @@ class MockHttp(object):
 
         if len(parts) == 2:  # record uri
             if method == "PUT":
-                record = json.loads(body)
+                if headers["Content-Type"].endswith("+smtb"):
+                    if not self.supports_binary:
+                        return MockResponse(415), ""
+                    record = json.loads(serialization.encode_record(binary.decode_record(body)))
+                else:
+                    record = json.loads(body)
                 check_record(record)
                 self.records[parts[1]] = record
                 content = ""
@@ -385,10 +816,12 @@ class MockHttp(object):
                 self.last_record = record
             elif method == "GET":
                 label = parts[1]
-                if label == "last":
-                    content = json.dumps(self.last_record)
+                record = self.last_record if label == "last" else self.records[label]
+                if binary_requested:
+                    content = binary.encode_record(serialization.build_record(record))
+                    response_headers["content-type"] = "application/vnd.sumatra.record-v4+smtb"
                 else:
-                    content = json.dumps(self.records[label])
+                    content = json.dumps(record)
                 status = 200
             elif method == "DELETE":
                 self.records.pop(parts[1])
@@ -401,18 +834,46 @@ class MockHttp(object):
                 status = 204
         elif len(parts) == 1:  # project uri
             if method == "GET":
-                if u.query:
-                    tags = u.query.split("=")[1].split(",")
-                    records = set([])
-                    for tag in tags:
-                        records = records.union(["%s://%s/%s/%s/" % (
-                            u.scheme, u.netloc, parts[0], path)
-                            for path in self.records.keys() if tag in self.records[path]['tags']])
-                    records = list(records)
+                if "tags" in query:
+                    tags = query["tags"][0].split(",")
+                    labels = sorted(label for label in self.records
+                                    if any(tag in self.records[label]['tags'] for tag in tags))
+                else:
+                    labels = sorted(self.records.keys())
+                if self.supports_batches and "label-list" in accept:
+                    content = json.dumps(sorted(labels, key=lambda label: self.records[label]["timestamp"],
+                                                reverse=True))
+                elif self.supports_batches and "digest-list" in accept:
+                    content = json.dumps(dict(
+                        (label, hashlib.sha1(json.dumps(self.records[label], sort_keys=True).encode('utf-8')).hexdigest())
+                        for label in labels))
+                elif self.supports_batches and "record-list" in accept:
+                    params = dict((name, values[0]) for name, values in query.items())
+                    records = filter_records([self.records[label] for label in labels], params)
+                    offset = int(params["offset"])
+                    limit = int(params["limit"])
+                    if offset + limit < len(records):
+                        params["offset"] = offset + limit
+                        next_page = "%s://%s%s?%s" % (u.scheme, u.netloc, u.path,
+                                                      urllib.parse.urlencode(params))
+                    else:
+                        next_page = None
+                    if binary_requested:
+                        from io import BytesIO
+                        fp = BytesIO()
+                        binary.dump_records([serialization.build_record(record)
+                                             for record in records[offset:offset + limit]], fp)
+                        content = fp.getvalue()
+                        response_headers["content-type"] = "application/vnd.sumatra.record-list-v4+smtb"
+                        if next_page:
+                            response_headers["link"] = '<%s>; rel="next"' % next_page
+                    else:
+                        content = json.dumps({"records": records[offset:offset + limit],
+                                              "next": next_page})
                 else:
-                    records = ["%s://%s/%s/%s/" % (u.scheme, u.netloc, parts[0], path)
-                               for path in self.records.keys()]
-                content = json.dumps({"records": records, "name": "TestProject", "description": ""})
+                    records = ["%s://%s/%s/%s/" % (u.scheme, u.netloc, parts[0], label)
+                               for label in labels]
+                    content = json.dumps({"records": records, "name": "TestProject", "description": ""})
                 status = 200
             elif method == "PUT":
                 content = ""
@@ -432,32 +893,30 @@ class MockHttp(object):
             content = '[{"id": "TestProject"}]'
         if self.debug:
             print(">>>>> %s %s" % (status, content))
-        return MockResponse(status), content
+        return MockResponse(status, **response_headers), content
 
 
 class MockHttpLib(object):
 
-    @staticmethod
-    def Http(*args, **kwargs):
-        return MockHttp(*args, **kwargs)
+    def __init__(self):
+        self.shared_state = {}
 
+    def Http(self, *args, **kwargs):
+        return MockHttp(self.shared_state, *args, **kwargs)
 
-class TestHttpRecordStore(unittest.TestCase, BaseTestRecordStore):
 
-    def __init__(self, *args, **kwargs):
-        unittest.TestCase.__init__(self, *args, **kwargs)
-        self.real_httplib = http_store.httplib2
-        http_store.httplib2 = MockHttpLib()
-
-    def __del__(self):
-        http_store.httplib2 = self.real_httplib
+class TestHttpRecordStore(unittest.TestCase, BaseTestRecordStore):
 
     def setUp(self):
         BaseTestRecordStore.setUp(self)
-        self.store = http_store.HttpRecordStore("http://127.0.0.1:8000/", "testuser", "z6Ty49HY")
+        self.real_httplib = http_store.httplib2
+        http_store.httplib2 = MockHttpLib()
+        self.store = http_store.HttpRecordStore("http://127.0.0.1:8000/", "testuser", "z6Ty49HY",
+                                                retry_backoff=0)
         self.project = MockProject()
 
     def tearDown(self):
+        http_store.httplib2 = self.real_httplib
         BaseTestRecordStore.tearDown(self)
 
     def test_record_store_is_pickleable(self):
@@ -485,6 +944,100 @@ class TestHttpRecordStore(unittest.TestCase, BaseTestRecordStore):
     def test_clear(self):
         pass  # override base class test to avoid UserWarning
 
+    def test_list_retrieves_records_in_batches(self):
+        self.add_some_records()
+        self.store.batch_size = 2
+        self.store.client.requests = []
+        records = self.store.list(self.project.name)
+        self.assertEqual(sorted(rec.label for rec in records), ["record1", "record2", "record3"])
+        self.assertEqual(len(self.store.client.requests), 2)
+
+    def test_list_without_batch_support(self):
+        self.add_some_records()
+        self.add_some_tags()
+        self.store.client.supports_batches = False
+        self.store.client.requests = []
+        records = self.store.list(self.project.name, "tag1")
+        self.assertEqual(sorted(rec.label for rec in records), ["record1", "record3"])
+        self.assertEqual(len(self.store.client.requests), 3)
+
+    def test_query_is_passed_to_server(self):
+        self.add_records_for_query()
+        self.store.client.requests = []
+        self.assertEqual(self.query_labels(outcome="converge", limit=1), ["record3"])
+        self.assertEqual(len(self.store.client.requests), 1)
+        method, url = self.store.client.requests[0]
+        self.assertIn("outcome=converge", url)
+        self.assertIn("limit=1", url)
+
+    def test_query_without_batch_support(self):
+        self.add_records_for_query()
+        self.store.client.supports_batches = False
+        self.assertEqual(self.query_labels(outcome="converge", limit=1, offset=1), ["record2"])
+
+    def test_binary_transfer(self):
+        self.store.binary = True
+        self.store.client.supports_binary = True
+        self.add_some_records()
+        self.add_some_tags()
+        record = self.store.get(self.project.name, "record1")
+        self.assertEqual(record.label, "record1")
+        self.assertEqual(record.user, "michaelpälin")
+        self.assertEqual(sorted(rec.label for rec in self.store.list(self.project.name, "tag1")),
+                         ["record1", "record3"])
+
+    def test_binary_query(self):
+        self.store.binary = True
+        self.store.client.supports_binary = True
+        self.add_records_for_query()
+        self.assertEqual(self.query_labels(order_by="timestamp", limit=2, offset=1),
+                         ["record2", "record3"])
+
+    def test_binary_falls_back_to_json(self):
+        self.store.binary = True
+        self.add_some_records()
+        self.assertFalse(self.store.binary)
+        self.assertEqual(self.store.get(self.project.name, "record1").label, "record1")
+        self.assertEqual(len(self.store.list(self.project.name)), 3)
+
+    def test_save_many_and_get_many(self):
+        now = datetime.now()
+        records = [MockRecord("record%d" % i, timestamp=now - timedelta(seconds=i))
+                   for i in range(10)]
+        self.store.save_many(self.project.name, records)
+        retrieved = self.store.get_many(self.project.name, ["record3", "record7"])
+        self.assertEqual([rec.label for rec in retrieved], ["record3", "record7"])
+        self.assertEqual(len(self.store.labels(self.project.name)), 10)
+
+    def test_retry_when_server_unavailable(self):
+        self.add_some_records()
+        self.store.client.n_unavailable = 2
+        self.assertEqual(self.store.get(self.project.name, "record1").label, "record1")
+
+    def test_give_up_after_max_retries(self):
+        self.add_some_records()
+        self.store.client.n_unavailable = self.store.max_retries + 1
+        self.assertRaises(http_store.RecordStoreAccessError,
+                          self.store.get, self.project.name, "record1")
+
+    def test_sync_only_transfers_changed_records(self):
+        self.add_some_records()
+        other_store = shelve_store.ShelveRecordStore(shelf_name="test_record_store2")
+        self.store.sync(other_store, self.project.name)
+        other_store.save(self.project.name, MockRecord("record4"))
+        self.store.client.requests = []
+        self.assertEqual(self.store.sync(other_store, self.project.name), [])
+        self.assertEqual(len(self.store.client.requests), 4)  # has_project, digest-list, has_project, PUT
+
+    def test_labels_uses_a_single_request(self):
+        self.add_some_records()
+        for supports_batches in (True, False):
+            self.store.client.supports_batches = supports_batches
+            self.store.client.requests = []
+            self.assertEqual(sorted(self.store.labels(self.project.name)),
+                             ["record1", "record2", "record3"])
+            self.assertEqual(len(self.store.client.requests), 1)
+
 
 class TestSerialization(unittest.TestCase):
     maxDiff = None
@@ -509,6 +1062,16 @@ class TestSerialization(unittest.TestCase):
             record = serialization.build_record(json.load(fp))
         self.assertEqual(record.label, "haggling")
 
+    def test_build_record_shares_sub_objects(self):
+        with open(os.path.join(this_directory, "example_0.7.json")) as fp:
+            data = json.load(fp)
+        record1 = serialization.build_record(data)
+        record2 = serialization.build_record(data)
+        for name in ("executable", "repository", "launch_mode", "datastore"):
+            self.assertIs(getattr(record1, name), getattr(record2, name))
+        self.assertIs(record1.dependencies[0], record2.dependencies[0])
+        self.assertIs(record1.platforms[0], record2.platforms[0])
+
     def test_round_trip(self):
         with open(os.path.join(this_directory, "example_0.7.json")) as fp:
             data_in = json.load(fp)
@@ -520,10 +1083,77 @@ class TestSerialization(unittest.TestCase):
         data_out['tags'] = sorted(data_out['tags'])
         self.assertEqual(data_in, data_out)
 
+    def test_dump_and_load_records(self):
+        from io import StringIO
+        with open(os.path.join(this_directory, "example_0.7.json")) as fp:
+            record = serialization.build_record(json.load(fp))
+        for indent in (None, 2):
+            fp = StringIO()
+            serialization.dump_records([record, record], fp, indent=indent)
+            fp.seek(0)
+            self.assertEqual(len(serialization.decode_records(fp.read())), 2)
+            fp.seek(0)
+            records = list(serialization.load_records(fp, chunk_size=100))
+            self.assertEqual([r.label for r in records], ["haggling", "haggling"])
+            self.assertEqual(serialization.record_digest(records[1]),
+                             serialization.record_digest(record))
+
+    def test_load_records_empty_and_invalid(self):
+        from io import StringIO
+        self.assertEqual(list(serialization.load_records(StringIO(" [ ] "))), [])
+        self.assertRaises(ValueError, list, serialization.load_records(StringIO("")))
+        self.assertRaises(ValueError, list, serialization.load_records(StringIO("{}")))
+        self.assertRaises(ValueError, list, serialization.load_records(StringIO("[{\"label\": ")))
+
     def test_encode_project_info(self):
         serialization.encode_project_info("foo", "description of foo")
 
 
+class TestBinarySerialization(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        with open(os.path.join(this_directory, "example_0.7.json")) as fp:
+            self.record = serialization.build_record(json.load(fp))
+
+    def test_round_trip(self):
+        from sumatra.formatting import record2dict
+        content = binary.encode_record(self.record)
+        self.assertTrue(binary.is_binary(content))
+        self.assertEqual(record2dict(binary.decode_record(content)), record2dict(self.record))
+
+    def test_dump_and_load_records(self):
+        from io import BytesIO
+        fp = BytesIO()
+        binary.dump_records([self.record, self.record], fp)
+        self.assertEqual(len(binary.decode_records(fp.getvalue())), 2)
+        fp.seek(0)
+        records = list(binary.load_records(fp))
+        self.assertEqual([r.label for r in records], ["haggling", "haggling"])
+        self.assertEqual(serialization.record_digest(records[1]),
+                         serialization.record_digest(self.record))
+        # identical sub-objects are shared between the records
+        self.assertIs(records[0].executable, records[1].executable)
+        self.assertIs(records[0].platforms[0], records[1].platforms[0])
+
+    def test_strings_are_shared_between_records(self):
+        from io import BytesIO
+        fp1, fp2 = BytesIO(), BytesIO()
+        binary.dump_records([self.record], fp1)
+        binary.dump_records([self.record] * 10, fp2)
+        self.assertLess(len(fp2.getvalue()), 10 * len(fp1.getvalue()) // 2)
+
+    def test_invalid_content(self):
+        from io import BytesIO
+        self.assertFalse(binary.is_binary('[{"label": "haggling"}]'))
+        self.assertEqual(list(binary.load_records(BytesIO(binary.MAGIC + b"\x01"))), [])
+        self.assertRaises(binary.BinaryFormatError, binary.decode_record, b"JSON")
+        self.assertRaises(binary.BinaryFormatError, binary.decode_record,
+                          binary.MAGIC + bytes(bytearray([binary.FORMAT_VERSION + 1])))
+        content = binary.encode_record(self.record)
+        self.assertRaises(binary.BinaryFormatError, binary.decode_record, content[:-10])
+
+
 class TestModuleFunctions(unittest.TestCase):
 
     def setUp(self):
@@ -549,6 +1179,12 @@ class TestModuleFunctions(unittest.TestCase):
         self.assertIsInstance(get_record_store("test_record_store.shelf"),
                               shelve_store.ShelveRecordStore)
 
+    def test_get_record_store_sqlite(self):
+        self.assertIsInstance(get_record_store("sqlite://test_record_store.db"),
+                              sqlite_store.SQLiteRecordStore)
+        self.assertIsInstance(get_record_store("test_record_store.sqlite"),
+                              sqlite_store.SQLiteRecordStore)
+
     def test_get_record_store_create_shelve(self):
         assert len(glob("test_record_store.shelf*")) == 0
         self.assertIsInstance(get_record_store("test_record_store.shelf"),
@@ -43,6 +43,27 @@ class TestWebInterface(unittest.TestCase):
                          [b[1]])
 
 
+    def test__parse_byte_range(self):
+        from sumatra.web.views import parse_byte_range
+        self.assertEqual(parse_byte_range(None, 100), None)
+        self.assertEqual(parse_byte_range("bytes=0-9", 100), (0, 10))
+        self.assertEqual(parse_byte_range("bytes=90-", 100), (90, 100))
+        self.assertEqual(parse_byte_range("bytes=-10", 100), (90, 100))
+        self.assertEqual(parse_byte_range("bytes=50-200", 100), (50, 100))
+        self.assertEqual(parse_byte_range("bytes=0-9,20-29", 100), None)
+        self.assertRaises(ValueError, parse_byte_range, "bytes=100-", 100)
+
+    def test__parse_paging_parameters(self):
+        from sumatra.web.views import parse_paging_parameters
+        self.assertEqual(parse_paging_parameters({}), (10 * 1024, 0, 200))
+        self.assertEqual(parse_paging_parameters({"offset": "20", "lines": "10", "truncate": "5"}),
+                         (5 * 1024, 20, 10))
+        self.assertEqual(parse_paging_parameters({"offset": "20", "truncate": "false"}),
+                         (None, 20, None))
+        for query in ({"offset": "abc"}, {"offset": "-1"}, {"lines": "-5"}, {"truncate": "x"}):
+            self.assertRaises(ValueError, parse_paging_parameters, query)
+
+
 class TestFilters(unittest.TestCase):
 
     def test__human_readable_duration(self):